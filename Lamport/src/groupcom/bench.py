@@ -0,0 +1,173 @@
+'''
+Created on 16/10/2026
+
+@author: ecejjar
+
+Micro-benchmarks for the group communication library.
+They exercise the code paths in isolation, without any network I/O, hence the
+figures they report are upper bounds on what the real servers can achieve.
+Run from this directory with: python bench.py
+'''
+
+from server import LogicalClockServer, BinaryCodec, JSONCodec, SequencedMsgLog
+from services.LeaderElection import O1StableLeaderElector, LeaderElectorBase, ExpiringLinksImpl
+from services.Paxos import Acceptor
+from threading import Lock, Thread
+from heapq import heappop
+from time import perf_counter
+import json
+import os
+import shelve
+import tempfile
+import logging
+
+def legacyhandle ( self, message, src ):
+    '''
+    The generic JSON handler as it was before ProtocolAgent built dispatch tables,
+    kept here as the baseline the current implementation is measured against.
+    '''
+    MyCls = type(self)
+    msgname, msgval = message.decode().split(':', 1)
+    if msgname in dir(MyCls):
+        MsgType = MyCls.__bases__[0].__dict__[msgname]
+        msg = MsgType(**json.loads(msgval))
+        MyCls.__dict__.get(msgname + 'Handler', MyCls.defaulthandler)(self, msg, src)
+    else:
+        return self.unknownhandler(message, src)
+
+def logicalclockserver ( ):
+    '''
+    Returns a LogicalClockServer having just the state its message handlers need;
+    the constructor is not called since it opens sockets and waits for state transfer.
+    '''
+    agent = LogicalClockServer.__new__(LogicalClockServer)
+    agent._LogicalClockServer__mutex = Lock()
+    agent._LogicalClockServer__clk = 0
+    agent._LogicalClockServer__members = {}
+    agent._LogicalClockServer__cmdseq = []
+    agent._LogicalClockServer__lasttimes = []
+    return agent
+
+def o1stableleaderelector ( address ):
+    '''
+    Returns an O1StableLeaderElector having just the state its message handlers need;
+    the constructor is not called since it sends Hello messages to its peers.
+    '''
+    class Observer(object):
+        def notify ( self, elector ): pass
+    agent = O1StableLeaderElector.__new__(O1StableLeaderElector)
+    agent.server_address = address
+    LeaderElectorBase.__init__(agent, [address], 0.2, Observer())
+    ExpiringLinksImpl.__init__(agent)
+    return agent
+
+def rate ( handle, agent, message, src, n ):
+    '''Calls handle(agent, message, src) n times, returns the number of calls per second'''
+    start = perf_counter()
+    for _ in range(n):
+        handle(agent, message, src)
+    return n / (perf_counter() - start)
+
+def benchdispatch ( n=100000 ):
+    address = ('127.0.0.1', 2020)
+    cases = [
+        ('LogicalClockServer', logicalclockserver(), LogicalClockServer.HeartbeatMsg(1)),
+        ('O1StableLeaderElector', o1stableleaderelector(address), O1StableLeaderElector.HelloMsg(address)),
+    ]
+    for name, agent, msg in cases:
+        before = rate(legacyhandle, agent, JSONCodec({}).encode(msg), address, n)
+        after = rate(type(agent).handle, agent, agent.msgcodec.encode(msg), address, n)
+        print("%s dispatch: %.0f msg/s before, %.0f msg/s after (x%.1f)" % (name, before, after, after/before))
+
+def benchcodecs ( n=100000 ):
+    msgs = [
+        LogicalClockServer.HeartbeatMsg(time=12345),
+        O1StableLeaderElector.OkMsg(1413452123.75, 0.00125, 0.0003, 17, [('10.0.0.1', 2020), ('10.0.0.2', 2020)]),
+        Acceptor.AcceptMsg(n=42, v='set x 1'),
+    ]
+    for msg in msgs:
+        msgtypes = {type(msg).__name__: type(msg)}
+        for codec in (JSONCodec(msgtypes), BinaryCodec(msgtypes)):
+            data = codec.encode(msg)
+            encrate = n / timeit(codec.encode, msg, n)
+            decrate = n / timeit(codec.decode, data, n)
+            print("%s with %s: %d bytes, %.0f encodings/s, %.0f decodings/s" % \
+                  (type(msg).__name__, type(codec).__name__, len(data), encrate, decrate))
+
+def benchlog ( n=2000, nthreads=8 ):
+    '''
+    Compares persisting sent messages the way loss-less RMcastServer did, one shelve write
+    and sync per message, with SequencedMsgLog, from one thread and from several at once.
+    '''
+    body = b'x' * 100
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shelf = shelve.open(os.path.join(tmpdir, 'shelf'))
+        def shelvesend ( seq ):
+            shelf[str(seq)] = body
+            shelf.sync()
+        shelverate = n / timeit(lambda _: [shelvesend(seq) for seq in range(1, n+1)], None, 1)
+        shelf.close()
+        
+        log, lock, seqs = SequencedMsgLog(os.path.join(tmpdir, 'log')), Lock(), iter(range(1, n*(nthreads+1)+1))
+        def logsend ( ):
+            with lock:
+                seq = next(seqs)
+                log.append(seq, body)
+            log.commit(seq)
+        lograte = n / timeit(lambda _: [logsend() for _ in range(n)], None, 1)
+        
+        def sender ( ):
+            for _ in range(n // nthreads): logsend()
+        def concurrently ( _ ):
+            threads = [Thread(target=sender) for _ in range(nthreads)]
+            list(map(Thread.start, threads))
+            list(map(Thread.join, threads))
+        grouprate = n / timeit(concurrently, None, 1)
+        log.close()
+    print("Loss-less sends: %.0f msg/s with shelve, %.0f msg/s with log, %.0f msg/s with log from %d threads" % \
+          (shelverate, lograte, grouprate, nthreads))
+
+def legacystable ( self ):
+    '''
+    The stability test as it was before LogicalClockServer kept the last message times of its
+    members in a heap, scanning all the members for every command delivered.
+    '''
+    if len(self.cmdseq) == 0: return False
+    if len(self.members) == 0: return True
+    with self.mutex:
+        mintime = min(map(lambda t: t[1][1], self.alivemembers))
+    return self.cmdseq[0][0] < mintime
+
+def benchstable ( n=10000, sizes=(4, 64, 1024) ):
+    '''Delivers n stable commands from groups of different sizes, one by one and all at once'''
+    def loaded ( members ):
+        agent = logicalclockserver()
+        for m in range(members):
+            agent.handleHeartbeat(LogicalClockServer.HeartbeatMsg(n + 1), ('10.0.0.%d' % m, 2020))
+        for time in range(n):
+            agent.handleCommand(LogicalClockServer.CommandMsg(time, time), ('10.0.0.0', 2020))
+        agent.handleHeartbeat(LogicalClockServer.HeartbeatMsg(n + 1), ('10.0.0.0', 2020))
+        return agent
+    def legacydeliver ( agent ):
+        while legacystable(agent): heappop(agent.cmdseq)
+    for members in sizes:
+        before = n / timeit(legacydeliver, loaded(members), 1)
+        after = n / timeit(list, loaded(members), 1)
+        drained = n / timeit(LogicalClockServer.drain_stable, loaded(members), 1)
+        print("Stable commands with %d members: %.0f cmd/s before, %.0f cmd/s one by one, %.0f cmd/s drained" % \
+              (members, before, after, drained))
+
+def timeit ( func, arg, n ):
+    '''Calls func(arg) n times, returns the time taken'''
+    start = perf_counter()
+    for _ in range(n):
+        func(arg)
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    benchdispatch()
+    benchcodecs()
+    benchlog()
+    benchstable()
@@ -8,24 +8,28 @@ and Lamport clocks-based total ordering multicast servers
 '''
 try:
     from socketserver import ThreadingMixIn, TCPServer, UDPServer, BaseRequestHandler # Python 3.x
-    from functools import reduce                                                      # Python 3.x
 except:
     from SocketServer import ThreadingMixIn, TCPServer, UDPServer, BaseRequestHandler # Python 2.x
 
 from functools import wraps    
-from collections import namedtuple, deque
-from struct import pack, unpack, calcsize
-from heapq import heappush, heappop
+from collections import namedtuple, OrderedDict, deque
+from itertools import count, islice
+from struct import Struct, pack, error as StructError
+from heapq import heappush, heappop, heapify
+from bisect import bisect_right
 from random import uniform
-from threading import Timer, Lock, Thread
-try:
-    from threading import _Timer    # Python 2.x
-except:
-    _Timer = Timer
-from operator import add
+from threading import Lock, RLock, Thread, Condition, Event, BoundedSemaphore, current_thread
 from select import select
-from time import clock
+from time import clock, monotonic
+from types import MappingProxyType
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import errno
+import zlib
 import shelve
+import dbm
+import selectors
 import socket
 import json
 import os
@@ -35,9 +39,119 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-class McastServer(UDPServer):
+class DgramBatchMixIn(object):
+    '''
+    A mix-in class for socketserver's UDPServer and its descendants. Every time the server
+    wakes up because its socket is readable, it drains all the datagrams ready in the socket
+    (up to 'batch_size') instead of reading just one, thus saving one wake-up per datagram.
+    Datagrams are read into a pool of buffers allocated once, when the first batch is read.
+    
+    A batch is a list of (data, client_address) tuples, where data is a memoryview over one
+    of the buffers in the pool; buffers are re-used by the next batch, so any data to be kept
+    must be copied before returning. If the server's handler class has a 'handlebatch'
+    class method it's called with the server and the batch as arguments; otherwise
+    the handler class is instantiated for each datagram as usual, but passing the datagram
+    as a bytes object.
+    
+    The class also provides methods for sending datagrams to many destinations in a row.
+    
+    Instead of calling serve_forever(), which takes a thread per server, the server can be
+    served by an asyncio event loop calling serve_on(). Batches are then handled by the loop's
+    thread, so any number of servers can share it.
+    '''
+    batch_size = 64
+    
+    # Where MSG_DONTWAIT is not supported (e.g. Windows) select() tells when the socket is drained
+    recv_flags = getattr(socket, 'MSG_DONTWAIT', 0)
+
+    def get_batch ( self ):
+        '''
+        Reads datagrams from the socket until no more are ready or the buffer pool is full.
+        Returns the batch of datagrams read, which may be empty.
+        '''
+        try:
+            pool = self.__pool
+        except AttributeError:
+            pool = self.__pool = [memoryview(bytearray(self.max_packet_size)) for _ in range(self.batch_size)]
+        batch = []
+        sock = self.socket
+        flags = self.recv_flags
+        for buf in pool:
+            if batch and not flags and not select([sock], [], [], 0)[0]:
+                break
+            try:
+                nbytes, client_address = sock.recvfrom_into(buf, 0, flags)
+            except (BlockingIOError, InterruptedError):
+                break       # EAGAIN/EWOULDBLOCK, the socket is drained
+            except socket.error as e:
+                logger.warning("Error receiving datagrams on %s, cause: %s", self.server_address, e)
+                break
+            batch.append((buf[:nbytes], client_address))
+        return batch
+    
+    def process_batch ( self, batch ):
+        handlebatch = getattr(self.RequestHandlerClass, 'handlebatch', None)
+        if handlebatch is not None:
+            return handlebatch(self, batch)
+        for data, client_address in batch:
+            request = (bytes(data), self.socket)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+    
+    def _handle_request_noblock ( self ):
+        '''
+        Overloads the base class method called by serve_forever() and handle_request()
+        when the socket is readable, so it handles a whole batch of datagrams.
+        '''
+        batch = self.get_batch()
+        if batch:
+            self.process_batch(batch)
+
+    def serve_on ( self, loop ):
+        '''
+        Has the asyncio event loop 'loop' handle the batches of datagrams received from now on.
+        Nothing run by the loop may block then: e.g. a RMcastServer with 'sndwindow' set
+        waits for acks when sending with the window full, but the acks are handled by the
+        loop, so sending from the loop's thread would deadlock until 'sndtimeout' expires.
+        '''
+        loop.add_reader(self.socket.fileno(), self._handle_request_noblock)
+        
+    def stop_serving ( self, loop ):
+        '''
+        Stops handling datagrams from the asyncio event loop 'loop' (see serve_on()).
+        '''
+        loop.remove_reader(self.socket.fileno())
+
+    def sendbatch ( self, batch ):
+        '''
+        Sends every datagram in the batch, a sequence of (data, destination) tuples.
+        Returns the list of destinations which the datagram could not be sent to.
+        '''
+        failed = []
+        sendto = self.socket.sendto
+        for data, dst in batch:
+            try:
+                if sendto(data, dst) < len(data):
+                    failed.append(dst)
+            except socket.error as e:
+                logger.debug("Error sending datagram to %s: %s", dst, e)
+                failed.append(dst)
+        return failed
+    
+    def sendmany ( self, data, dsts ):
+        '''
+        Sends the same datagram to every destination in dsts.
+        Returns the list of destinations which the datagram could not be sent to.
+        '''
+        return self.sendbatch((data, dst) for dst in dsts)
+
+
+class McastServer(DgramBatchMixIn, UDPServer):
     '''
     A multicast server (sender and receiver).
+    Received datagrams are handled in batches, see DgramBatchMixIn.
     Usage:
     >>> from groupcom.server import McastServer
     >>> import socket
@@ -111,6 +225,12 @@ class McastBridgeHandler(BaseRequestHandler):
             #print("Routing message from %s to %s" % (self.client_address, self.server.peer.grpaddr))
             self.server.peer.send(self.request[0])
 
+    @classmethod
+    def handlebatch ( cls, server, batch ):
+        own_addr = server.socket.getsockname()
+        grpaddr = server.peer.grpaddr
+        server.peer.sendbatch([(data, grpaddr) for data, client_address in batch if client_address != own_addr])
+
 
 class McastBridge(McastServer):
     '''
@@ -128,37 +248,219 @@ class McastBridge(McastServer):
         del self.__peer
     peer = property(getPeer, setPeer, removePeer)
 
+
+class SeenCache(object):
+    '''
+    A bounded set of recently seen keys. Keys are forgotten 'ttl' seconds after they're first
+    seen or, if more than 'maxlen' keys are seen in that time, when they're the oldest in the
+    set. The cache counts hits (keys seen again) and misses (keys seen for the first time).
+    The class is not thread-safe.
+    '''
+    MAXLEN = 65536
+    
+    def __init__ ( self, ttl, maxlen=None ):
+        self.__ttl = ttl
+        self.__maxlen = maxlen or SeenCache.MAXLEN
+        self.__keys = OrderedDict()  # key -> expiry time, oldest first
+        self.__hits = 0
+        self.__misses = 0
+        
+    @property
+    def ttl ( self ): return self.__ttl
+    
+    @property
+    def maxlen ( self ): return self.__maxlen
+    
+    @property
+    def hits ( self ): return self.__hits
+    
+    @property
+    def misses ( self ): return self.__misses
+    
+    def __len__ ( self ):
+        return len(self.__keys)
+    
+    def seen ( self, key ):
+        '''
+        Tells if 'key' has been seen before and is still remembered; if not, remembers it.
+        '''
+        keys, now = self.__keys, monotonic()
+        while keys:
+            oldest, expiry = next(iter(keys.items()))
+            if expiry > now: break
+            del keys[oldest]
+        if key in keys:
+            self.__hits += 1
+            return True
+        keys[key] = now + self.__ttl
+        if len(keys) > self.__maxlen:
+            keys.popitem(last=False)
+        self.__misses += 1
+        return False
+
     
 class McastRouter(object):
     '''
-    A router joining two multicast domains by means of two bridges peered to each other
+    A router joining two or more multicast domains by means of one bridge per domain.
+    Datagrams received by any bridge are forwarded to the groups of all the other bridges,
+    except those sent by the router's bridges themselves.
+    
+    The router serves all the bridges' sockets from a single thread waiting on a selector;
+    every time a socket is readable it is drained, reading the datagrams in batches (see
+    DgramBatchMixIn) and forwarding every batch to each of the other domains in a row.
+    
+    Extra domains beyond the first two are passed in actual argument 'domains', a sequence of
+    (hostport, mcast_hostport) tuples. If actual argument 'func' is present it's called as
+    func(data, src) for every datagram received, 'data' being a bytes object and 'src' the
+    address of the datagram's sender; it returns the data to be forwarded, or None if the
+    datagram must be dropped.
+    
+    The router counts the datagrams forwarded from each domain to each other one, see the
+    'forwarded' property, and those dropped by 'func' in each domain, see 'filtered'.
+    
+    Several routers can join the same domains for redundancy; each router is then given the
+    addresses of the bridges of the others in actual argument 'routers', a sequence holding
+    a sequence of bridge addresses per router. Datagrams sent by another router's bridges
+    are never forwarded, so routers don't forward each other's datagrams back and forth,
+    and traffic from a domain to another is forwarded by a single designated router: the
+    one ranking first for that pair of groups (hashing the groups and the router's lowest
+    bridge address) among itself and the routers heard from in the last 'peerttl' seconds.
+    Hence, for 'peerttl' seconds after the designated router dies, or after some traffic
+    resumes following a quiet period, datagrams may be lost or forwarded twice; receivers
+    tell duplicates apart and RMcastServer NAKs the losses.
+    
+    Besides, the router remembers the datagrams of RMcastServer messages it receives for
+    'dupttl' seconds (see SeenCache, its 'seen' property), keyed by the message's whole header
+    (sequence number, epoch and ack, which tells apart the NAKs of different receivers) and a
+    digest of its body (the sender's address is not preserved by routers), and drops those it has already seen, whichever domain they come from. The time
+    must be shorter than it takes a RMcastServer to ask for a re-transmission (see
+    SequencedMsgRcvQueue.naktime), which must not be dropped; setting it to 0 disables the
+    cache. Datagrams too short to carry a SequencedMessage header are not cached; actual
+    argument 'dupkey', if present, replaces rmcastkey() as the function telling the key of
+    a datagram, or None if it must not be cached.
     '''
-    def __init__ ( self, hostport1, mcast_hostport1, hostport2, mcast_hostport2, func = None ):
+    DUPTTL = 0.25
+    PEERTTL = 2.0
+    
+    def __init__ ( self, hostport1, mcast_hostport1, hostport2, mcast_hostport2, func = None, domains = (),
+                   dupttl = DUPTTL, dupmax = None, dupkey = None, routers = (), peerttl = PEERTTL ):
         '''
         Constructor
         '''
-        self.__server1 = McastBridge(hostport1, mcast_hostport1)
-        self.__server2 = McastBridge(hostport2, mcast_hostport2, 32, self.__server1)
+        self.__servers = [McastBridge(hostport, mcast_hostport)
+                          for hostport, mcast_hostport in [(hostport1, mcast_hostport1), (hostport2, mcast_hostport2)] + list(domains)]
+        self.__server1, self.__server2 = self.__servers[:2]
         self.__server1.peer = self.__server2
+        self.__server2.peer = self.__server1
+        self.__own = set(server.server_address for server in self.__servers)
         self.__func = func
+        self.__forwarded = [[0] * len(self.__servers) for _ in self.__servers]
+        self.__filtered = [0] * len(self.__servers)
+        self.__seen = SeenCache(dupttl, dupmax) if dupttl else None
+        self.__dupkey = dupkey or McastRouter.rmcastkey
+        self.__routers = {}         # bridge address of another router -> the router's id
+        for bridges in routers:
+            bridges = [tuple(bridge) for bridge in bridges]
+            self.__routers.update((bridge, min(bridges)) for bridge in bridges)
+        self.__id = min(self.__own)
+        self.__heard = {}           # router id -> time the router was last heard from
+        self.__peerttl = peerttl
         self.__shutdown = False
-
+    
+    @staticmethod
+    def rmcastkey ( data ):
+        '''
+        Returns the key of a datagram carrying a RMcastServer message in the cache of datagrams
+        seen lately, or None if it's too short to be one.
+        '''
+        header = SequencedDgramMsgHandler.HEADER
+        if len(data) < header.size: return None
+        return bytes(data[:header.size]) + blake2b(data[header.size:], digest_size=8).digest()
+    
+    def designated ( self, index, peer_index ):
+        '''
+        Tells if this router is the one forwarding datagrams from the group of the bridge in
+        position 'index' to the group of the bridge in position 'peer_index'.
+        '''
+        if not self.__heard: return True
+        pair = repr((self.__servers[index].grpaddr, self.__servers[peer_index].grpaddr))
+        rank = lambda router: blake2b((pair + repr(router)).encode('utf8'), digest_size=8).digest()
+        now = monotonic()
+        alive = [router for router, heard in self.__heard.items() if now - heard < self.__peerttl]
+        return all(rank(self.__id) < rank(router) for router in alive)
+    
     def route_forever ( self ):
+        selector = selectors.DefaultSelector()
         try:
+            for index, server in enumerate(self.__servers):
+                selector.register(server.socket, selectors.EVENT_READ, index)
             while not self.__shutdown:
-                r, w, e = select([self.__server1.socket, self.__server2.socket], [], [], 0.5)
-                if self.__server1.socket in r:
-                    self.__server1.handle_request()
-                if self.__server2.socket in r:
-                    self.__server2.handle_request()
+                for key, _ in selector.select(0.5):
+                    self.route(key.data)
         finally:
-            self.__server1.socket.close()
-            self.__server2.socket.close()
+            selector.close()
+            for server in self.__servers:
+                server.socket.close()
             self.__shutdown = False
-
+            
+    def route ( self, index ):
+        '''
+        Forwards all the datagrams ready in the socket of the bridge in position 'index' to the
+        groups of all the other bridges.
+        '''
+        server, own, routers, func = self.__servers[index], self.__own, self.__routers, self.__func
+        forwarded = self.__forwarded[index]
+        cache, dupkey = self.__seen, self.__dupkey
+        def seen ( data ):
+            if cache is None: return False
+            key = dupkey(data)
+            return key is not None and cache.seen(key)
+        while True:
+            batch = server.get_batch()
+            for _, client_address in batch:
+                if client_address in routers:
+                    self.__heard[routers[client_address]] = monotonic()
+            received = [(data, client_address) for data, client_address in batch
+                        if client_address not in own and client_address not in routers and not seen(data)]
+            if func is None:
+                dgrams = [data for data, _ in received]
+            else:
+                dgrams = [data for data in (func(bytes(data), client_address) for data, client_address in received)
+                          if data is not None]
+                self.__filtered[index] += len(received) - len(dgrams)
+            if dgrams:
+                for peer_index, peer in enumerate(self.__servers):
+                    if peer is server or not self.designated(index, peer_index): continue
+                    grpaddr = peer.grpaddr
+                    failed = peer.sendbatch([(data, grpaddr) for data in dgrams])
+                    forwarded[peer_index] += len(dgrams) - len(failed)
+            if len(batch) < server.batch_size:
+                return      # drained
+            
     def shutdown ( self ):
         self.__shutdown = True
 
+    @property
+    def servers ( self ):
+        return tuple(self.__servers)
+    
+    @property
+    def forwarded ( self ):
+        '''Number of datagrams forwarded, as a {(from group, to group): count} dictionary'''
+        servers = self.__servers
+        return {(servers[i].grpaddr, servers[j].grpaddr): count
+                for i, row in enumerate(self.__forwarded) for j, count in enumerate(row) if i != j}
+    
+    @property
+    def seen ( self ):
+        '''The cache of datagrams seen lately, None if disabled'''
+        return self.__seen
+    
+    @property
+    def filtered ( self ):
+        '''Number of datagrams dropped by the router's function, as a {group: count} dictionary'''
+        return {server.grpaddr: count for server, count in zip(self.__servers, self.__filtered)}
+    
     @property
     def server1 ( self ):
         return self.__server1
@@ -168,6 +470,435 @@ class McastRouter(object):
         return self.__server2
 
 
+class Framing(object):
+    '''
+    The framing of messages sent over TCP connections by agents: every message is preceded
+    by a HEADER holding its length. Messages are written with scatter/gather I/O, so headers
+    and messages are never concatenated, and many messages can be written with a single
+    system call. Received messages are reassembled by a Reader.
+    '''
+    HEADER = Struct('!I')   # message length
+    MAXSIZE = 1 << 30       # longer messages are taken as a corrupted stream
+    RECVSIZE = 1 << 16
+    try:
+        IOVMAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+    except (AttributeError, ValueError, OSError):
+        IOVMAX = 16
+    
+    class Reader(object):
+        '''
+        Reassembles the messages received over a connection into a buffer re-used for
+        the whole life of the connection, growing it only for messages not fitting in it.
+        '''
+        def __init__ ( self, size=None ):
+            self.__buf = bytearray(size or Framing.RECVSIZE)
+            self.__start = 0        # first byte not parsed yet
+            self.__end = 0          # first byte not received yet
+            self.__needed = Framing.HEADER.size
+            
+        def recv ( self, sock ):
+            '''
+            Receives whatever is ready in socket 'sock', up to the buffer's free space. Returns the
+            list of messages completed, or None if the remote peer closed the connection. Non-blocking
+            sockets raise BlockingIOError if nothing is ready.
+            '''
+            self.__reserve()
+            with memoryview(self.__buf)[self.__end:] as view:
+                nbytes = sock.recv_into(view)
+            if nbytes == 0: return None
+            self.__end += nbytes
+            return self.__parse()
+        
+        def feed ( self, data ):
+            '''
+            Adds 'data', received by some other means, to the buffer. Returns the list of messages completed.
+            '''
+            self.__reserve(len(data))
+            self.__buf[self.__end:self.__end+len(data)] = data
+            self.__end += len(data)
+            return self.__parse()
+        
+        def __reserve ( self, nbytes=1 ):
+            ''' Makes room for at least 'nbytes' bytes and for the message being received, if known '''
+            buf, start, end = self.__buf, self.__start, self.__end
+            needed = max(start + self.__needed, end + nbytes)
+            if needed <= len(buf): return
+            if start > 0:
+                buf[:end-start] = buf[start:end]
+                self.__start, self.__end = 0, end - start
+                needed -= start
+            if needed > len(buf):
+                buf.extend(bytes(max(needed, 2 * len(buf)) - len(buf)))
+        
+        def __parse ( self ):
+            header, msgs = Framing.HEADER, []
+            start, end = self.__start, self.__end
+            with memoryview(self.__buf) as view:
+                while end - start >= header.size:
+                    msglen, = header.unpack_from(view, start)
+                    if msglen > Framing.MAXSIZE:
+                        raise ValueError("Message of %d bytes exceeds max message size, stream corrupted" % msglen)
+                    if end - start < header.size + msglen:
+                        self.__needed = header.size + msglen
+                        break
+                    start += header.size
+                    msgs.append(bytes(view[start:start+msglen]))
+                    start += msglen
+                else:
+                    self.__needed = header.size
+            if start == end:
+                start = end = 0
+            self.__start, self.__end = start, end
+            return msgs
+    
+    @staticmethod
+    def frame ( msg ):
+        ''' Returns the buffers to be written for message 'msg' '''
+        return (Framing.HEADER.pack(len(msg)), msg) if len(msg) else (Framing.HEADER.pack(0),)
+    
+    @staticmethod
+    def sendv ( sock, buffers ):
+        '''
+        Writes as much as socket 'sock' takes of the buffers in 'buffers' with a single system
+        call. Returns the number of bytes written.
+        '''
+        buffers = list(islice(buffers, Framing.IOVMAX))
+        if hasattr(sock, 'sendmsg'):
+            return sock.sendmsg(buffers)
+        return sock.send(b''.join(buffers))     # e.g. Windows
+    
+    @staticmethod
+    def consume ( buffers, nbytes ):
+        ''' Drops the first 'nbytes' bytes written from deque 'buffers' '''
+        while nbytes:
+            first = buffers[0]
+            if len(first) <= nbytes:
+                nbytes -= len(first)
+                buffers.popleft()
+            else:
+                buffers[0] = memoryview(first)[nbytes:]
+                nbytes = 0
+    
+    @staticmethod
+    def sendall ( sock, msgs ):
+        ''' Writes all the messages in 'msgs' to blocking socket 'sock' '''
+        buffers = deque(buf for msg in msgs for buf in Framing.frame(msg))
+        while buffers:
+            Framing.consume(buffers, Framing.sendv(sock, buffers))
+
+
+class MultiplexedTCPServer(object):
+    '''
+    A TCP server (and client) handling any number of connections from a single thread waiting
+    on a selector, rather than from a thread per connection like socketserver's ThreadingMixIn.
+    Sub-classes provide a handle(data, peer) method, called for every message received; if it
+    returns something other than None it is sent back to the peer.
+    
+    Messages are framed as by TCP agents (see Framing). Sockets are non-blocking: every
+    connection has a read buffer where frames split across several reads are reassembled,
+    and a write queue holding the frames the socket couldn't take yet, which are written
+    with as few system calls as the socket allows. send()
+    queues a message for a peer, connecting to it if needed, and can be called from any
+    thread; when the queue of a connection holds more than 'maxqueue' bytes, it blocks until
+    the queue drains, raising TimeoutError if it doesn't in 'sndtimeout' seconds (by default
+    it waits forever). Messages sent by the serving thread itself, e.g. answers, are always
+    queued. Connections without traffic for 'idletime' seconds are closed, if present.
+    
+    By default messages are handled by the serving thread. Setting 'workers' to a number
+    of threads has messages handled by a pool of that many threads instead, keeping the
+    order of the messages received on each connection.
+    
+    Connections are known by the address of the peer, i.e. the address connected to for
+    outgoing connections and the remote address for incoming ones; see the 'peers' property.
+    If the sub-class has a closed(peer) method it is called whenever a connection is closed.
+    '''
+    MAXQUEUE = 1 << 20
+    
+    class Connection(object):
+        '''A connection to a peer, its buffers and the messages waiting for a worker'''
+        __slots__ = ('sock', 'peer', 'reader', 'wqueue', 'wbytes', 'lastactive', 'connecting', 'closed',
+                     'lock', 'drained', 'msgs', 'busy')
+        
+        def __init__ ( self, sock, peer, connecting=False ):
+            self.sock = sock
+            self.peer = peer
+            self.reader = Framing.Reader()
+            self.wqueue = deque()
+            self.wbytes = 0
+            self.lastactive = monotonic()
+            self.connecting = connecting
+            self.closed = False
+            self.lock = Lock()
+            self.drained = Condition(self.lock)
+            self.msgs = []
+            self.busy = False
+    
+    def __init__ ( self, hostport, workers=None, idletime=None, maxqueue=None, sndtimeout=None, backlog=128 ):
+        '''
+        Constructor
+        '''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(hostport)
+        self.socket.listen(backlog)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.socket, selectors.EVENT_READ, None)
+        self.__wakeup, self.__waker = socket.socketpair()
+        self.__wakeup.setblocking(False)
+        self.__waker.setblocking(False)
+        self.__selector.register(self.__wakeup, selectors.EVENT_READ, self.__wakeup)
+        self.__peers = {}           # peer address -> Connection
+        self.__lock = Lock()        # protects the two members above and below
+        self.__changes = []         # connections whose selector registration is to be updated
+        self.__executor = ThreadPoolExecutor(workers) if workers else None
+        self.__idletime = idletime
+        self.__maxqueue = maxqueue or MultiplexedTCPServer.MAXQUEUE
+        self.__sndtimeout = sndtimeout
+        self.__thread = None
+        self.__shutdown = False
+        
+    @property
+    def peers ( self ): return self.__peers
+    
+    @property
+    def idletime ( self ): return self.__idletime
+    
+    @property
+    def maxqueue ( self ): return self.__maxqueue
+    
+    @property
+    def sndtimeout ( self ): return self.__sndtimeout
+    
+    def serve_forever ( self, poll_interval=0.5 ):
+        self.__thread = current_thread()
+        selector = self.__selector
+        nextreap = monotonic()
+        try:
+            while not self.__shutdown:
+                for key, events in selector.select(poll_interval):
+                    conn = key.data
+                    if conn is None:
+                        self.__accept()
+                    elif conn is self.__wakeup:
+                        self.__drainwakeup()
+                    else:
+                        if events & selectors.EVENT_READ:
+                            self.__read(conn)
+                        if events & selectors.EVENT_WRITE and not conn.closed:
+                            self.__write(conn)
+                self.__applychanges()
+                if self.__idletime is not None and monotonic() >= nextreap:
+                    self.__reap()
+                    nextreap = monotonic() + self.__idletime / 2
+        finally:
+            self.__thread = None
+            self.__shutdown = False
+            
+    def shutdown ( self ):
+        ''' Makes serve_forever() return; connections are left open '''
+        self.__shutdown = True
+        self.__wake()
+        
+    def close ( self ):
+        ''' Closes every connection and the listening socket '''
+        for conn in list(self.__peers.values()):
+            self.__close(conn)
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
+        self.__selector.close()
+        self.__wakeup.close()
+        self.__waker.close()
+        self.socket.close()
+        
+    def send ( self, msg, dst ):
+        '''
+        Sends message 'msg' to the peer whose address is 'dst', connecting to it if needed.
+        '''
+        buffers = deque(Framing.frame(msg))
+        nbytes = len(msg) + Framing.HEADER.size
+        conn = self.__connection(dst)
+        with conn.lock:
+            if conn.wbytes > self.__maxqueue and current_thread() is not self.__thread:
+                if not conn.drained.wait_for(lambda: conn.wbytes <= self.__maxqueue or conn.closed, self.__sndtimeout):
+                    raise TimeoutError("Write queue to %s full: %d bytes not sent" % (str(dst), conn.wbytes))
+            if conn.closed:
+                raise ConnectionError("Connection to %s closed" % str(dst))
+            if not conn.wqueue and not conn.connecting:
+                # Nothing queued, try to send right away
+                try:
+                    sent = Framing.sendv(conn.sock, buffers)
+                except BlockingIOError:
+                    sent = 0
+                conn.lastactive = monotonic()
+                if sent == nbytes: return
+                Framing.consume(buffers, sent)
+                nbytes -= sent
+            conn.wqueue.extend(buffers)
+            conn.wbytes += nbytes
+        self.__watch(conn)
+        
+    def __connection ( self, dst ):
+        with self.__lock:
+            conn = self.__peers.get(dst)
+            if conn is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                err = sock.connect_ex(dst)
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sock.close()
+                    raise ConnectionError(err, "Unable to connect to %s: %s" % (str(dst), os.strerror(err)))
+                conn = self.__peers[dst] = MultiplexedTCPServer.Connection(sock, dst, err != 0)
+                self.__changes.append(conn)
+            else:
+                return conn
+        self.__wake()
+        return conn
+    
+    def __watch ( self, conn ):
+        ''' Has the serving thread wait for the connection's socket to be writable '''
+        with self.__lock:
+            self.__changes.append(conn)
+        if current_thread() is not self.__thread:
+            self.__wake()
+            
+    def __wake ( self ):
+        try:
+            self.__waker.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass        # already awake, or closed
+    
+    def __drainwakeup ( self ):
+        try:
+            while self.__wakeup.recv(4096): pass
+        except BlockingIOError:
+            pass
+        
+    def __applychanges ( self ):
+        with self.__lock:
+            changes, self.__changes = self.__changes, []
+        for conn in changes:
+            with conn.lock:
+                if conn.closed: continue
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.wqueue or conn.connecting else 0)
+                try:
+                    self.__selector.modify(conn.sock, events, conn)
+                except KeyError:
+                    self.__selector.register(conn.sock, events, conn)
+        
+    def __accept ( self ):
+        while True:
+            try:
+                sock, peer = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = MultiplexedTCPServer.Connection(sock, peer)
+            with self.__lock:
+                self.__peers[peer] = conn
+            self.__selector.register(sock, selectors.EVENT_READ, conn)
+            
+    def __read ( self, conn ):
+        try:
+            msgs = conn.reader.recv(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Error receiving from remote peer %s, cause: %s", conn.peer, e)
+            msgs = None
+        if msgs is None:
+            return self.__close(conn)   # remote peer closed the connection
+        conn.lastactive = monotonic()
+        if not msgs: return
+        if self.__executor is None:
+            self.__handlemany(conn, msgs)
+        else:
+            with conn.lock:
+                conn.msgs.extend(msgs)
+                if conn.busy: return
+                conn.busy = True
+            self.__executor.submit(self.__drain, conn)
+            
+    def __drain ( self, conn ):
+        while True:
+            with conn.lock:
+                if not conn.msgs:
+                    conn.busy = False
+                    return
+                msgs, conn.msgs = conn.msgs, []
+            self.__handlemany(conn, msgs)
+    
+    def __handlemany ( self, conn, msgs ):
+        for msg in msgs:
+            try:
+                result = self.handle(msg, conn.peer)
+                if result is not None:
+                    MultiplexedTCPServer.send(self, result, conn.peer)
+            except Exception:
+                logger.exception("Error handling message from remote peer %s", conn.peer)
+        
+    def __write ( self, conn ):
+        with conn.lock:
+            sock = conn.sock
+            if conn.connecting:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    logger.warning("Unable to connect to remote peer %s, cause: %s", conn.peer, os.strerror(err))
+                    conn.wqueue.clear()
+                    conn.wbytes = 0
+                conn.connecting = False
+            else:
+                err = 0
+            queue = conn.wqueue
+            while queue and not err:
+                buffers = list(islice(queue, Framing.IOVMAX))
+                try:
+                    sent = Framing.sendv(sock, buffers)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as e:
+                    logger.warning("Error sending to remote peer %s, cause: %s", conn.peer, e)
+                    err = e.errno
+                    break
+                conn.wbytes -= sent
+                Framing.consume(queue, sent)
+                if sent < sum(map(len, buffers)):
+                    break       # the socket's buffer is full
+            conn.lastactive = monotonic()
+            if conn.wbytes <= self.__maxqueue:
+                conn.drained.notify_all()
+            if not queue and not err:
+                self.__selector.modify(sock, selectors.EVENT_READ, conn)
+        if err:
+            self.__close(conn)
+            
+    def __reap ( self ):
+        ''' Closes the connections without traffic for the last 'idletime' seconds '''
+        expiry = monotonic() - self.__idletime
+        for conn in [conn for conn in list(self.__peers.values()) if conn.lastactive < expiry and not conn.wqueue]:
+            self.__close(conn)
+            
+    def __close ( self, conn ):
+        with conn.lock:
+            if conn.closed: return
+            conn.closed = True
+            conn.drained.notify_all()
+        with self.__lock:
+            if self.__peers.get(conn.peer) is conn:
+                del self.__peers[conn.peer]
+        try:
+            self.__selector.unregister(conn.sock)
+        except (KeyError, ValueError, RuntimeError):
+            pass        # never registered, or the selector is closed
+        conn.sock.close()
+        closed = getattr(self, 'closed', None)
+        if closed is not None:
+            closed(conn.peer)
+
+
 SequencedMessage = namedtuple('SequencedMessage', 'seq, epoch, ack, body')
 
 
@@ -175,44 +906,70 @@ class SequencedDgramMsgHandler(BaseRequestHandler):
     '''
     A handler for datagram senders of sequenced messages.
     Its only function is decoding the sequenced message and delivering it to its server.
+    
+    When handling batches of datagrams, if the server's 'zerocopy' attribute is True the
+    message body is a memoryview over the receive buffer rather than a bytes object; the
+    server must copy the body before the handlebatch() method returns if it needs to keep it.
     '''
+    HEADER = Struct('QQQ')  # seq, epoch, ack
+    
     def handle ( self ):
         msg = self.decode()                                 # decode msg
         self.server.receive(msg, self.client_address[0])    # hand over to server
     
     def decode ( self ):
-        return SequencedMessage(*unpack('QQQ%ds' % (len(self.request[0]) - 3*calcsize('Q')), self.request[0]))
+        data = self.request[0]
+        header = SequencedDgramMsgHandler.HEADER
+        return SequencedMessage(*header.unpack_from(data), body=bytes(data[header.size:]))
+
+    @classmethod
+    def handlebatch ( cls, server, batch ):
+        header = cls.HEADER
+        zerocopy = server.zerocopy
+        for data, client_address in batch:
+            body = data[header.size:]
+            msg = SequencedMessage(*header.unpack_from(data), body=body if zerocopy else bytes(body))
+            try:
+                server.receive(msg, client_address[0])
+            except Exception:
+                server.handle_error((data, server.socket), client_address)
 
 
-class SequencedMsgSndQueue(deque):
+class SequencedMsgSndQueue(object):
     '''
-    A normal deque providing a send-queue-like interface. This interface creates
-    a sliding-window abstraction.
+    A fixed-size ring buffer of sequenced messages providing a send-queue-like interface.
+    This interface creates a sliding-window abstraction.
     
     The queue has a sequence number property containing the sequence number of the
     last message pushed into the queue. Each time a message is pushed into the
     queue it gets the sequence number queue.seq+1 and the queue's 'seq' property
-    is updated accordingly.
+    is updated accordingly. Messages are retrieved by sequence number in constant
+    time using the indexing operator, i.e. queue[seq]; IndexError is raised if the
+    message with that sequence number is not in the queue.
     
-    The queue has also an 'ack' property containing the sequence number
-    in the last positive acknowledge received from any peer. The class keeps a counter
-    of the number of times the same acknowledged sequence number has been seen.
+    The queue keeps the sequence number in the last positive acknowledge received from
+    each peer, and a counter of the number of times that peer sent the same acknowledged
+    sequence number. The queue's 'ack' property is the lowest of those sequence numbers,
+    i.e. the sequence number of the first message not received by some known peer.
     
     The current sending window ranges from the queue's head to the message having
     as sequence number the value of the queue's 'ack' property.
     
-    By default the queue grows without bound, but its maximum size can be limited by
-    argument 'maxlen' to the class' constructor.
+    The queue holds at most 'maxlen' messages; when full, pushing a message drops the
+    oldest one, whether acknowledged or not. The number of messages dropped this way is
+    available in the queue's 'dropped' property.
     
-    The queue can be trimmed down to the current transmission
-    window (thus "forgetting" about all the acknowledged messages) calling its tail()
-    method.
+    The queue can be trimmed down to the current transmission window (thus "forgetting"
+    about all the messages acknowledged by all the known peers) calling its tail() method.
+    Notice peers never sending an acknowledge are unknown to the queue, so they may still
+    miss a message trimmed down.
     
-    Notice that trimming down the queue in a RMcast environment where just one peer
-    has sent a positive ack for a message may cause it to forget about messages not
-    received by other peers. If a nak for a forgotten message comes in later the
-    queue will be unable to re-transmit it. 
+    The queue is thread-safe, since messages are pushed by the sending threads while acks
+    are recorded, and the queue trimmed, by the thread receiving them.
     '''
+    MAXLEN = 1024
+    SLACK = 64      # stale entries the heap of acks may hold beyond twice the peers
+    
     def __init__ ( self, seq=0, maxlen=None ):
         '''
         Constructor.
@@ -220,42 +977,137 @@ class SequencedMsgSndQueue(deque):
         first message pushed into the queue shall get this sequence number plus one.
         By default it takes the value 0.
         @param maxlen: controls the maximum size of the queue. By default it
-        takes the value None, i.e. no maximum size limit.
+        takes the value None, i.e. SequencedMsgSndQueue.MAXLEN messages.
         '''
-        super(SequencedMsgSndQueue, self).__init__(maxlen=maxlen)
-        self.__seq = seq
-        self.__ack = [0, 0]
+        self.__maxlen = maxlen or SequencedMsgSndQueue.MAXLEN
+        self.__ring = [None] * self.__maxlen
+        self.__lock = RLock()       # protects the ring and the acks
+        self.__acks = {}            # peer -> [ack, count]
+        self.__ackheap = []         # (ack, n, peer) tuples, entries not matching self.__acks are stale
+        self.__ackcounter = count() # tie-breaker for heap entries, peers may not be comparable
+        self.__lastack = [0, 0]     # the entry in self.__acks updated last
+        self.__nbytes = 0
+        self.__dropped = 0
+        self.__trimmed = 0
+        self.seq = seq
     
     @property
     def seq ( self ): return self.__seq
 
     @seq.setter
-    def seq ( self, seq ): self.__seq = seq
+    def seq ( self, seq ):
+        with self.__lock:
+            self.__seq = seq
+            self.__first = seq + 1
+            self.__ring = [None] * self.__maxlen
+            self.__nbytes = 0
     
     @property
-    def ack ( self ): return self.__ack[0]
+    def first ( self ): return self.__first
+    
+    @property
+    def ack ( self ):
+        with self.__lock:
+            heap, acks = self.__ackheap, self.__acks
+            while heap:
+                ack, _, peer = heap[0]
+                if peer in acks and acks[peer][0] == ack:
+                    return ack
+                heappop(heap)
+            return 0
 
     @property
-    def ackcount ( self ): return self.__ack[1]
+    def ackcount ( self ): return self.__lastack[1]
 
     @property
     def empty ( self ): return len(self) == 0
 
+    @property
+    def maxlen ( self ): return self.__maxlen
+
+    @property
+    def nbytes ( self ):
+        '''The total size of the bodies of the messages in the queue'''
+        return self.__nbytes
+    
+    @property
+    def dropped ( self ):
+        '''The number of messages dropped from the queue before being acknowledged by all peers'''
+        return self.__dropped
+    
+    @property
+    def trimmed ( self ):
+        '''The number of messages acknowledged by all peers and trimmed down from the queue'''
+        return self.__trimmed
+    
+    def __len__ ( self ):
+        return self.__seq - self.__first + 1
+    
+    def __getitem__ ( self, seq ):
+        with self.__lock:
+            if seq < self.__first or seq > self.__seq:
+                raise IndexError("Message with sequence number %d not in memory" % seq)
+            return self.__ring[seq % self.__maxlen]
+    
+    def __iter__ ( self ):
+        with self.__lock:
+            return iter([self.__ring[seq % self.__maxlen] for seq in range(self.__first, self.__seq + 1)])
+    
     def push ( self, msg ):
-        self.__seq += 1
-        self.append(msg)
+        with self.__lock:
+            if len(self) == self.__maxlen:
+                self.__popfirst()
+                self.__dropped += 1
+            self.__seq += 1
+            self.__ring[self.__seq % self.__maxlen] = msg
+            self.__nbytes += len(msg.body or b'')
 
-    def updateack ( self, ack ):
-        if ack > self.ack:
-            self.__ack = [ack, 1]
-        else:
-            self.__ack[1] += 1
+    def updateack ( self, ack, peer=None ):
+        '''
+        Records the acknowledged sequence number 'ack' received from 'peer'.
+        '''
+        with self.__lock:
+            entry = self.__acks.get(peer)
+            if entry is None or ack > entry[0]:
+                entry = self.__acks[peer] = [ack, 1]
+                heappush(self.__ackheap, (ack, next(self.__ackcounter), peer))
+                self.__compact()
+            else:
+                entry[1] += 1
+            self.__lastack = entry
+        
+    def __compact ( self ):
+        '''
+        Rebuilds the heap of acks out of the current ones if it holds too many stale entries,
+        which only leave the heap when they reach its top: a peer not acking anything new for
+        a while keeps the entries of those acking underneath it. The caller must hold the lock.
+        '''
+        acks = self.__acks
+        if len(self.__ackheap) > 2 * len(acks) + SequencedMsgSndQueue.SLACK:
+            self.__ackheap = [(entry[0], next(self.__ackcounter), peer) for peer, entry in acks.items()]
+            heapify(self.__ackheap)
+        
+    def forget ( self, peer ):
+        '''
+        Stops tracking the acknowledges sent by 'peer', e.g. because it is dead.
+        '''
+        with self.__lock:
+            self.__acks.pop(peer, None)
 
     def tail ( self ):
-        if not self.empty:
-            # Remove all messages from send queue's tail with seq < ack
-            while self[0].seq < self.ack:
-                self.popleft()
+        # Remove all messages from send queue's tail with seq < ack
+        with self.__lock:
+            ack = self.ack
+            while not self.empty and self.__first < ack:
+                self.__popfirst()
+                self.__trimmed += 1
+    
+    def __popfirst ( self ):
+        ''' Drops the oldest message. The caller must hold the lock. '''
+        index = self.__first % self.__maxlen
+        self.__nbytes -= len(self.__ring[index].body or b'')
+        self.__ring[index] = None
+        self.__first += 1
 
 class PersistentSequencedMsgSndQueue(SequencedMsgSndQueue):
     '''
@@ -308,29 +1160,231 @@ class PersistentSequencedMsgSndQueue(SequencedMsgSndQueue):
             return self.__shelf[key]
 
 
-class SequencedMsgRcvQueue(list):
+class SequencedMsgLog(object):
+    '''
+    A segmented, append-only write-ahead log of sequenced messages, used by loss-less
+    RMcastServer instances to keep the messages they send.
+    
+    Segments are files named <id>.<firstseq>.log, <firstseq> being the sequence number of
+    their first record, holding at most 'seglen' records each. Records are made of a RECORD
+    header (sequence number, flags, body length) followed by the body. Since records carry
+    consecutive sequence numbers, a sparse index holding the offset of every INDEXEVERY-th
+    record in a segment is enough to find any record reading a few others at most.
+    
+    append() writes a record but doesn't wait for it to reach the disk, commit() does.
+    Writers calling commit() while someone else is syncing the log wait for it to finish
+    then sync everything written meanwhile with a single fsync() (group commit).
+    
+    On start-up only the last segment is read, to find out the last sequence number and to
+    drop any record partially written when the process died; the indexes of the other
+    segments are built the first time they are searched.
+    '''
+    RECORD = Struct('!QQI')     # seq, flags, body length
+    INDEXEVERY = 64
+    SEGLEN = 10000
+    
+    def __init__ ( self, id_, seglen=None ):
+        '''
+        Constructor
+        @param id_: path prefix of the segment files
+        @param seglen: max number of records per segment, defaults to SEGLEN
+        '''
+        self.__id = id_
+        self.__seglen = seglen or SequencedMsgLog.SEGLEN
+        self.__lock = Lock()
+        self.__commitlock = Lock()
+        self.__written = 0          # sequence number of the last record written
+        self.__synced = 0           # sequence number of the last record synced to disk
+        self.__indexes = {}         # first sequence number in segment -> sparse index
+        self.__file = None
+        self.__count = 0            # number of records in the last segment
+        self.__offset = 0           # size of the last segment
+        
+        dirname, prefix = os.path.split(id_)
+        pattern = re.compile(re.escape(prefix) + r'\.(\d+)\.log$')
+        matches = map(pattern.match, os.listdir(dirname or os.curdir))
+        self.__segments = sorted(int(m.group(1)) for m in matches if m)
+        if self.__segments:
+            self.__recover()
+            
+    @property
+    def id ( self ): return self.__id
+    
+    @property
+    def seglen ( self ): return self.__seglen
+    
+    @property
+    def lastseq ( self ):
+        '''Sequence number of the last record in the log, 0 if empty'''
+        return self.__written
+    
+    @property
+    def segments ( self ):
+        '''Paths of the segment files, oldest first'''
+        return [self.__path(first) for first in self.__segments]
+    
+    def __path ( self, first ):
+        return "%s.%d.log" % (self.__id, first)
+    
+    def __scan ( self, data ):
+        '''Returns the sparse index, the number of records and the size of the complete records in data'''
+        record, every = SequencedMsgLog.RECORD, SequencedMsgLog.INDEXEVERY
+        index, count, offset, seq = [], 0, 0, None
+        while offset + record.size <= len(data):
+            rseq, _, length = record.unpack_from(data, offset)
+            if offset + record.size + length > len(data): break
+            if count % every == 0: index.append(offset)
+            seq, count, offset = rseq, count + 1, offset + record.size + length
+        return index, count, offset, seq
+    
+    def __recover ( self ):
+        first = self.__segments[-1]
+        path = self.__path(first)
+        with open(path, 'rb') as f:
+            data = f.read()
+        index, count, offset, seq = self.__scan(data)
+        if offset < len(data):
+            logger.warning("Dropping %d bytes of incomplete record at the end of %s", len(data) - offset, path)
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        self.__indexes[first] = index
+        self.__count, self.__offset = count, offset
+        self.__written = self.__synced = first - 1 if seq is None else seq
+        self.__file = open(path, 'ab')
+        
+    def __rotate ( self, first ):
+        if self.__file is not None:
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__file.close()
+            self.__synced = self.__written
+        self.__segments.append(first)
+        self.__indexes[first] = []
+        self.__count, self.__offset = 0, 0
+        self.__file = open(self.__path(first), 'ab')
+        
+    def rotate ( self ):
+        '''Starts a new segment, unless the last one is empty'''
+        with self.__lock:
+            if self.__count > 0:
+                self.__rotate(self.__written + 1)
+    
+    def append ( self, seq, body, flags=0 ):
+        '''
+        Writes a record for the message with sequence number 'seq', which must be the one
+        following the last record's. The record is not guaranteed to be on disk until commit()
+        is called.
+        '''
+        with self.__lock:
+            if self.__file is None or self.__count >= self.__seglen:
+                self.__rotate(seq)
+            if self.__count % SequencedMsgLog.INDEXEVERY == 0:
+                self.__indexes[self.__segments[-1]].append(self.__offset)
+            self.__file.write(SequencedMsgLog.RECORD.pack(seq, flags, len(body)))
+            self.__file.write(body)
+            self.__offset += SequencedMsgLog.RECORD.size + len(body)
+            self.__count += 1
+            self.__written = seq
+            
+    def commit ( self, seq=None ):
+        '''
+        Makes sure the record with sequence number 'seq', or all records if absent, are on disk.
+        '''
+        with self.__commitlock:
+            if seq is not None and self.__synced >= seq:
+                return  # the last writer to sync did it for us
+            with self.__lock:
+                if self.__file is None: return
+                target = self.__written
+                self.__file.flush()
+                # Sync a duplicate of the descriptor so that writers can go on meanwhile
+                fd = os.dup(self.__file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.__synced = max(self.__synced, target)
+    
+    def __getitem__ ( self, seq ):
+        '''
+        Returns the (flags, body) tuple recorded for the message with sequence number 'seq'.
+        Raises KeyError if there is no such record.
+        '''
+        with self.__lock:
+            if not self.__segments or not self.__segments[0] <= seq <= self.__written:
+                raise KeyError(seq)
+            first = self.__segments[bisect_right(self.__segments, seq) - 1]
+            if first == self.__segments[-1] and self.__file is not None:
+                self.__file.flush()
+            index = self.__indexes.get(first)
+        record = SequencedMsgLog.RECORD
+        with open(self.__path(first), 'rb') as f:
+            if index is None:
+                index = self.__indexes[first] = self.__scan(f.read())[0]
+            n, skip = divmod(seq - first, SequencedMsgLog.INDEXEVERY)
+            if n >= len(index):
+                raise KeyError(seq)
+            f.seek(index[n])
+            for _ in range(skip + 1):
+                header = f.read(record.size)
+                if len(header) < record.size: break
+                rseq, flags, length = record.unpack(header)
+                if rseq == seq:
+                    return flags, f.read(length)
+                f.seek(length, os.SEEK_CUR)
+        raise KeyError(seq)
+    
+    def close ( self ):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.flush()
+                os.fsync(self.__file.fileno())
+                self.__file.close()
+                self.__file = None
+                self.__synced = self.__written
+
+
+class SequencedMsgRcvQueue(object):
     '''
     A queue for reception of sequenced messages.
-    The queue sorts messages by sequence number (msg.seq) using the heap queue algorithm.
-    Messages can be appended to the queue's tail using push(), and removed from the
-    queue's head using pop().
+    The queue is a sliding window of slots indexed by sequence number (msg.seq), starting
+    at the sequence number of the next message expected, i.e. the queue's 'ack' property.
+    Messages can be stored into the queue using push(), which finds the message slot and
+    detects duplicated messages in constant time. Messages having a sequence number beyond
+    the end of the window, whose size is set by the constructor's 'maxwindow' argument,
+    are rejected.
     The head() method is a generator returning the longest sequence of messages with
-    consecutive sequence numbers at the queue's head.
-    The class provides support for reliable transmission protocols. The 'nakseen'
-    property can be used to record if a NAK for a message currently in the queue has
-    been spotted. The startTimer() and cancelTimer() methods can be used to schedule
+    consecutive sequence numbers at the queue's head, sliding the window accordingly.
+    The class provides support for reliable transmission protocols. The missing()
+    generator returns the sequence numbers of the messages missing in the window, and
+    spot() records those a NAK has been seen for, so that unspotted() returns only the
+    ones still needing a NAK. The 'nakseen' property tells if a NAK has been spotted
+    for every missing message. The startTimer() and cancelTimer() methods can be used to schedule
     queue management events, like e.g. sending of a NAK if a message is missing.
     The class itself is not thread-safe but provides a 'lock' property of type Lock
     to synchronize access to the queue.
     '''
-    def __init__ ( self, ack=1, epoch=0 ):
+    
+    # Outcomes of push()
+    ACCEPTED = 0
+    DUPLICATE = 1
+    OVERFLOW = 2
+    
+    MAXWINDOW = 1024
+    
+    def __init__ ( self, ack=1, epoch=0, maxwindow=None, scheduler=None ):
         '''
-        Constructor
+        Constructor. Timers run on 'scheduler', by default the module's TimerScheduler.
         '''
-        super(SequencedMsgRcvQueue, self).__init__()
+        self.__scheduler = scheduler
         self.__ack = ack
         self.__epoch = epoch
-        self.__nakseen = False
+        self.__maxwindow = maxwindow or SequencedMsgRcvQueue.MAXWINDOW
+        self.__window = [None] * self.__maxwindow
+        self.__count = 0
+        self.__last = ack - 1   # highest sequence number in the queue
+        self.__horizon = ack - 1    # highest sequence number seen, queued or dropped beyond the window
+        self.__spotted = set()  # missing sequence numbers someone else has NAK'd
         self.__nakt = None
         self.__lock = Lock()
 
@@ -338,7 +1392,7 @@ class SequencedMsgRcvQueue(list):
     def naktime ( self ): return uniform(0.5, 1.0)
 
     @property
-    def empty ( self ): return len(self) == 0
+    def empty ( self ): return self.__count == 0
     
     @property
     def ack ( self ): return self.__ack
@@ -346,25 +1400,112 @@ class SequencedMsgRcvQueue(list):
     @property
     def epoch ( self ): return self.__epoch
     
+    @property
+    def maxwindow ( self ): return self.__maxwindow
+    
+    @property
+    def overflowed ( self ):
+        '''Tells if messages beyond the last one queued were dropped and have not been delivered yet'''
+        return self.__horizon > self.__last and self.__horizon >= self.__ack
+    
+    @property
+    def first ( self ):
+        '''The lowest sequence number in the queue, None if the queue is empty'''
+        if self.__count:
+            window, maxwindow = self.__window, self.__maxwindow
+            for seq in range(self.__ack, self.__last + 1):
+                if window[seq % maxwindow] is not None:
+                    return seq
+        return None
+    
     def getNakSeen ( self ):
-        return self.__nakseen
+        return bool(self.__spotted) and next(self.unspotted(), None) is None
     def setNakSeen ( self, val ):
-        self.__nakseen = val
+        if val:
+            self.__spotted.update(self.missing())
+        else:
+            self.__spotted.clear()
     nakseen = property(getNakSeen, setNakSeen)
 
     @property
     def lock ( self ): return self.__lock
     
+    def __len__ ( self ):
+        return self.__count
+    
+    def accepts ( self, seq ):
+        '''
+        Tells what the outcome of pushing a message with sequence number 'seq' would be.
+        '''
+        offset = seq - self.__ack
+        if offset >= self.__maxwindow:
+            return SequencedMsgRcvQueue.OVERFLOW
+        if offset < 0 or self.__window[seq % self.__maxwindow] is not None:
+            return SequencedMsgRcvQueue.DUPLICATE
+        return SequencedMsgRcvQueue.ACCEPTED
+    
     def push ( self, msg ):
-        heappush(self, msg)
+        '''
+        Stores the message in the queue. Returns ACCEPTED if the message was stored, DUPLICATE if
+        the message was already queued or delivered, and OVERFLOW if it is beyond the window end;
+        in the latter case the messages up to the window end are reported as missing from then on.
+        '''
+        result = self.accepts(msg.seq)
+        if result == SequencedMsgRcvQueue.ACCEPTED:
+            self.__window[msg.seq % self.__maxwindow] = msg
+            self.__count += 1
+            if msg.seq > self.__last:
+                self.__last = msg.seq
+        if result != SequencedMsgRcvQueue.DUPLICATE and msg.seq > self.__horizon:
+            self.__horizon = msg.seq
+        return result
         
     def pop ( self ):
-        return heappop(self)
+        '''
+        Removes and returns the message with the lowest sequence number in the queue.
+        Raises IndexError if the queue is empty.
+        '''
+        seq = self.first
+        if seq is None:
+            raise IndexError("pop from empty queue")
+        index = seq % self.__maxwindow
+        msg, self.__window[index] = self.__window[index], None
+        self.__count -= 1
+        return msg
+    
+    def __end ( self ):
+        '''The highest sequence number a missing message in the window can have'''
+        return min(self.__horizon, self.__ack + self.__maxwindow - 1)
+    
+    def missing ( self ):
+        '''Generates the sequence numbers of the messages missing in the window'''
+        window, maxwindow = self.__window, self.__maxwindow
+        for seq in range(self.__ack, self.__end() + 1):
+            if window[seq % maxwindow] is None:
+                yield seq
+    
+    def unspotted ( self ):
+        '''Generates the sequence numbers of the missing messages no NAK has been spotted for'''
+        spotted = self.__spotted
+        return (seq for seq in self.missing() if seq not in spotted)
+    
+    def spot ( self, seqs ):
+        '''
+        Records a NAK has been spotted for the messages in 'seqs'; those not missing are ignored.
+        Returns True if a NAK for any missing message was recorded.
+        '''
+        window, maxwindow, end = self.__window, self.__maxwindow, self.__end()
+        spotted = [seq for seq in seqs if self.__ack <= seq <= end and window[seq % maxwindow] is None]
+        self.__spotted.update(spotted)
+        return len(spotted) > 0
+    
+    def isspotted ( self, seq ):
+        '''Tells if a NAK has been spotted for the missing message with sequence number 'seq' '''
+        return seq in self.__spotted
     
     def startTimer ( self, func, args ):
         if self.__nakt is None:
-            self.__nakt = Timer(self.naktime, func, args=args)
-            self.__nakt.start()
+            self.__nakt = (self.__scheduler or scheduler).schedule(self.naktime, func, args)
         
     def cancelTimer ( self ):
         if self.__nakt:
@@ -372,11 +1513,16 @@ class SequencedMsgRcvQueue(list):
             self.__nakt = None
           
     def head ( self ):
-        while not self.empty and self[0].seq == self.__ack:
-            msg = self.pop()
-            self.__ack +=1
+        window, maxwindow = self.__window, self.__maxwindow
+        while self.__count:
+            index = self.__ack % maxwindow
+            msg = window[index]
+            if msg is None: break
+            window[index] = None
+            self.__count -= 1
+            self.__ack += 1
+            self.__spotted.discard(msg.seq)
             yield msg
-            self.__nakseen = False
 
 
 class RMcastServer(McastServer):
@@ -390,7 +1536,8 @@ class RMcastServer(McastServer):
     The server holds a sending queue, where it stores all the messages it has sent
     just in case some peer asks for a retransmission. Latest messages sent are held
     in RAM, whereas older messages are stored in disk. For the time being messages
-    are never deleted from the disk once stored. 
+    are never deleted from the disk once stored. The number of messages held in RAM
+    is limited by actual argument 'sndqlen' (see SequencedMsgSndQueue).
      
     The server also holds one queue for every sender (i.e. source IP address) it sees.
     For every queue, the server holds the sequence number of the last message
@@ -548,56 +1695,276 @@ class RMcastServer(McastServer):
     a while, otherwise a receiver missing a message shall either abort once the max
     number of NAKs has been reached, or block holding a number of messages in its receive
     queue for the dead sender forever.
+    
+    Loss-less servers keep every message they send in a SequencedMsgLog whose segment files
+    hold 'filesize' messages each, and the last sequence number delivered from each sender in
+    a separate shelf. Messages are sent once they are on disk; messages sent concurrently
+    by several threads get on disk with a single sync, and are put on the wire in the order
+    of their sequence numbers all the same. A server finding neither the log nor the acks
+    shelf but a shelf named after 'station_id', as kept by previous versions (bodies keyed
+    by sequence number, acks keyed by sender), imports its contents on start-up.
+    
+    By default, datagrams are received into a pool of pre-allocated buffers and message
+    bodies are handled as memoryviews over those buffers, being copied only when the
+    server needs to keep them (i.e. when a message is queued for delivery). Hence no
+    body is copied for duplicated messages or NAKs. Sub-classes overloading receive()
+    and expecting bytes bodies can set actual argument 'zerocopy' to 'False' when
+    instantiating the server.
+    
+    A receiver missing several messages asks for all of them with a single NAK carrying
+    a bitmap of the missing sequence numbers (flag NAK_RANGES set in the 'epoch' field),
+    which the sender answers with a single batch of re-transmissions. Receivers spotting
+    a NAK from someone else refrain from NAK'ing the same messages themselves.
+    
+    Small messages can be coalesced by setting actual argument 'batchbytes' to the max number
+    of bytes (e.g. the path MTU minus headers) a message body can carry. Payloads sent to the
+    group are then held until they fill that budget or 'batchdelay' microseconds elapse since
+    the first one, then sent as a single message (flag FRAME_BATCH set in the 'epoch' field)
+    whose body is the sequence of payloads, each prefixed by its length. In loss-less mode the
+    whole batch takes a single record in the log. Receivers unpack the payloads and hand them
+    over to the handler one at a time, in order. Call flush() to send held payloads right away.
+    
+    Messages are handed over to the handler from the thread serving the socket, hence a
+    slow handler delays delivery of the messages from every sender. Setting actual argument
+    'delivery_workers' to a number of threads makes the server deliver messages from a pool
+    of that many threads instead, keeping the order of the messages from each sender but
+    delivering messages from different senders in parallel. NAKs and acks are still handled
+    by the thread serving the socket so re-transmissions are never delayed by handlers.
+    
+    Payloads larger than 'mtu' bytes are sent as a series of fragments (flag FRAME_FRAGMENT
+    set in the 'epoch' field), each one a message of its own carrying a FRAGMENT header, so
+    that losing a fragment costs just the re-transmission of that fragment. Receivers
+    reassemble the payload before handing it over to the handler. All the fragments of a
+    payload have to fit both in the send queue, to be re-transmitted, and in the receivers'
+    reorder window, so a payload can't be split into more than min('sndqlen', 'rcvwindow')
+    fragments; 'maxmsgsize' defaults to the largest payload that many fragments can carry.
+    Payloads larger than 'maxmsgsize' bytes, or needing more fragments, are rejected by
+    send() with ValueError.
+    
+    Messages received out of order are held in a per-sender reorder window until the
+    missing ones arrive. The window holds at most 'rcvwindow' messages (by default
+    SequencedMsgRcvQueue.MAXWINDOW); messages beyond its end are dropped and recovered
+    through the NAK mechanism once the window slides.
+    
+    The piggy-backed acks tell the sender how far the slowest of the peers sending to the
+    group is. Setting actual argument 'sndwindow' to a number of messages enables flow
+    control: every datagram sent to the group (whole message, batch or fragment) waits while
+    the messages sent and not yet acknowledged by that peer fill the window, and send()
+    raises TimeoutError if room is not made within 'sndtimeout' seconds (SNDTIMEOUT by
+    default); the message is queued already by then, so peers still get it when they NAK
+    it. The window shrinks by half whenever a peer NAKs one of
+    our messages or re-acks an old one three times, then grows back by one message per
+    window's worth of messages acknowledged, never beyond 'sndwindow'. Peers never sending
+    are unknown to the sender and do not slow it down, nor does anyone until the first ack
+    is received, and peers declared dead by forgetpeer() or given up on after 'max_nak_retries'
+    NAKs stop slowing it down. Answers returned by the handler, and batches of coalesced
+    payloads sent when 'batchdelay' expires, are sent regardless of the window, since
+    blocking the thread that delivers messages could prevent acks from being received,
+    and blocking the scheduler's thread would delay every timer.
+    The current window and the rate at which the slowest peer acknowledges our messages
+    are available in the 'sndwindow' and 'sndrate' properties.
+    
+    Timers (NAK time-outs and coalescing delays) run on the module's TimerScheduler unless
+    actual argument 'scheduler' is present. Servers served by an asyncio event loop (see
+    DgramBatchMixIn.serve_on()) should get an AsyncioScheduler for the same loop, so that
+    everything runs in the loop's thread.
+    
+    Setting actual argument 'fec' to a number of messages k enables forward error correction:
+    every k messages sent to the group (those with sequence numbers n*k+1 to n*k+k) are
+    followed by a parity datagram (flag FEC_PARITY set in the 'epoch' field) carrying the
+    XOR of their flags, lengths and bodies. A receiver having got all the messages in the
+    block but one rebuilds the missing one from the parity right away, rather than NAK'ing
+    it; losses of two or more messages in the same block are still recovered through NAKs.
+    Receivers need no configuration, they start rebuilding messages from a sender as soon
+    as they see its first parity datagram. The number of messages rebuilt from parities and
+    of missing messages received after being NAK'd are available in the 'fecrecovered'
+    and 'nakrecovered' properties.
     '''
     
     #Constants
     SND_EXCEPTION = 0
     RCV_EXCEPTION = 1
     
+    class FECBlock(object):
+        '''The XOR of the flags and lengths, and of the bodies, of the messages received in a FEC block'''
+        __slots__ = ('hdr', 'body', 'seqs', 'parity')
+        
+        def __init__ ( self ):
+            self.hdr = 0
+            self.body = 0
+            self.seqs = set()
+            self.parity = None      # (hdr, body) carried by the block's parity datagram
+    
+    class DeliveryChain(object):
+        '''Messages from a sender waiting for a delivery worker, and whether one is serving them'''
+        __slots__ = ('msgs', 'busy')
+        
+        def __init__ ( self ):
+            self.msgs = []
+            self.busy = False
+    
+    # Flags carried in the top bits of the 'epoch' field
+    FLAGS = 0xFF << 56
+    NAK_RANGES = 1 << 63    # NAK whose body is a bitmap of missing messages
+    FRAME_BATCH = 1 << 62   # message whose body is a sequence of RECORD-prefixed payloads
+    FRAME_FRAGMENT = 1 << 61# message whose body is a FRAGMENT header plus a piece of a payload
+    FEC_PARITY = 1 << 60    # datagram whose body is a PARITY header plus the XOR of a block of message bodies
+    
+    RECORD = Struct('!I')   # length of a payload in a batch
+    FRAGMENT = Struct('!IHH')   # message id (seq of first fragment), fragment index, fragment count
+    PARITY = Struct('!HQ')  # messages in the block, XOR of their flags (low byte) and lengths
+    
+    MTU = 1400              # default max body size of a datagram
+    
+    MAXNAKSPAN = 8192       # max number of messages a single NAK can ask for
+    
+    RATEGAIN = 0.125        # weight of the latest sample in the ack rate moving average
+    SNDTIMEOUT = 10         # default max seconds a datagram waits for room in the send window
+    
     @staticmethod
     def ntoi ( addr ):
         ''' Converts a packed 32-bits IPv4 address into an integer number '''
-        return reduce(add, map(lambda a,b: a*(1 << 8*b), addr, range(3, -1, -1)))
+        return int.from_bytes(addr, 'big')
 
     @staticmethod
     def iton ( baddr ):
         ''' Converts an integer number into a packed 32-bits IPv4 address '''
-        return bytes([(baddr >> 8*n) & 0xFF for n in range(4)])
+        return baddr.to_bytes(4, 'big')
+    
+    @staticmethod
+    def unframe ( msg ):
+        ''' Returns the list of payloads carried by message 'msg' '''
+        if not msg.epoch & RMcastServer.FRAME_BATCH:
+            return [msg.body]
+        body, record, offset, payloads = msg.body, RMcastServer.RECORD, 0, []
+        while offset < len(body):
+            size, = record.unpack_from(body, offset)
+            offset += record.size
+            payloads.append(body[offset:offset+size])
+            offset += size
+        return payloads
+    
+    @staticmethod
+    def nakmap ( ack, seqs ):
+        '''
+        Encodes the sequence numbers of missing messages 'seqs', all of them >= ack, as a
+        bitmap whose bit n is set if message ack+n is missing. Sequence numbers beyond
+        ack + MAXNAKSPAN are left out.
+        '''
+        bitmap = 0
+        for seq in seqs:
+            if seq - ack >= RMcastServer.MAXNAKSPAN: break
+            bitmap |= 1 << (seq - ack)
+        return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+        
+    @staticmethod
+    def nakseqs ( ack, bitmap ):
+        ''' Decodes a bitmap encoded by nakmap() into a list of sequence numbers '''
+        bitmap = int.from_bytes(bitmap, 'little')
+        return [ack + n for n in range(bitmap.bit_length()) if bitmap >> n & 1]
     
     # Properties    
     id = property(lambda s: s.__id)
     epoch = property(lambda s: s.__epoch)
     ack = property(lambda s: s.__ack)
     nakretries = property(lambda s: s.__nakretries)
-    lossless = property(lambda s: s.__shelf is not None)
+    lossless = property(lambda s: s.__log is not None)
+    log = property(lambda s: s.__log)
+    zerocopy = property(lambda s: s.__zerocopy)
+    batchbytes = property(lambda s: s.__batchbytes)
+    batchdelay = property(lambda s: s.__batchdelay)
+    mtu = property(lambda s: s.__mtu)
+    maxmsgsize = property(lambda s: s.__maxmsgsize)
+    sndq = property(lambda s: s.__sndq)
+    sndtimeout = property(lambda s: s.__sndtimeout)
+    fec = property(lambda s: s.__feck)
+    scheduler = property(lambda s: s.__scheduler or scheduler)
+    fecrecovered = property(lambda s: s.__fecrecovered)
+    nakrecovered = property(lambda s: s.__nakrecovered)
+    
+    @property
+    def sndwindow ( self ):
+        '''The number of messages that can be sent ahead of the slowest peer's ack, None if unlimited'''
+        return None if self.__maxwindow is None else int(self.__window)
+    
+    @property
+    def sndrate ( self ):
+        '''The number of messages per second the slowest peer is acknowledging (moving average)'''
+        return self.__sndrate
+    
+    @property
+    def inflight ( self ):
+        '''The number of messages sent and not yet acknowledged by the slowest peer'''
+        return self.__sndq.seq - self.__sndack + 1 if self.__sndack else 0
     
-    def __init__ ( self, mcast_hostport, hostport, handler, ttl=32, station_id=None, max_nak_retries=3, lossless=False, filesize=10000 ):
+    def __init__ ( self, mcast_hostport, hostport, handler, ttl=32, station_id=None, max_nak_retries=3, lossless=False, filesize=10000,
+                   zerocopy=True, sndqlen=None, rcvwindow=None, batchbytes=0, batchdelay=1000, delivery_workers=None,
+                   mtu=MTU, maxmsgsize=None, sndwindow=None, sndtimeout=SNDTIMEOUT, fec=0, scheduler=None ):
         '''
         Constructor.
         '''
         super(RMcastServer, self).__init__(mcast_hostport, hostport, SequencedDgramMsgHandler, ttl)
+        self.__zerocopy = zerocopy
+        self.__scheduler = scheduler
+        self.__batchbytes = batchbytes
+        self.__batchdelay = batchdelay
+        self.__pending = []
+        self.__pendingbytes = 0
+        self.__flusht = None
+        self.__sndlock = Lock()
+        self.__mtu = mtu
+        self.__maxfragments = min(sndqlen or SequencedMsgSndQueue.MAXLEN,
+                                  rcvwindow or SequencedMsgRcvQueue.MAXWINDOW, 0xFFFF)
+        self.__maxmsgsize = maxmsgsize or self.__maxfragments * (mtu - RMcastServer.FRAGMENT.size)
+        self.__fragments = {}       # sender address -> (message id, fragments received so far)
+        self.__maxwindow = sndwindow
+        self.__window = float(sndwindow or 0)
+        self.__sndtimeout = sndtimeout
+        self.__windowcond = Condition()
+        self.__sndack = 0           # the send queue's ack, as seen by the thread receiving it
+        self.__sndackt = monotonic()
+        self.__sndrate = 0.0
+        self.__recover = 0          # the window isn't shrunk again until this message is acked
+        self.__feck = fec
+        self.__fecblock = None      # [first seq, hdr, body] of the block being sent
+        self.__parities = []        # parity datagrams waiting for their block to be sent
+        self.__fec = {}             # sender address -> (messages per block, first seq -> FECBlock)
+        self.__fecrecovered = 0
+        self.__nakrecovered = 0
         self.__id = station_id or (str(mcast_hostport) + '@' + str(hostport))
         self.__rcvq = {}
+        self.__rcvwindow = rcvwindow
+        self.__executor = ThreadPoolExecutor(delivery_workers) if delivery_workers else None
+        self.__chains = {}
+        self.__chainslock = Lock()
+        self.__baddr = RMcastServer.ntoi(socket.inet_aton(self.server_address[0]))
+        self.__baddrs = {}          # peer address -> integer form
+        self.__addrs = {}           # integer form -> peer address
+        self.__rcvshelflock = Lock()
         self.__ack = 0
         self.__handler = handler
         self.__nakretries = max_nak_retries
         self.__epoch = int(clock())
-        self.__shelf = None
+        self.__log = None
         lastseq = 0
         if lossless:
             # Loss-less servers don't use epochs, they don't need to detect sender crashes 
             self.__epoch = 0
             
-            self.__shelf = shelve.open(self.__id)
+            self.__log = SequencedMsgLog(self.__id, filesize)
+            legacy = not self.__log.segments and not dbm.whichdb(self.__id + '.acks') and dbm.whichdb(self.__id)
             
-            self.__rcvshelf = self.__shelf
-            if self.__rcvshelf is not False:
-                for (from_addr, ack) in self.__rcvshelf.items():
-                    self.__rcvq[from_addr] = SequencedMsgRcvQueue(ack, self.__epoch)
+            self.__rcvshelf = shelve.open(self.__id + '.acks')
+            if legacy:
+                self.__migrate()
+            for (from_addr, ack) in self.__rcvshelf.items():
+                self.__rcvq[from_addr] = SequencedMsgRcvQueue(ack, self.__epoch, rcvwindow, scheduler)
                     
-            lastseq = int(max(self.__shelf or [0]))
+            lastseq = self.__log.lastseq
                                 
-        self.__sndq = SequencedMsgSndQueue(lastseq)                
+        self.__sndq = SequencedMsgSndQueue(lastseq, sndqlen)
+        self.__xmitcond = Condition()
+        self.__sentseq = lastseq    # sequence number of the last message put on the wire
             
         # We never know if the last message recorded was actually sent - the process might have
         # crashed after recording it but right before sending it. Hence, just in case we send it
@@ -605,6 +1972,33 @@ class RMcastServer(McastServer):
         if lastseq > 0:
             self.resend(lastseq)
             
+    def __migrate ( self ):
+        '''
+        Imports the shelf kept by previous versions of loss-less servers, holding both the
+        bodies of the messages sent (keyed by sequence number, with their flags if any) and
+        the acks of the senders, into the log and the acks shelf.
+        '''
+        with shelve.open(self.__id, 'r') as shelf:
+            seqs, acks = set(), {}
+            for key, value in shelf.items():
+                if key.isdigit():
+                    seqs.add(int(key))
+                elif isinstance(value, int):
+                    acks[key] = value
+            # The log holds consecutive sequence numbers only, import the last run of them
+            first = last = max(seqs or [0])
+            while first - 1 in seqs:
+                first -= 1
+            for seq in range(first, last + 1) if last else ():
+                data, flags = shelf[str(seq)], 0
+                if type(data) is tuple:
+                    flags, data = data
+                self.__log.append(seq, data, flags)
+        self.__log.commit()
+        self.__rcvshelf.update(acks)
+        self.__rcvshelf.sync()
+        logger.info("Imported messages %d to %d and %d acks from legacy shelf %s", first, last, len(acks), self.__id)
+    
     def rcvq ( self, from_addr, msg=None ):
         '''
         Returns the receive queue that corresponds to the sender identified by its address,
@@ -619,7 +2013,7 @@ class RMcastServer(McastServer):
             rcvq = self.__rcvq[from_addr]
         except KeyError as e:
             if msg is None: raise e
-            rcvq = SequencedMsgRcvQueue(msg.seq, msg.epoch)
+            rcvq = SequencedMsgRcvQueue(msg.seq, msg.epoch & ~RMcastServer.FLAGS, self.__rcvwindow, self.__scheduler)
             self.__rcvq[from_addr] = rcvq
         return rcvq
     
@@ -628,163 +2022,766 @@ class RMcastServer(McastServer):
         
         # Check for OOB message
         if msg.seq == 0:
-            r = self.__handler.handleOOB(msg.body, from_addr)
+            r = self.__handler.handleOOB(bytes(msg.body), from_addr)
             if r is not None:
                 super(RMcastServer, self).send(r, from_addr)
             return
         
         baddr, ack = msg.ack & 0xFFFFFFFF, msg.ack >> 32
-        self_baddr = RMcastServer.ntoi(socket.inet_aton(self.server_address[0]))
-        from_baddr = RMcastServer.ntoi(socket.inet_aton(from_addr))
+        flags = msg.epoch & RMcastServer.FLAGS
+        epoch = msg.epoch ^ flags
+        self_baddr = self.__baddr
+        from_baddr = self.__baddrs.get(from_addr) or self.addpeer(from_addr)
         
-        if len(msg.body) > 0:
+        if flags & RMcastServer.FEC_PARITY:
+            self.__repair(msg, epoch, from_addr, from_baddr)
+        elif len(msg.body) > 0 and not flags & RMcastServer.NAK_RANGES:
             rcvq = self.rcvq(from_addr, msg)        
+            deliverable = []
             rcvq.lock.acquire()
             try:            
                 # Handle the incoming message; first, check if sender has restarted
                 # (notice when servers are loss-less epochs are always 0 so the code
                 # below should never be entered in that case) 
-                if msg.epoch > rcvq.epoch:
+                if epoch > rcvq.epoch:
                     # The sender is loss-full and has re-started; drop whatever
                     # we may have in the receive queue and notify the upper layer
                     if not rcvq.empty:
                         self.__handler.handleException(RMcastServer.RCV_EXCEPTION, baddr)
                     del self.__rcvq[from_addr]
+                    self.__fragments.pop(from_addr, None)
+                    self.__fec.pop(from_addr, None)
                     if self.lossless:
-                        del self.__rcvshelf[from_addr]
+                        with self.__rcvshelflock:
+                            del self.__rcvshelf[from_addr]
                     return self.receive(msg, from_addr)
                 
-                if msg.seq < rcvq.ack: return # duplicated message
-
-                rcvq.push(msg)
-                for m in rcvq.head():
-                    # Handle the top message in the receive queue
-                    r = self.__handler.handle(m.body, from_addr)
-                    
-                    # We need to update the last message handled with every handling,
-                    # since in case of failure in the middle of this loop we need to
-                    # know which was the last one processed
-                    if self.lossless:
-                        self.__rcvshelf[from_addr] = rcvq.ack
-                    self.__ack = (rcvq.ack << 32) + from_baddr
-                        
-                    # If there was an answer send it back
-                    if r is not None:
-                        self.send(r)
+                status = rcvq.accepts(msg.seq)
+                if status == SequencedMsgRcvQueue.DUPLICATE: return # duplicated message
+                if status == SequencedMsgRcvQueue.OVERFLOW:
+                    # Too far ahead of what we've delivered so far; drop it, but have the queue
+                    # remember it so that the whole window gets NAK'd below, and the rest once
+                    # the window slides
+                    rcvq.push(msg)
+                    logger.warning("Message %d from %s beyond receive window (ack=%d), dropped", msg.seq, from_addr, rcvq.ack)
+                else:
+                    # The body may be a view over a receive buffer, we need our own copy
+                    if type(msg.body) is memoryview:
+                        msg = msg._replace(body=bytes(msg.body))
+                    if rcvq.isspotted(msg.seq):
+                        self.__nakrecovered += 1
+                    rcvq.push(msg)
+                    fec = self.__fec.get(from_addr)
+                    if fec is not None:
+                        self.__fold(fec, msg, rcvq)
+                    deliverable = list(rcvq.head())
+                    if deliverable:
+                        self.__ack = (rcvq.ack << 32) + from_baddr
             finally:
                 rcvq.lock.release()
                 
-            self.checkmissing(rcvq, baddr)
+            self.checkmissing(rcvq, from_baddr)
             
             # Handle the ack only if it refers to a message sent by us
             if baddr == self_baddr:
-                self.__sndq.updateack(ack)
+                self.__sndq.updateack(ack, from_addr)
+                self.__acked(self.__sndq.ack)
                 if self.__sndq.ackcount >= 3:
                     self.resend(ack)        # re-transmit if we've seen 3 times the same old ack
+                    self.__congested()
                 if self.lossless:
-                    self.__sndq.tail()      # purge send queue only if loss-less (we've got the shelf back-up)
+                    self.__sndq.tail()      # purge send queue only if loss-less (we've got the log back-up)
+                    
+            # Finally hand the messages now in sequence over to the handler
+            if deliverable:
+                self.__dispatch(deliverable, from_addr)
         else:
             # Handle the NAK
-            if baddr == self_baddr:         # if it is for a message sent by us ...
-                self.resend(ack)            # ... re-transmit immediately
+            seqs = RMcastServer.nakseqs(ack, msg.body) if flags & RMcastServer.NAK_RANGES else [ack]
+            if baddr == self_baddr:         # if it is for messages sent by us ...
+                self.resendmany(seqs)       # ... re-transmit immediately
+                self.__congested()
             else:                           # otherwise ...
-                self.spottednak(baddr, ack) # ... record if we saw a NAK for someone else
+                self.spottednak(baddr, seqs)# ... record if we saw a NAK for someone else
+            
+    def __dispatch ( self, msgs, from_addr ):
+        if self.__executor is None:
+            self.deliver(msgs, from_addr)
+        else:
+            self.__enqueue(msgs, from_addr)
+    
+    def __repair ( self, parity, epoch, from_addr, from_baddr ):
+        '''
+        Records the parity datagram 'parity' sent by 'from_addr' and, if just one message in
+        its block is missing, rebuilds and delivers the missing message.
+        '''
+        rcvq = self.__rcvq.get(from_addr)
+        if rcvq is None: return     # we'll sync to the sender on its next message
+        k, hdr = RMcastServer.PARITY.unpack_from(parity.body)
+        deliverable = []
+        with rcvq.lock:
+            if epoch != rcvq.epoch: return
+            fec = self.__fec.get(from_addr)
+            if fec is None or fec[0] != k:
+                fec = self.__fec[from_addr] = (k, {})
+            blocks = fec[1]
+            for first in [first for first in blocks if first + k <= rcvq.ack]:
+                del blocks[first]   # blocks delivered in full, through NAKs or otherwise
+            if parity.seq + k <= rcvq.ack: return
+            block = blocks.get(parity.seq)
+            if block is None:
+                block = blocks[parity.seq] = RMcastServer.FECBlock()
+            block.parity = (hdr, int.from_bytes(parity.body[RMcastServer.PARITY.size:], 'little'))
+            if self.__rebuild(fec, parity.seq, rcvq):
+                deliverable = list(rcvq.head())
+                if deliverable:
+                    self.__ack = (rcvq.ack << 32) + from_baddr
+        if deliverable:
+            self.checkmissing(rcvq, from_baddr)
+            self.__dispatch(deliverable, from_addr)
+    
+    def __fold ( self, fec, msg, rcvq ):
+        '''
+        Adds message 'msg', just pushed into 'rcvq', to its FEC block, rebuilding the block's
+        missing message if possible. The caller must hold the queue's lock.
+        '''
+        k, blocks = fec
+        first = msg.seq - (msg.seq - 1) % k
+        block = blocks.get(first)
+        if block is None:
+            block = blocks[first] = RMcastServer.FECBlock()
+        block.hdr ^= (msg.epoch >> 56) | len(msg.body) << 8
+        block.body ^= int.from_bytes(msg.body, 'little')
+        block.seqs.add(msg.seq)
+        if len(block.seqs) == k:
+            del blocks[first]
+        else:
+            self.__rebuild(fec, first, rcvq)
+    
+    def __rebuild ( self, fec, first, rcvq ):
+        '''
+        Rebuilds the message missing in the FEC block starting at 'first' and pushes it into
+        'rcvq', if the block's parity is known and no other message is missing. Returns True
+        if a message was rebuilt. The caller must hold the queue's lock.
+        '''
+        k, blocks = fec
+        block = blocks[first]
+        if block.parity is None or len(block.seqs) != k - 1: return False
+        seq = next(seq for seq in range(first, first + k) if seq not in block.seqs)
+        del blocks[first]
+        # Messages received before we started keeping track of the block aren't in it
+        if rcvq.accepts(seq) != SequencedMsgRcvQueue.ACCEPTED: return False
+        hdr = block.hdr ^ block.parity[0]
+        body = (block.body ^ block.parity[1]).to_bytes(hdr >> 8, 'little')
+        rcvq.push(SequencedMessage(seq = seq, epoch = rcvq.epoch | (hdr & 0xFF) << 56, ack = 0, body=body))
+        self.__fecrecovered += 1
+        return True
+    
+    def deliver ( self, msgs, from_addr ):
+        '''
+        Hands the payloads in 'msgs', messages from 'from_addr' in sequence, over to the handler
+        and sends back its answers.
+        '''
+        for m in msgs:
+            if m.epoch & RMcastServer.FRAME_FRAGMENT:
+                payload = self.__reassemble(m, from_addr)
+                if payload is None: continue
+                payloads = [payload]
+            else:
+                payloads = RMcastServer.unframe(m)
+            rs = [self.__handler.handle(body, from_addr) for body in payloads]
             
+            # We need to update the last message handled with every handling,
+            # since in case of failure in the middle of this loop we need to
+            # know which was the last one processed (for fragmented payloads,
+            # the last one whose fragments were all handled)
+            if self.lossless:
+                with self.__rcvshelflock:
+                    self.__rcvshelf[from_addr] = m.seq + 1
+                    
+            # If there were answers send them back
+            for r in rs:
+                if r is not None:
+                    self.__sendgroup(r)
+                    
+    def __reassemble ( self, msg, from_addr ):
+        '''
+        Adds fragment 'msg' to the payload being reassembled for sender 'from_addr'.
+        Returns the payload if 'msg' is its last fragment, None otherwise.
+        '''
+        msgid, index, count = RMcastServer.FRAGMENT.unpack_from(msg.body)
+        fragment = memoryview(msg.body)[RMcastServer.FRAGMENT.size:]
+        if index == 0:
+            entry = self.__fragments[from_addr] = (msgid, [])
+        else:
+            entry = self.__fragments.get(from_addr)
+            if entry is None or entry[0] != msgid or len(entry[1]) != index:
+                # Fragments are delivered in sequence so this should only happen if the
+                # sender restarted in the middle of a payload
+                logger.warning("Dropping fragment %d/%d of message %d from %s, previous fragments missing",
+                               index+1, count, msgid, from_addr)
+                return None
+        entry[1].append(fragment)
+        if index + 1 < count:
+            return None
+        del self.__fragments[from_addr]
+        return b''.join(entry[1])
+    
+    def __enqueue ( self, msgs, from_addr ):
+        '''
+        Appends 'msgs' to the delivery chain of sender 'from_addr', and has the chain served
+        by the delivery pool unless some worker is already serving it.
+        '''
+        with self.__chainslock:
+            chain = self.__chains.get(from_addr)
+            if chain is None:
+                chain = self.__chains[from_addr] = RMcastServer.DeliveryChain()
+            chain.msgs.extend(msgs)
+            if chain.busy: return
+            chain.busy = True
+        self.__executor.submit(self.__drain, chain, from_addr)
+    
+    def __drain ( self, chain, from_addr ):
+        while True:
+            with self.__chainslock:
+                if not chain.msgs:
+                    chain.busy = False
+                    return
+                msgs, chain.msgs = chain.msgs, []
+            try:
+                self.deliver(msgs, from_addr)
+            except Exception:
+                logger.exception("Error delivering messages from %s", from_addr)
+    
     def checkmissing ( self, rcvq, baddr, tries=0 ):
         with rcvq.lock:
-            if not rcvq.empty:
+            if not rcvq.empty or rcvq.overflowed:
                 # Not all messages could be delivered, see how bad it is
-                if len(rcvq) >= 3:
-                    # If 3+ messages queued cancel timer (this combined with the call to startTimer()
-                    # below has the effect of resetting the timer) and send NAK for the first missing message
+                if len(rcvq) >= 3 or rcvq.overflowed:
+                    # If 3+ messages queued, or some dropped beyond the window end, cancel timer (this
+                    # combined with the call to startTimer() below has the effect of resetting the timer)
+                    # and send a single NAK for all the missing messages nobody has NAK'd yet, up to the
+                    # window end; on time-out NAK them all again
                     rcvq.cancelTimer()
-                    if not rcvq.nakseen:
-                        self.sendnak(baddr, rcvq.ack)
+                    if tries > 0:
+                        rcvq.nakseen = False
+                    missing = list(rcvq.unspotted())
+                    if missing:
+                        self.sendnak(baddr, missing[0], missing)
+                        rcvq.spot(missing)
                 
                 if tries < self.__nakretries:
                     # Schedule a time-out, just in case we don't receive from this peer in a while
                     rcvq.startTimer(RMcastServer.checkmissing, (self, rcvq, baddr, tries+1))
                 else:
-                    # max time-outs in a row so we give up - notify upper layer
+                    # max time-outs in a row so we give up - notify upper layer, and don't let
+                    # the peer hold our send window back should it be gone
                     self.__handler.handleException(RMcastServer.RCV_EXCEPTION, baddr)
+                    self.forgetpeer(self.__addrs[baddr])
         
-    def spottednak ( self, baddr, ack ):
-        addr = socket.inet_ntoa(RMcastServer.iton(baddr))
+    def addpeer ( self, addr ):
+        '''
+        Records the integer form of the address of a peer we've just heard from for the first
+        time, so that neither has to be converted into the other again. Returns the integer.
+        '''
+        baddr = RMcastServer.ntoi(socket.inet_aton(addr))
+        self.__addrs[baddr] = addr
+        self.__baddrs[addr] = baddr
+        return baddr
+    
+    def spottednak ( self, baddr, seqs ):
         try:
-            rcvq = self.__rcvq[addr]
-            if ack >= rcvq.ack and ack < rcvq[0].seq:
-                # NAK is for a message we're missing so we can stop asking (the other guy will do it)
-                rcvq.cancelTimer()
-                rcvq.nakseen = True
+            rcvq = self.__rcvq[self.__addrs[baddr]]
+            with rcvq.lock:
+                if rcvq.spot(seqs) and rcvq.nakseen:
+                    # NAKs cover all the messages we're missing so we can stop asking (the other guys will do it)
+                    rcvq.cancelTimer()
         except KeyError:
             # We've seen a NAK for a message from someone we don't know; since we'll see the retransmission
             # too we have nothing to worry about
             pass
-        except IndexError:
-            # The receive queue for that sender is empty so we're not missing any message from it
-            pass
         
     def send ( self, data, dst = None ):
         if (dst is None) or (dst == self.grpaddr):
-            msg = SequencedMessage(seq = self.__sndq.seq+1, epoch = self.__epoch, ack = self.__ack, body=data)
-            if self.lossless:
-                self.__shelf[str(msg.seq)] = msg.body
-                self.__shelf.sync()
-            self.__sndq.push(msg)
+            return self.__sendgroup(data, True)
         else:
             msg = SequencedMessage(seq = 0, epoch = self.__epoch, ack = self.__ack, body=data)
         return super(RMcastServer, self).send(self.encode(msg))
+    
+    def __sendgroup ( self, data, paced=False ):
+        if len(data) > self.__mtu:
+            return self.__fragment(data, paced)
+        if self.__batchbytes:
+            return self.__coalesce(data, paced)
+        with self.__sndlock:
+            msg = self.__sequence(data)
+        return self.__transmit([msg], paced)
+    
+    def __pace ( self, seq ):
+        '''
+        Waits until the send window has room for the message with sequence number 'seq',
+        if flow control is enabled.
+        '''
+        hasroom = lambda: not self.__sndack or seq - self.__sndack < int(self.__window)
+        with self.__windowcond:
+            if not self.__windowcond.wait_for(hasroom, self.__sndtimeout):
+                raise TimeoutError("Send window full: %d messages not acknowledged" % self.inflight)
+    
+    def forgetpeer ( self, addr ):
+        '''
+        Stops waiting for acknowledges from the peer at 'addr', e.g. because it is dead or has
+        left the group; if it sends to the group again it's taken into account again.
+        '''
+        self.__sndq.forget(addr)
+        self.__acked(self.__sndq.ack)
+        with self.__windowcond:
+            self.__windowcond.notify_all()
+    
+    def __acked ( self, ack ):
+        '''
+        Records 'ack', the sequence number of the first message the slowest peer is missing,
+        updating the ack rate and growing the send window if it moved forward.
+        '''
+        if ack == self.__sndack: return
+        with self.__windowcond:
+            last, self.__sndack = self.__sndack, ack
+            if ack < last or not last: return   # a slower peer showed up, or the first one
+            now = monotonic()
+            if now > self.__sndackt:
+                rate = (ack - last) / (now - self.__sndackt)
+                self.__sndrate += RMcastServer.RATEGAIN * (rate - self.__sndrate) if self.__sndrate else rate
+            self.__sndackt = now
+            if self.__maxwindow is not None:
+                self.__window = min(self.__maxwindow, self.__window + (ack - last) / self.__window)
+                self.__windowcond.notify_all()
+                
+    def __congested ( self ):
+        '''
+        Shrinks the send window by half because some peer is missing our messages; losses
+        of messages sent before the last time the window shrank are not counted again.
+        '''
+        if self.__maxwindow is None: return
+        with self.__windowcond:
+            if self.__sndack <= self.__recover: return
+            self.__window = max(1.0, self.__window / 2)
+            self.__recover = self.__sndq.seq
+            logger.debug("Send window shrunk to %d messages", self.__window)
         
-    def sendnak ( self, baddr, ack ):
-        nak = (ack << 32) + baddr
-        msg = SequencedMessage(seq = self.__sndq.seq or 1, epoch = self.__epoch, ack = nak, body=None)
+    def __sequence ( self, body, flags=0 ):
+        '''
+        Builds the next message to be sent to the group and records it in the send queue and,
+        if loss-less, in the log. The caller must hold the send lock.
+        '''
+        msg = SequencedMessage(seq = self.__sndq.seq+1, epoch = self.__epoch | flags, ack = self.__ack, body=body)
+        if self.lossless:
+            self.__log.append(msg.seq, body, flags)
+        self.__sndq.push(msg)
+        if self.__feck:
+            self.__encode(msg)
+        return msg
+    
+    def __encode ( self, msg ):
+        '''
+        Adds message 'msg' to the FEC block being sent, building the block's parity datagram once
+        the block is complete. The caller must hold the send lock.
+        '''
+        k, block = self.__feck, self.__fecblock
+        first = msg.seq - (msg.seq - 1) % k
+        if first == msg.seq:
+            block = self.__fecblock = [first, 0, 0]
+        elif block is None or block[0] != first:
+            return                  # we've restarted in the middle of this block
+        block[1] ^= (msg.epoch >> 56) | len(msg.body) << 8
+        block[2] ^= int.from_bytes(msg.body, 'little')
+        if msg.seq == first + k - 1:
+            body = block[2].to_bytes((block[2].bit_length() + 7) // 8, 'little')
+            self.__parities.append(SequencedMessage(seq = first, epoch = self.__epoch | RMcastServer.FEC_PARITY,
+                                                    ack = self.__ack, body=RMcastServer.PARITY.pack(k, block[1]) + body))
+            self.__fecblock = None
+    
+    def __sendparities ( self ):
+        ''' Sends the parity datagrams of the FEC blocks completed so far '''
+        if not self.__parities: return
+        with self.__sndlock:
+            parities, self.__parities = self.__parities, []
+        self.sendbatch((self.encode(msg), self.grpaddr) for msg in parities)
+    
+    def __transmit ( self, msgs, paced=False ):
+        '''
+        Sends messages built by __sequence(), in order. If loss-less, waits for the messages to be
+        on disk first; this is done without holding the send lock, so that messages sent meanwhile
+        by other threads get on disk with the same sync. If 'paced', waits for the messages
+        sequenced before to be sent first, then each message waits for room in the send window.
+        Unpaced messages (handler answers and timer flushes) don't wait for anyone, since the
+        messages ahead of them may be waiting for acks only their thread can handle.
+        '''
+        try:
+            if self.lossless:
+                self.__log.commit(msgs[-1].seq)
+            if paced:
+                with self.__xmitcond:
+                    self.__xmitcond.wait_for(lambda: self.__sentseq >= msgs[0].seq - 1)
+            if paced and self.__maxwindow is not None:
+                for msg in msgs:
+                    self.__pace(msg.seq)
+                    result = super(RMcastServer, self).send(self.encode(msg))
+            elif len(msgs) == 1:
+                result = super(RMcastServer, self).send(self.encode(msgs[0]))
+            else:
+                result = self.sendbatch((self.encode(msg), self.grpaddr) for msg in msgs)
+        finally:
+            # Let the messages sequenced next go even if these didn't make it, peers will NAK them
+            with self.__xmitcond:
+                self.__sentseq = max(self.__sentseq, msgs[-1].seq)
+                self.__xmitcond.notify_all()
+        self.__sendparities()
+        return result
+    
+    def __fragment ( self, data, paced=False ):
+        '''
+        Sends a payload larger than the MTU as a series of fragments, each one a message
+        of its own, with consecutive sequence numbers.
+        '''
+        if len(data) > self.__maxmsgsize:
+            raise ValueError("Message of %d bytes exceeds max message size %d" % (len(data), self.__maxmsgsize))
+        header, size = RMcastServer.FRAGMENT, self.__mtu - RMcastServer.FRAGMENT.size
+        count = (len(data) + size - 1) // size
+        if count > self.__maxfragments:
+            raise ValueError("Message of %d bytes needs %d fragments, more than the %d the send queue and "
+                             "reorder window can hold, increase the MTU" % (len(data), count, self.__maxfragments))
+        data = memoryview(data)
+        with self.__sndlock:
+            # Coalesced payloads sent before this one have to go first
+            msgs = [self.__flush()] if self.__pending else []
+            msgid = (self.__sndq.seq + 1) & 0xFFFFFFFF
+            for index in range(count):
+                body = header.pack(msgid, index, count) + data[index*size:(index+1)*size]
+                msgs.append(self.__sequence(body, RMcastServer.FRAME_FRAGMENT))
+        self.__transmit(msgs, paced)
+        return len(data)
+    
+    def __coalesce ( self, data, paced=False ):
+        msgs = []
+        with self.__sndlock:
+            size = RMcastServer.RECORD.size + len(data)
+            if self.__pending and self.__pendingbytes + size > self.__batchbytes:
+                msgs.append(self.__flush())
+            self.__pending.append(data)
+            self.__pendingbytes += size
+            if self.__pendingbytes >= self.__batchbytes:
+                msgs.append(self.__flush())
+            elif self.__flusht is None:
+                self.__flusht = self.scheduler.schedule(self.__batchdelay / 1e6, self.flush)
+        if msgs:
+            self.__transmit(msgs, paced)
+        return len(data)
+    
+    def flush ( self ):
+        ''' Sends right away the payloads waiting to be coalesced into a single message, if any '''
+        with self.__sndlock:
+            msg = self.__flush()
+        if msg is not None:
+            self.__transmit([msg])
+            
+    def __flush ( self ):
+        ''' Builds a message out of the payloads waiting to be coalesced, if any. The caller must hold the send lock. '''
+        if self.__flusht is not None:
+            self.__flusht.cancel()
+            self.__flusht = None
+        pending = self.__pending
+        if not pending: return None
+        if len(pending) == 1:
+            msg = self.__sequence(pending[0])
+        else:
+            record = RMcastServer.RECORD.pack
+            msg = self.__sequence(b''.join(record(len(data)) + data for data in pending), RMcastServer.FRAME_BATCH)
+        self.__pending, self.__pendingbytes = [], 0
+        return msg
+        
+    def sendnak ( self, baddr, ack, missing=None ):
+        '''
+        Sends a NAK to the peer whose address is 'baddr' for message 'ack'. If 'missing' is present
+        the NAK asks for all the messages in it, a sequence of sequence numbers >= ack.
+        '''
+        nak, epoch, body = (ack << 32) + baddr, self.__epoch, None
+        if missing is not None and len(missing) > 1:
+            epoch, body = epoch | RMcastServer.NAK_RANGES, RMcastServer.nakmap(ack, missing)
+        msg = SequencedMessage(seq = self.__sndq.seq or 1, epoch = epoch, ack = nak, body=body)
         super(RMcastServer, self).send(self.encode(msg))
         
-    def resend ( self, seq ):
+    def retrieve ( self, seq ):
+        '''
+        Returns the message we sent with sequence number 'seq', or None if it is no longer
+        available, in which case the upper layer is notified.
+        '''
         try:
-            if seq < self.__sndq[0].seq:
-                raise IndexError("Message with sequence number %d not in memory" % seq)
-            msg = self.__sndq[seq - self.__sndq[0].seq]
+            return self.__sndq[seq]
         except IndexError:
             try:
                 if not self.lossless:
                     raise KeyError("Message with sequence number %d not in persistent store" % seq)
-                data = self.__shelf[str(seq)]
-                msg = SequencedMessage(seq = seq, epoch = self.__epoch, ack = self.__ack, body=data)
+                flags, data = self.__log[seq]
+                return SequencedMessage(seq = seq, epoch = self.__epoch | flags, ack = self.__ack, body=data)
             except KeyError:
-                return self.__handler.handleException(RMcastServer.SND_EXCEPTION, seq)
+                self.__handler.handleException(RMcastServer.SND_EXCEPTION, seq)
+                return None
+        
+    def resend ( self, seq ):
+        msg = self.retrieve(seq)
+        if msg is not None:
+            return super(RMcastServer, self).send(self.encode(msg))
                 
-        return super(RMcastServer, self).send(self.encode(msg))
+    def resendmany ( self, seqs ):
+        '''Re-transmits all the messages in 'seqs' as a single batch'''
+        msgs = [msg for msg in map(self.retrieve, seqs) if msg is not None]
+        return self.sendbatch((self.encode(msg), self.grpaddr) for msg in msgs)
                 
     def encode ( self, msg ):
-        return pack('QQQ%ds' % len(msg.body or b''), msg.seq, msg.epoch, msg.ack, msg.body or b'')
+        return SequencedDgramMsgHandler.HEADER.pack(msg.seq, msg.epoch, msg.ack) + (msg.body or b'')
 
     def cycleshelf ( self ):
+        ''' Starts a new segment of the loss-less log '''
         if not self.lossless: return
-        self.__shelf.close()
-        files = filter(lambda f: re.match('^' + self.__id + "\.\d+$", f), os.listdir())
-        files.sort()
-        index = int(re.search("\d+$", files[-1]).group())
-        os.rename(self.__id, self.__id + '.' + str(index+1))
-        self.__shelf = shelve.open(self.__id)
+        self.__log.rotate()
         
     def shutdown ( self ):
+        self.flush()
         result = super(RMcastServer, self).shutdown()
+        with self.__windowcond:
+            self.__sndack = 0       # release senders waiting for room in the window
+            self.__windowcond.notify_all()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
         if self.lossless:
-            self.__shelf.close()
-            self.__rcvshelf.close()
+            self.__log.close()
+            with self.__rcvshelflock:
+                self.__rcvshelf.close()
         list(map(SequencedMsgRcvQueue.cancelTimer, self.__rcvq.values()))
         return result
 
 
+class JSONCodec(object):
+    '''
+    A message codec for ProtocolAgent classes encoding messages as text of the form
+    <name>:<object>, where <name> is the message name and <object> is a JSON object
+    mapping field names to field values.
+    Encoded messages are large and slow to process but easy to read in network traces,
+    hence this codec is mostly useful for debugging.
+    '''
+    def __init__ ( self, msgtypes ):
+        '''
+        Constructor
+        @param msgtypes: dict-like object mapping message names to message types (namedtuples)
+        '''
+        self.__msgtypes = msgtypes
+
+    def encode ( self, msg ):
+        return bytes(type(msg).__name__ + ':' + json.dumps(msg._asdict()), 'utf8')
+
+    def decode ( self, data ):
+        '''
+        Returns a (message name, message) tuple. Raises KeyError if the message is unknown.
+        '''
+        msgname, msgval = bytes(data).decode().split(':', 1)
+        MsgType = self.__msgtypes[msgname]
+        return msgname, MsgType(**json.loads(msgval))
+
+
+class BinaryCodec(object):
+    '''
+    A message codec for ProtocolAgent classes encoding messages in a compact binary format:
+    a 16-bits message type identifier followed by the message fields in declaration order.
+    Field names are not transmitted; every field value is packed with struct preceded by a
+    one-byte tag telling its type, since namedtuples don't declare the types of their fields.
+    Integers between -128 and 127 take one byte, other integers eight. Strings, bytes and
+    containers are preceded by their length, taking one byte if lower than 255.
+    Supported field types are None, bool, int (64 bits), float, str, bytes, and lists,
+    tuples and dicts of those. Unlike JSON, tuples are decoded as tuples.
+    
+    Message type identifiers are derived from the message names alone (see msgid()), hence
+    agents of different classes understand each other's messages as long as they agree on
+    the names and fields of the messages they exchange, no matter what other messages each
+    of them knows. A class whose message names happen to hash to the same identifier can't
+    use the codec, ValueError is raised; renaming one of the messages solves it.
+    
+    Messages made only of numbers are decoded in a single struct call, using the layout of
+    the last message of the same type if the message tags match it.
+    '''
+    NONE, FALSE, TRUE, INT8, INT, FLOAT, STR, BYTES, LIST, TUPLE, DICT = range(11)
+    NUMBERS = { INT8: 'Bb', INT: 'Bq', FLOAT: 'Bd' }
+    LONG = 0xFF     # one-byte length value telling the actual length follows in 4 bytes
+
+    MSGID = Struct('!H')
+    INT8VAL = Struct('!Bb')
+    INTVAL = Struct('!Bq')
+    FLOATVAL = Struct('!Bd')
+    LENGTH = Struct('!BB')
+    LONGLENGTH = Struct('!I')
+
+    def __init__ ( self, msgtypes ):
+        '''
+        Constructor
+        @param msgtypes: dict-like object mapping message names to message types (namedtuples)
+        '''
+        self.__types = {}
+        for name in msgtypes:
+            msgid = BinaryCodec.msgid(name)
+            if msgid in self.__types:
+                raise ValueError("Messages %s and %s get the same identifier, rename one" % (self.__types[msgid][0], name))
+            self.__types[msgid] = (name, msgtypes[name])
+        self.__ids = dict((MsgType, msgid) for msgid, (_, MsgType) in self.__types.items())
+        self.__layouts = {}
+
+    @staticmethod
+    def msgid ( name ):
+        '''Returns the 16-bits identifier of the message named 'name', the same in every agent'''
+        return int.from_bytes(blake2b(name.encode('utf8'), digest_size=2).digest(), 'big')
+
+    def encode ( self, msg ):
+        try:
+            fmt, values = ['!H'], [self.__ids[type(msg)]]
+        except KeyError:
+            raise ValueError("Message type %s unknown to the codec" % type(msg).__name__)
+        for value in msg:
+            BinaryCodec.__pack(value, fmt, values)
+        return pack(''.join(fmt), *values)
+
+    def decode ( self, data ):
+        '''
+        Returns a (message name, message) tuple. Raises KeyError if the message is unknown.
+        '''
+        msgid, = BinaryCodec.MSGID.unpack_from(data)
+        msgname, MsgType = self.__types[msgid]
+        layout = self.__layouts.get(msgid)
+        if layout is not None and layout[0].size == len(data):
+            values = layout[0].unpack_from(data)
+            if values[1::2] == layout[1]:
+                return msgname, MsgType._make(values[2::2])
+
+        offset = BinaryCodec.MSGID.size
+        fields, tags = [], []
+        for _ in MsgType._fields:
+            tags.append(data[offset])
+            value, offset = BinaryCodec.__unpack(data, offset)
+            fields.append(value)
+        if offset != len(data):
+            raise ValueError("Message %s takes %d bytes, got %d" % (msgname, offset, len(data)))
+        if all(tag in BinaryCodec.NUMBERS for tag in tags):
+            fmt = '!H' + ''.join(BinaryCodec.NUMBERS[tag] for tag in tags)
+            self.__layouts[msgid] = (Struct(fmt), tuple(tags))
+        return msgname, MsgType._make(fields)
+
+    @staticmethod
+    def __packlength ( tag, length, fmt, values ):
+        if length < BinaryCodec.LONG:
+            fmt.append('BB')
+            values += (tag, length)
+        else:
+            fmt.append('BBI')
+            values += (tag, BinaryCodec.LONG, length)
+
+    @staticmethod
+    def __pack ( value, fmt, values ):
+        t = type(value)
+        if t is int:
+            if -128 <= value < 128:
+                fmt.append('Bb')
+                values += (BinaryCodec.INT8, value)
+            else:
+                fmt.append('Bq')
+                values += (BinaryCodec.INT, value)
+        elif t is float:
+            fmt.append('Bd')
+            values += (BinaryCodec.FLOAT, value)
+        elif t is str:
+            value = value.encode('utf8')
+            BinaryCodec.__packlength(BinaryCodec.STR, len(value), fmt, values)
+            fmt.append('%ds' % len(value))
+            values.append(value)
+        elif value is None:
+            fmt.append('B')
+            values.append(BinaryCodec.NONE)
+        elif t is bool:
+            fmt.append('B')
+            values.append(BinaryCodec.TRUE if value else BinaryCodec.FALSE)
+        elif t in (bytes, bytearray, memoryview):
+            value = bytes(value)
+            BinaryCodec.__packlength(BinaryCodec.BYTES, len(value), fmt, values)
+            fmt.append('%ds' % len(value))
+            values.append(value)
+        elif t is dict:
+            BinaryCodec.__packlength(BinaryCodec.DICT, len(value), fmt, values)
+            for k, v in value.items():
+                BinaryCodec.__pack(k, fmt, values)
+                BinaryCodec.__pack(v, fmt, values)
+        elif isinstance(value, (list, tuple)):
+            tag = BinaryCodec.LIST if isinstance(value, list) else BinaryCodec.TUPLE
+            BinaryCodec.__packlength(tag, len(value), fmt, values)
+            for v in value:
+                BinaryCodec.__pack(v, fmt, values)
+        else:
+            raise TypeError("Values of type %s cannot be encoded" % t.__name__)
+
+    @staticmethod
+    def __unpack ( data, offset ):
+        '''
+        Returns a (value, offset) tuple, where offset points to the byte after the value
+        '''
+        tag = data[offset]
+        if tag == BinaryCodec.INT8:
+            return BinaryCodec.INT8VAL.unpack_from(data, offset)[1], offset + 2
+        elif tag == BinaryCodec.INT:
+            return BinaryCodec.INTVAL.unpack_from(data, offset)[1], offset + 9
+        elif tag == BinaryCodec.FLOAT:
+            return BinaryCodec.FLOATVAL.unpack_from(data, offset)[1], offset + 9
+        elif tag == BinaryCodec.NONE:
+            return None, offset + 1
+        elif tag == BinaryCodec.TRUE:
+            return True, offset + 1
+        elif tag == BinaryCodec.FALSE:
+            return False, offset + 1
+        length = data[offset + 1]
+        offset += 2
+        if length == BinaryCodec.LONG:
+            length, = BinaryCodec.LONGLENGTH.unpack_from(data, offset)
+            offset += BinaryCodec.LONGLENGTH.size
+        if tag == BinaryCodec.STR:
+            return bytes(data[offset:offset+length]).decode('utf8'), offset + length
+        elif tag == BinaryCodec.BYTES:
+            return bytes(data[offset:offset+length]), offset + length
+        elif tag == BinaryCodec.DICT:
+            value = {}
+            for _ in range(length):
+                k, offset = BinaryCodec.__unpack(data, offset)
+                value[k], offset = BinaryCodec.__unpack(data, offset)
+            return value, offset
+        elif tag in (BinaryCodec.LIST, BinaryCodec.TUPLE):
+            value = []
+            for _ in range(length):
+                v, offset = BinaryCodec.__unpack(data, offset)
+                value.append(v)
+            return (value if tag == BinaryCodec.LIST else tuple(value)), offset
+        raise ValueError("Unknown value tag %d at offset %d" % (tag, offset))
+
+
 class ProtocolAgent(type):
     '''
     A meta-class for classes intended to talk over some communication means.
     Currently supports communication over:
         - local memory (classes running within the same Python interpreter)
         - TCP
+        - TCP, multiplexing all the connections on a single thread
+        - TCP served by an asyncio event loop
         - UDP
         - Reliable multi-cast (using the RMcastServer implementation in this module)
+    
+    Messages are encoded by the codec class bound to the 'codec' attribute of the agent
+    class, BinaryCodec if the attribute is absent. Set it to JSONCodec for readable
+    messages while debugging:
+        @ProtocolAgent.UDP
+        class E:
+            codec = JSONCodec
+            ...
     '''
     def __new__ ( cls, name, bases, d ):
         '''
@@ -792,7 +2789,9 @@ class ProtocolAgent(type):
         '''
         ProtocolAgent.__addmsghandlers(bases, d)
         ProtocolAgent.__decoratesend(bases, d)
-        ProtocolAgent.__addgenericjsonhandler(d)
+        ProtocolAgent.__adddispatchtable(bases, d)
+        ProtocolAgent.__addcodec(bases, d)
+        ProtocolAgent.__addgenerichandler(d)
         ProtocolAgent.__exportprivate(bases, d)
         return type.__new__(cls, name, bases, d)
 
@@ -814,8 +2813,8 @@ class ProtocolAgent(type):
         '''
         Adds to the class' dictionary any method having a 'msgname' attribute in a base class;
         those methods can be tagged in base classes using the 'handles(msg)' decorator.
-        Each method is bound to a name of the form <msg>Handler and is called by the generic JSON
-        handler mentioned in class method __addgenericjsonhandler(). 
+        Each method is bound to a name of the form <msg>Handler and is called by the generic
+        handler mentioned in class method __addgenerichandler(). 
         '''
         handlers = [
             (m.msgname+'Handler', m)
@@ -828,11 +2827,11 @@ class ProtocolAgent(type):
     def __decoratesend ( bases, d ):
         '''
         Decorates the first 'send' method found in base classes by wrapping it into
-        the jsonencoded() method.
+        the encoded() method.
         '''
         send = d.get('send', ProtocolAgent.__searchbases(bases, 'send'))
         if send is not None and callable(send):
-            d['send'] = ProtocolAgent.jsonencoded(send)
+            d['send'] = ProtocolAgent.encoded(send)
         else:
             d['send'] = lambda s, m, d: None
             #d['send'] = lambda s, m, d: \
@@ -840,7 +2839,41 @@ class ProtocolAgent(type):
             #    (type(s).__name__, str(m), str(d)))
     
     @staticmethod
-    def __addgenericjsonhandler ( d ):
+    def __adddispatchtable ( bases, d ):
+        '''
+        Builds the table used by the generic handler to dispatch received messages.
+        The table maps every message name to a (message type, handler method) tuple; the
+        handler method is None for messages with no handler, which are passed over to
+        the defaulthandler() method instead. Message types are looked up as Python looks
+        up attributes, i.e. first in the class' dictionary then in the bases' MROs.
+        The table is built once, at class creation time, and is read-only thereafter.
+        '''
+        namespace = {}
+        for b in reversed(bases):
+            for k in reversed(b.__mro__):
+                namespace.update(k.__dict__)
+        namespace.update(d)
+        table = dict(
+            (name, (value, namespace.get(name + 'Handler')))
+            for name, value in namespace.items()
+            if isinstance(value, type) and issubclass(value, tuple) and hasattr(value, '_fields')
+        )
+        d['dispatchtable'] = MappingProxyType(table)
+
+    @staticmethod
+    def __addcodec ( bases, d ):
+        '''
+        Adds to the class' dictionary an instance of the class' codec (see the 'codec'
+        attribute in the class documentation) for the messages in the dispatch table.
+        '''
+        codec = d.get('codec')
+        if codec is None:
+            codec = next((b.codec for b in bases if hasattr(b, 'codec')), BinaryCodec)
+        msgtypes = dict((msgname, entry[0]) for msgname, entry in d['dispatchtable'].items())
+        d['msgcodec'] = codec(msgtypes)
+
+    @staticmethod
+    def __addgenerichandler ( d ):
         '''
         Adds a handler method that calls the right message handler method based on the
         type of the message received.
@@ -854,27 +2887,32 @@ class ProtocolAgent(type):
         
         def unknownhandler ( self, message, src ):
             '''
-            Called when we receive an unknown message.
+            Called when we receive an unknown message, or one that can't be decoded.
             Can be re-implemented in derived classes.
             '''
-            msgname, msgval = message.decode().split(':', 1)
-            print("%s.unknownhandler: unknown message '%s' received from %s" % (type(self).__name__, msgname, src))
+            print("%s.unknownhandler: unknown message %r received from %s" % (type(self).__name__, bytes(message[:32]), src))
+        
+        dispatchtable = d['dispatchtable']
+        decode = d['msgcodec'].decode
         
         def handle ( self, message, src ):
             '''
             Method to be injected into classes having ProtocolAgent as metaclass.
-            Decodes a received JSON message into a Python object and calls the handler
-            method 'self.<msgname>Handler()', where <msgname> is the message name received
-            at the heading of the message.
+            Decodes a received message into a Python object using the class' codec and calls
+            the handler method 'self.<msgname>Handler()', where <msgname> is the name of the
+            message received. The handler is found in the class' dispatch table (see
+            __adddispatchtable()) so no class introspection takes place here.
             '''
-            MyCls = type(self)
-            msgname, msgval = message.decode().split(':', 1)
-            if msgname in dir(MyCls):
-                MsgType = MyCls.__bases__[0].__dict__[msgname]
-                msg = MsgType(**json.loads(msgval))
-                MyCls.__dict__.get(msgname + 'Handler', MyCls.defaulthandler)(self, msg, src)
-            else:
+            try:
+                msgname, msg = decode(message)
+            except (KeyError, IndexError, ValueError, TypeError, StructError):
+                # unknown message type, or garbage
                 return self.unknownhandler(message, src)
+            handler = dispatchtable[msgname][1]
+            if handler is None:
+                self.defaulthandler(msg, src)
+            else:
+                handler(self, msg, src)
             
         d['handle'] = handle
         d['unknownhandler'] = unknownhandler
@@ -912,8 +2950,7 @@ class ProtocolAgent(type):
             def wrapper ( self, msg, src ):
                 rsp = handlerfunc(self, msg, src)
                 if type(rsp).__name__.endswith('Msg'):  # type(None).__name__ is 'NoneType'
-                    jsonencodedrsp = type(rsp).__name__ + ':' + json.dumps(rsp.__dict__)
-                    return bytes(jsonencodedrsp, 'utf8') 
+                    return self.msgcodec.encode(rsp)
             wrapper.msgname = msgname
             return wrapper
         return decorator
@@ -927,10 +2964,22 @@ class ProtocolAgent(type):
         '''
         @wraps(sendfunc)
         def wrapper ( self, msg, dst=None ):
-            jsonencodedmsg = type(msg).__name__ + ':' + json.dumps(msg.__dict__)
+            jsonencodedmsg = type(msg).__name__ + ':' + json.dumps(msg._asdict())
             return sendfunc(self, bytes(jsonencodedmsg, 'utf8'), dst)
         return wrapper
 
+    @staticmethod
+    def encoded ( sendfunc ):
+        '''
+        Decorator for a method having as arguments a message 'msg' and a destination 'dst'.
+        It encodes the message using the codec of the agent class before calling the decorated
+        method. Ideally suited to decorate a send() method receiving a Python object as message.
+        '''
+        @wraps(sendfunc)
+        def wrapper ( self, msg, dst=None ):
+            return sendfunc(self, self.msgcodec.encode(msg), dst)
+        return wrapper
+
     def describe ( self ):
         '''
         Returns a string description of the agent class with messages, message handling methods,
@@ -980,13 +3029,28 @@ class ProtocolAgent(type):
         '''
         class UDPHandler(BaseRequestHandler):
             def handle ( self ):
-                data = self.request[0].strip()
+                data = self.request[0]
                 socket = self.request[1]
                 result = self.server.handle(data, self.client_address)
                 if result is not None:
                     socket.sendto(result, self.client_address)
+                    
+            @classmethod
+            def handlebatch ( cls, server, batch ):
+                results = []
+                for data, client_address in batch:
+                    try:
+                        result = server.handle(data, client_address)
+                        if result is not None:
+                            results.append((result, client_address))
+                    except Exception:
+                        server.handle_error((data, server.socket), client_address)
+                if results:
+                    server.sendbatch(results)
+                
+        class BatchUDPServer(DgramBatchMixIn, UDPServer): pass
                 
-        class wrapper(cls, UDPServer, metaclass=ProtocolAgent):
+        class wrapper(cls, BatchUDPServer, metaclass=ProtocolAgent):
             def __init__ ( self, hostport, *args, **kwargs ):
                 UDPServer.__init__(self, hostport, UDPHandler)
                 cls.__init__(self, *args, **kwargs)
@@ -997,6 +3061,13 @@ class ProtocolAgent(type):
             def send ( self, msg, dst ):
                 # The method providing send() functionality in UDPServer is sendto()
                 return self.socket.sendto(msg, dst) < len(msg)
+            
+            def sendmany ( self, msg, dsts ):
+                '''
+                Sends the same message to every destination in dsts, encoding it only once.
+                Returns the list of destinations which the message could not be sent to.
+                '''
+                return DgramBatchMixIn.sendmany(self, self.msgcodec.encode(msg), dsts)
 
         return wrapper
     
@@ -1008,6 +3079,17 @@ class ProtocolAgent(type):
             @ProtocolAgent.TCP
             class C:
                 ...
+            agent = C(hostport, tcpopts={'connecttimeout': 1})
+            
+        The agent keeps one connection per peer, whether opened by the peer or by send(). Senders
+        to different peers never wait for each other: connecting to a peer only blocks those
+        sending to it, for at most 'connecttimeout' seconds, and at most 'maxdials' connections
+        are being opened at any time. Before re-using a connection send() checks whether the
+        peer closed it, and if so, or if sending fails, it connects again and re-sends the
+        message once. The numbers of connections opened and re-used, and of failures to connect
+        or send, are available in the 'dials', 'reuses' and 'failures' properties.
+        
+        If the class has a closed(peer) method it's called whenever a connection served ends.
         '''
         class TCPHandler(BaseRequestHandler):
             def handle ( self ):
@@ -1024,32 +3106,57 @@ class ProtocolAgent(type):
                     # wants to reuse the connection. In both cases the connection is not to be recycled.
                     recycleconn = False
                 try:
+                    reader = Framing.Reader()
                     while True:
-                        data = sock.recv(2)
-                        if len(data) == 0: break    # remote peer closed the connection
-                        msglen = (data[0] << 8) + data[1]
-                        data = sock.recv(msglen)
-                        result = self.server.handle(data, self.client_address)
-                        if result is not None:
-                            self.server.send(result, peer)
+                        msgs = reader.recv(sock)
+                        if msgs is None: break      # remote peer closed the connection
+                        for data in msgs:
+                            result = self.server.handle(data, self.client_address)
+                            if result is not None:
+                                self.server.send(result, peer)
                     if recycleconn and not self.server.reuseconn:
+                        self.server.delpeer(peer, sock)
                         sock.close()
-                        self.server.delpeer(peer)
                 except socket.error as msg:
                     logger.warning("Error sending result message to remote peer %s, cause: %s" % (self.client_address, msg))
+                except ValueError as msg:
+                    # Most likely a corrupted stream (see Framing.Reader), there's no way to find
+                    # where the next message starts
+                    logger.warning("Error reading from remote peer %s, closing connection, cause: %s" % (self.client_address, msg))
+                    self.server.delpeer(peer, sock)
+                    sock.close()
+                finally:
+                    closed = getattr(self.server, 'closed', None)
+                    if closed is not None: closed(peer)
                 
         class ThreadingTCPServer(ThreadingMixIn, TCPServer): pass
         
         class wrapper(cls, ThreadingTCPServer, metaclass=ProtocolAgent):
-            def __init__ ( self, hostport, *args, **kwargs ):
+            CONNECTTIMEOUT = 5
+            MAXDIALS = 16
+            
+            def __init__ ( self, hostport, *args, tcpopts={}, **kwargs ):
                 TCPServer.__init__(self, hostport, TCPHandler)
                 cls.__init__(self, *args, **kwargs)
                 self.__peers = {}
-                self.__peersmutex = Lock()
+                self.__peersmutex = Lock()  # protects the members above and below
+                self.__sendlocks = {}       # address -> Lock serializing connecting and sending to the peer
+                self.__stats = [0, 0, 0]    # dials, reuses, failures
+                self.__connecttimeout = tcpopts.get('connecttimeout', self.CONNECTTIMEOUT)
+                self.__dialslots = BoundedSemaphore(tcpopts.get('maxdials', self.MAXDIALS))
                 self.__reuseconn = False
             
             @property
             def peers ( self ): return self.__peers
+            
+            @property
+            def dials ( self ): return self.__stats[0]
+            
+            @property
+            def reuses ( self ): return self.__stats[1]
+            
+            @property
+            def failures ( self ): return self.__stats[2]
 
             @property
             def reuseconn ( self ): return self.__reuseconn
@@ -1058,9 +3165,11 @@ class ProtocolAgent(type):
                 with self.__peersmutex:
                     self.__peers[address] = sock
                     
-            def delpeer ( self, address ):
+            def delpeer ( self, address, sock=None ):
+                # send() may have replaced a connection the peer closed with a new one already
                 with self.__peersmutex:
-                    del self.__peers[address]
+                    if sock is None or self.__peers.get(address) is sock:
+                        self.__peers.pop(address, None)
                     
             def address ( self ):
                 return self.server_address
@@ -1068,33 +3177,70 @@ class ProtocolAgent(type):
             def send ( self, msg, dst ):
                 # Notice TCPServer is a pure reactive server class, it doesn't have a send() method
                 # Hence this wrapper needs to provide its own send()
-                # There is a potential race condition here, if the try block runs in parallel to the
-                # closing of a connection by the remote peer. The try block gets the socket, the
-                # connection close removes the socket, then we try to send on a closed socket. The
-                # consequence is the send() call below raises an exception.
-                try:
-                    sock = self.__peers[dst]
-                except KeyError:
-                    with self.__peersmutex:
-                        # Two threads executing this block in sequence shall create two
-                        # connections to the same dest. Hence before actually creating the
-                        # connection we need to check if another thread has created it already.
-                        if not dst in self.__peers:
-                            # create a connection to dst
-                            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            #sock.bind((self.address[0], self.address[1]+len(self.__peers)+1))
-                            sock.connect(dst)
-                            self.__peers[dst] = sock
+                # The peer may close the connection, or the handler recycle it, right after we
+                # check it's alive; if sending fails then, we connect again and re-send. Since
+                # the message wasn't sent in full the peer can't have handled it.
+                lock = self.__sendlocks.get(dst) or self.__sendlock(dst)
+                with lock:
+                    for retry in (False, True):
+                        sock = self.__connection(dst)
+                        try:
+                            # The header and the message are written together, without copying them into
+                            # a single buffer; the message is written in full even if the socket takes it
+                            # in pieces.
+                            Framing.sendall(sock, (msg,))
+                            return
+                        except OSError as e:
+                            self.__count(2)
+                            self.__drop(dst, sock)
+                            if retry: raise
+                            logger.info("Error sending to remote peer %s, re-connecting, cause: %s", dst, e)
                             
-                # Notice socket.send() returns the actual number of bytes sent, which may be smaller
-                # than the number of bytes we want to send; we're responsible for sending the remaining
-                # bytes. With current TCP window sizes however it's highly unlikely that fragmented TCP
-                # segment delivery takes place so we try to send everything first, and only if not all
-                # was sent we enter the delivery loop that copies the message buffer due to slicing.
-                enc_msg = bytes((len(msg) >> 8, len(msg) & 0xFF)) + msg
-                bytes_remaining = len(enc_msg) - sock.send(enc_msg)
-                while bytes_remaining:
-                    bytes_remaining = bytes_remaining - sock.send(enc_msg[len(enc_msg)-bytes_remaining:])
+            def __sendlock ( self, dst ):
+                with self.__peersmutex:
+                    return self.__sendlocks.setdefault(dst, Lock())
+                
+            def __count ( self, stat ):
+                with self.__peersmutex:
+                    self.__stats[stat] += 1
+                    
+            def __connection ( self, dst ):
+                '''Returns a live connection to 'dst', connecting to it if needed. The caller holds its send lock.'''
+                sock = self.__peers.get(dst)
+                if sock is not None:
+                    if wrapper.alive(sock):
+                        self.__count(1)
+                        return sock
+                    self.__drop(dst, sock)
+                with self.__dialslots:
+                    try:
+                        sock = socket.create_connection(dst, self.__connecttimeout)
+                    except OSError:
+                        self.__count(2)
+                        raise
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.addpeer(dst, sock)
+                self.__count(0)
+                return sock
+            
+            def __drop ( self, dst, sock ):
+                with self.__peersmutex:
+                    if self.__peers.get(dst) is sock:
+                        del self.__peers[dst]
+                sock.close()
+                
+            @staticmethod
+            def alive ( sock ):
+                '''Tells whether the remote peer hasn't closed connection 'sock' (nor has it been closed here)'''
+                try:
+                    if not DgramBatchMixIn.recv_flags and not select([sock], [], [], 0)[0]:
+                        return True     # nothing to read, hence not closed
+                    return len(sock.recv(1, socket.MSG_PEEK | DgramBatchMixIn.recv_flags)) > 0
+                except BlockingIOError:
+                    return True
+                except (OSError, ValueError):
+                    return False
             
             def close ( self ):
                 # We need to protect ourselves from the handler class removing
@@ -1105,6 +3251,29 @@ class ProtocolAgent(type):
             
         return wrapper
     
+    @staticmethod
+    def MultiplexedTCP ( cls ):
+        '''
+        A class decorator to support communication between agents using TCP, serving all the
+        connections from a single thread (see MultiplexedTCPServer) rather than from a thread
+        per connection. Options of the server (e.g. workers, idletime) can be passed in the
+        'tcpopts' dict.
+        Usage:
+            @ProtocolAgent.MultiplexedTCP
+            class F:
+                ...
+            agent = F(hostport, tcpopts={'workers': 4})
+        '''
+        class wrapper(cls, MultiplexedTCPServer, metaclass=ProtocolAgent):
+            def __init__ ( self, hostport, *args, tcpopts={}, **kwargs ):
+                MultiplexedTCPServer.__init__(self, hostport, **tcpopts)
+                cls.__init__(self, *args, **kwargs)
+                
+            def address ( self ):
+                return self.server_address
+            
+        return wrapper
+    
     @staticmethod
     def RMcast ( cls ):
         '''
@@ -1115,81 +3284,834 @@ class ProtocolAgent(type):
                 ...
         '''
         class wrapper(cls, RMcastServer, metaclass=ProtocolAgent):
-            def __init__ ( self, mcast_hostport, hostport, ttl=32, station_id=cls.__name__, *args, **kwargs ):
+            def __init__ ( self, mcast_hostport, hostport, ttl=32, station_id=cls.__name__, *args, rmcastopts={}, **kwargs ):
                 # Notice the handler argument to RMcastServer constructor is not a handler in the
                 # serversocket sense; it is the class we want to receive the messages handled by the
                 # RMcastServer instance, which has its own socketserver-like handler of type SequencedDgramMsgHandler.
                 # Since the wrapper class shall have a handle() method injected by the metaclass, this works.
-                RMcastServer.__init__(self, mcast_hostport, hostport, self, ttl, station_id)
+                # Further RMcastServer options (e.g. batchbytes) can be passed in the 'rmcastopts' dict.
+                RMcastServer.__init__(self, mcast_hostport, hostport, self, ttl, station_id, **rmcastopts)
                 cls.__init__(self, *args, **kwargs)
 
             def address ( self ):
                 return self.grpaddr
                 
         return wrapper
+    
+    @staticmethod
+    def Asyncio ( cls ):
+        '''
+        A class decorator to support communication between agents using TCP, served by an asyncio
+        event loop rather than by a thread per connection, so that many agents can share a thread.
+        Messages are framed as by TCP agents, hence both kinds of agents can talk to each other.
+        The agent is bound to its address when instantiated and serves connections as soon as the
+        loop runs; send() can be called from any thread, but handlers always run in the loop's.
+        The loop is given in actual argument 'loop', which can be omitted only when instantiating
+        the agent from a coroutine run by the loop itself; ValueError is raised otherwise.
+        Usage:
+            @ProtocolAgent.Asyncio
+            class E:
+                ...
+            agent = E(hostport, loop=loop)
+        
+        Handlers must not block the loop. In particular, if they send to the group through a
+        RMcastServer served by the same loop (see DgramBatchMixIn.serve_on()) that has flow
+        control enabled ('sndwindow' set), a full window blocks the loop's thread waiting for
+        acks that only that thread could handle, i.e. a deadlock lasting 'sndtimeout' seconds.
+        Use no send window for such servers, or send from another thread.
+        '''
+        class Connection(asyncio.Protocol):
+            '''A connection to a peer; messages sent before it's made are held until then'''
+            def __init__ ( self, agent, peer=None ):
+                self.agent = agent
+                self.peer = peer
+                self.transport = None
+                self.pending = []
+                self.reader = Framing.Reader()
+                
+            def connection_made ( self, transport ):
+                self.transport = transport
+                if self.peer is None:
+                    # Incoming connection, it'll be used for sending to this peer too
+                    self.peer = transport.get_extra_info('peername')
+                    self.agent.addpeer(self.peer, self)
+                transport.writelines(self.pending)
+                self.pending = None
+                
+            def data_received ( self, data ):
+                try:
+                    msgs = self.reader.feed(data)
+                except ValueError as e:
+                    logger.warning("Closing connection to remote peer %s, cause: %s", self.peer, e)
+                    return self.transport.close()
+                for msg in msgs:
+                    try:
+                        result = self.agent.handle(msg, self.peer)
+                        if result is not None:
+                            self.write(result)
+                    except Exception:
+                        logger.exception("Error handling message from remote peer %s", self.peer)
+                
+            def write ( self, msg ):
+                if self.transport is None:
+                    self.pending.extend(Framing.frame(msg))
+                else:
+                    self.transport.writelines(Framing.frame(msg))
+                    
+            def connection_lost ( self, exc ):
+                self.agent.delpeer(self.peer, self)
+                closed = getattr(self.agent, 'closed', None)
+                if closed is not None:
+                    closed(self.peer)
+        
+        class wrapper(cls, metaclass=ProtocolAgent):
+            def __init__ ( self, hostport, *args, loop=None, **kwargs ):
+                if loop is None:
+                    try:
+                        loop = asyncio.get_running_loop()
+                    except RuntimeError:
+                        raise ValueError("No event loop running, pass the one serving the agent in actual argument 'loop'")
+                self.__loop = loop
+                self.__peers = {}
+                self.__server = None
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.socket.bind(hostport)
+                self.socket.listen()
+                self.socket.setblocking(False)
+                self.server_address = self.socket.getsockname()
+                asyncio.run_coroutine_threadsafe(self.__serve(), self.__loop)
+                cls.__init__(self, *args, **kwargs)
+                
+            async def __serve ( self ):
+                self.__server = await self.__loop.create_server(lambda: Connection(self), sock=self.socket)
+                
+            @property
+            def loop ( self ): return self.__loop
+            
+            @property
+            def peers ( self ): return self.__peers
+            
+            def addpeer ( self, address, conn ):
+                self.__peers[address] = conn
+                
+            def delpeer ( self, address, conn ):
+                if self.__peers.get(address) is conn:
+                    del self.__peers[address]
+                    
+            def address ( self ):
+                return self.server_address
+            
+            def __inloop ( self ):
+                try:
+                    return asyncio.get_running_loop() is self.__loop
+                except RuntimeError:
+                    return False
+            
+            def send ( self, msg, dst ):
+                # Connections are only touched from the loop's thread, hence they need no locking
+                if self.__inloop():
+                    self.__send(msg, dst)
+                else:
+                    self.__loop.call_soon_threadsafe(self.__send, msg, dst)
+                    
+            def __send ( self, msg, dst ):
+                conn = self.__peers.get(dst)
+                if conn is None:
+                    conn = self.__peers[dst] = Connection(self, dst)
+                    connecting = self.__loop.create_task(self.__loop.create_connection(lambda: conn, *dst))
+                    connecting.add_done_callback(lambda task: self.__connected(task, conn))
+                conn.write(msg)
+                
+            def __connected ( self, task, conn ):
+                cause = 'cancelled' if task.cancelled() else task.exception()
+                if cause is not None:
+                    logger.warning("Unable to connect to remote peer %s, cause: %s", conn.peer, cause)
+                    self.delpeer(conn.peer, conn)
+            
+            def shutdown ( self ):
+                '''Stops serving and closes every connection; the loop is left running'''
+                if self.__inloop():
+                    self.__close()
+                else:
+                    self.__loop.call_soon_threadsafe(self.__close)
+                    
+            def __close ( self ):
+                if self.__server is not None:
+                    self.__server.close()
+                else:
+                    self.socket.close()
+                for conn in list(self.__peers.values()):
+                    if conn.transport is not None:
+                        conn.transport.close()
+                
+            close = shutdown
+            
+        return wrapper
+
+
+class TimerScheduler(object):
+    '''
+    Runs timed calls from a single thread, no matter how many timers are pending.
+    Timers are kept in a heap ordered by expiry time; schedule() returns a handle
+    whose cancel() method just flags the timer, which is discarded when it reaches
+    the top of the heap. The thread is started with the first timer scheduled.
+    Callbacks are run outside the scheduler's lock, hence they can schedule or
+    cancel timers themselves, but they must return quickly and never block since
+    they delay every other timer expiring meanwhile; NAK time-outs and flushes of
+    coalesced messages are fine, anything that may block (e.g. sending through a
+    flow-controlled server) belongs in a RepeatableTimer, which runs its function
+    on a thread of its own.
+    '''
+    
+    class Handle(object):
+        '''A scheduled call; can be cancelled until the call starts'''
+        __slots__ = ('when', 'function', 'args', 'kwargs', 'cancelled', 'fired', 'scheduler')
+        
+        def __init__ ( self, when, function, args, kwargs, scheduler ):
+            self.when = when
+            self.function = function
+            self.args = args
+            self.kwargs = kwargs
+            self.cancelled = False
+            self.fired = False
+            self.scheduler = scheduler
+            
+        @property
+        def pending ( self ): return not (self.fired or self.cancelled)
+        
+        def cancel ( self ):
+            self.scheduler._cancel(self)
+            
+        def __repr__ ( self ):
+            return "<timer %r at %.3f%s>" % (self.function, self.when, ' (cancelled)' if self.cancelled else '')
+    
+    def __init__ ( self, name='TimerScheduler' ):
+        self.__name = name
+        self.__heap = []            # (when, n, handle) tuples
+        self.__counter = count()    # tie-breaker for heap entries, handles are not comparable
+        self.__ncancelled = 0
+        self.__cond = Condition()
+        self.__thread = None
+        
+    @property
+    def pending ( self ):
+        '''Number of timers waiting to expire'''
+        with self.__cond:
+            return len(self.__heap) - self.__ncancelled
+        
+    @property
+    def thread ( self ): return self.__thread
+        
+    def schedule ( self, delay, function, args=(), kwargs={} ):
+        '''
+        Schedules a call to function(*args, **kwargs) in 'delay' seconds.
+        Returns a handle that can be used to cancel the call.
+        '''
+        handle = TimerScheduler.Handle(monotonic() + delay, function, args, kwargs, self)
+        with self.__cond:
+            heappush(self.__heap, (handle.when, next(self.__counter), handle))
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name=self.__name, daemon=True)
+                self.__thread.start()
+            elif self.__heap[0][2] is handle:
+                self.__cond.notify()    # expires before whatever the thread is waiting for
+        return handle
+    
+    def _cancel ( self, handle ):
+        with self.__cond:
+            if not handle.pending: return
+            handle.cancelled = True
+            self.__ncancelled += 1
+            # Timers like NAK time-outs are mostly cancelled, don't let them pile up
+            if self.__ncancelled > 64 and self.__ncancelled > len(self.__heap) // 2:
+                self.__heap[:] = [entry for entry in self.__heap if not entry[2].cancelled]
+                heapify(self.__heap)
+                self.__ncancelled = 0
+    
+    def __run ( self ):
+        heap, cond = self.__heap, self.__cond
+        while True:
+            with cond:
+                while True:
+                    if heap and heap[0][2].cancelled:
+                        heappop(heap)
+                        self.__ncancelled -= 1
+                    elif not heap:
+                        cond.wait()
+                    else:
+                        delay = heap[0][0] - monotonic()
+                        if delay <= 0:
+                            handle = heappop(heap)[2]
+                            handle.fired = True
+                            break
+                        cond.wait(delay)
+            try:
+                handle.function(*handle.args, **handle.kwargs)
+            except Exception:
+                logger.exception("Timer callback %r failed", handle)
+
+
+class AsyncioScheduler(object):
+    '''
+    Runs timed calls on an asyncio event loop by means of loop.call_later(), providing the
+    same interface as TimerScheduler. Timers can be scheduled and cancelled from any thread
+    but calls always run in the loop's thread, hence servers served by the loop (see
+    DgramBatchMixIn.serve_on()) and their timers need no other thread.
+    '''
+    
+    class Handle(object):
+        '''A scheduled call; can be cancelled until the call starts'''
+        __slots__ = ('function', 'args', 'kwargs', 'cancelled', 'fired', 'timer', 'scheduler')
+        
+        def __init__ ( self, function, args, kwargs, scheduler ):
+            self.function = function
+            self.args = args
+            self.kwargs = kwargs
+            self.cancelled = False
+            self.fired = False
+            self.timer = None       # the loop's TimerHandle, once armed
+            self.scheduler = scheduler
+            
+        @property
+        def pending ( self ): return not (self.fired or self.cancelled)
+        
+        def cancel ( self ):
+            self.scheduler._cancel(self)
+    
+    def __init__ ( self, loop ):
+        self.__loop = loop
+        self.__pending = 0
+        self.__lock = Lock()
+        
+    @property
+    def loop ( self ): return self.__loop
+    
+    @property
+    def pending ( self ):
+        '''Number of timers waiting to expire'''
+        return self.__pending
+    
+    def __inloop ( self ):
+        try:
+            return asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            return False
+    
+    def schedule ( self, delay, function, args=(), kwargs={} ):
+        '''
+        Schedules a call to function(*args, **kwargs) in 'delay' seconds.
+        Returns a handle that can be used to cancel the call.
+        '''
+        handle = AsyncioScheduler.Handle(function, args, kwargs, self)
+        with self.__lock:
+            self.__pending += 1
+        if self.__inloop():
+            self.__arm(handle, delay)
+        else:
+            self.__loop.call_soon_threadsafe(self.__arm, handle, delay)
+        return handle
+    
+    def __arm ( self, handle, delay ):
+        if not handle.cancelled:
+            handle.timer = self.__loop.call_later(delay, self.__fire, handle)
+    
+    def _cancel ( self, handle ):
+        with self.__lock:
+            if not handle.pending: return
+            handle.cancelled = True
+            self.__pending -= 1
+        # The loop's handles aren't thread-safe; if not armed yet or called from another
+        # thread, the timer just goes off doing nothing
+        if handle.timer is not None and self.__inloop():
+            handle.timer.cancel()
+    
+    def __fire ( self, handle ):
+        with self.__lock:
+            if not handle.pending: return
+            handle.fired = True
+            self.__pending -= 1
+        try:
+            handle.function(*handle.args, **handle.kwargs)
+        except Exception:
+            logger.exception("Timer callback %r failed", handle.function)
+
 
+# The scheduler all timers in this module run on
+scheduler = TimerScheduler()
 
-class RepeatableTimer ( _Timer ):
+
+class RepeatableTimer(object):
+    '''
+    A timer calling a function every 'interval' seconds, 'count' times or until
+    cancelled. Provides the same interface as threading.Timer but is timed by the
+    module's TimerScheduler (or by 'scheduler', if present) rather than by a thread
+    sleeping all along. Since functions like heart-beats may block, every call runs on
+    a short-lived thread of its own so that the scheduler's timers are never delayed;
+    set actual argument 'inline' to 'True' to run quick, non-blocking functions on the
+    scheduler's thread instead (e.g. the asyncio loop's, see AsyncioScheduler).
+    A call starts only once the previous one has returned.
+    '''
     FOREVER = -1
     
-    def __init__ ( self, interval, function, args=(), kwargs={}, count=-1):
-        super(RepeatableTimer, self).__init__(interval, function, args, kwargs)
+    def __init__ ( self, interval, function, args=(), kwargs={}, count=-1, scheduler=None, inline=False ):
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.finished = Event()
         self.__count = count
+        self.__scheduler = scheduler
+        self.__inline = inline
+        self.__handle = None
+        self.__next = None
+        self.__lock = Lock()
         
-    def run ( self ):
-        while self.__count != 0:
-            super(RepeatableTimer, self).run()
-            self.finished.clear() # Timer.run() calls finished.set() right before returning
-            self.__count -= 1
-        self.finished.set()
+    def start ( self ):
+        with self.__lock:
+            if self.__count == 0:
+                self.finished.set()
+            else:
+                self.__next = monotonic() + self.interval
+                self.__handle = (self.__scheduler or scheduler).schedule(self.interval, self.__fire)
+        
+    def __fire ( self ):
+        if self.__inline:
+            self.__run()
+        else:
+            Thread(target=self.__run, name=type(self).__name__, daemon=True).start()
+        
+    def __run ( self ):
+        try:
+            self.function(*self.args, **self.kwargs)
+        except Exception:
+            logger.exception("Repeatable timer function %r failed", self.function)
+        finally:
+            with self.__lock:
+                if not self.finished.is_set():
+                    self.__count -= 1
+                    if self.__count == 0:
+                        self.finished.set()
+                    else:
+                        # Fixed rate: slow callbacks don't make the timer drift
+                        self.__next += self.interval
+                        self.__handle = (self.__scheduler or scheduler).schedule(self.__next - monotonic(), self.__fire)
             
     def cancel ( self ):
-        self.__count = 1
-        super(RepeatableTimer, self).cancel()
+        with self.__lock:
+            self.finished.set()
+            if self.__handle is not None:
+                self.__handle.cancel()
+    
+    def is_alive ( self ):
+        return self.__handle is not None and not self.finished.is_set()
+    
+    def join ( self, timeout=None ):
+        self.finished.wait(timeout)
 
 
+class MerkleDict(dict):
+    '''
+    A dict keeping a hash tree over its items, so two replicas can find where they differ
+    exchanging a few hashes (see StateXferAgent.syncState()).
+    
+    Keys are spread over FANOUT ** depth leaves by a hash of their repr(). The hash of a leaf
+    is the XOR of the hashes of the repr() of its (key, value) items, and the hash of every
+    other node is the XOR of the hashes of its children. Hence every write updates the tree
+    in O(depth), XORing out the hash of the old item and XORing in that of the new one along
+    the path from the leaf to the root. Nodes are numbered breadth-first, the root being 0.
+    
+    Keys and values must have a repr() that is the same in every replica, as numbers, strings
+    and tuples of those do. The class is no more thread-safe than dict.
+    '''
+    FANOUT = 16
+    DEPTH = 3
+    
+    def __init__ ( self, data=(), depth=DEPTH ):
+        super(MerkleDict, self).__init__()
+        self.__depth = depth
+        self.__first = (MerkleDict.FANOUT ** depth - 1) // (MerkleDict.FANOUT - 1)
+        self.__nodes = [0] * (self.__first + MerkleDict.FANOUT ** depth)
+        self.__keys = [set() for _ in range(MerkleDict.FANOUT ** depth)]    # the keys of every leaf
+        self.update(data)
+        
+    @property
+    def depth ( self ): return self.__depth
+    
+    @property
+    def root ( self ): return self.__nodes[0]
+    
+    @staticmethod
+    def digest ( obj ):
+        return int.from_bytes(blake2b(repr(obj).encode(), digest_size=8).digest(), 'big', signed=True)
+    
+    def node ( self, index ):
+        return self.__nodes[index]
+    
+    def isleaf ( self, index ):
+        return index >= self.__first
+    
+    def children ( self, index ):
+        return range(index * MerkleDict.FANOUT + 1, (index + 1) * MerkleDict.FANOUT + 1)
+    
+    @property
+    def leaves ( self ): return range(self.__first, len(self.__nodes))
+    
+    def leaf ( self, key ):
+        '''Returns the index of the leaf node holding the key'''
+        return self.__first + MerkleDict.digest(key) % len(self.__keys)
+    
+    def leafkeys ( self, index ):
+        return self.__keys[index - self.__first]
+    
+    def __xor ( self, index, delta ):
+        nodes = self.__nodes
+        while index > 0:
+            nodes[index] ^= delta
+            index = (index - 1) // MerkleDict.FANOUT
+        nodes[0] ^= delta
+        
+    def __setitem__ ( self, key, value ):
+        index = self.leaf(key)
+        delta = MerkleDict.digest((key, value))
+        if key in self:
+            delta ^= MerkleDict.digest((key, dict.__getitem__(self, key)))
+        else:
+            self.__keys[index - self.__first].add(key)
+        dict.__setitem__(self, key, value)
+        self.__xor(index, delta)
+        
+    def __delitem__ ( self, key ):
+        value = dict.pop(self, key)
+        index = self.leaf(key)
+        self.__keys[index - self.__first].discard(key)
+        self.__xor(index, MerkleDict.digest((key, value)))
+        
+    def pop ( self, key, *default ):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+    
+    def popitem ( self ):
+        key, value = dict.popitem(self)
+        dict.__setitem__(self, key, value)
+        del self[key]
+        return key, value
+    
+    def setdefault ( self, key, default=None ):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+    
+    def update ( self, *args, **kwargs ):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+            
+    def clear ( self ):
+        dict.clear(self)
+        self.__nodes = [0] * len(self.__nodes)
+        for keys in self.__keys: keys.clear()
+    
+    
 @ProtocolAgent.TCP
 class StateXferAgent(object):
     '''
     A state transfer agent based on TCP. It can both send and receive
     a dictionary-like state (a number of key-value pairs) over TCP to
     a remote peer.
+    
+    The whole state is sent as a snapshot taken when the transfer starts, streamed in chunks
+    of up to 'chunksize' items each, compressed with zlib. The sender is held back by the TCP
+    connection when the receiver falls behind, so no more than a few chunks are in flight.
+    The receiver applies each chunk in a single update() call, and stops serving once the
+    snapshot is complete. Both ends report the progress of the transfer in the 'items',
+    'total', 'nbytes', 'elapsed' and 'rate' properties.
+    
+    If the state is a MerkleDict, syncState() sends just the items the receiver lacks or has
+    different. The sender sends the hashes of the tree nodes level by level, starting with
+    the root, and the receiver answers which ones differ from its own; the children of the
+    nodes differing are sent next, and the leaves differing are sent in full, replacing
+    the receiver's. Receivers whose state isn't a MerkleDict get all the leaves. Since the
+    sender's state may change while it is read, the exchange starts over from the root
+    until the receiver finds its root equal to the sender's, at most SYNCROUNDS times;
+    otherwise the transfer fails, the sender closing the connection without a DoneMsg.
+    
+    The keys are spread over PARTITIONS partitions by their hash (see partition()), and
+    xferState() can send just some of them, announced in a PartsMsg and each one followed by
+    a DoneMsg. Hence a receiver can get disjoint partitions from several senders at once, and
+    retry just those it misses after a failure: the receiving agent removes every partition
+    received from set 'parts' and stops serving once it's empty. It also stops once a sender
+    closes its connection before sending all the partitions it announced, telling it in the
+    'broken' property, and once all the senders are done while 'parts' is not empty yet.
     '''
     ItemMsg = namedtuple('ItemMsg', 'key, value')
+    ItemsMsg = namedtuple('ItemsMsg', 'keys, values')
+    PartsMsg = namedtuple('PartsMsg', 'parts')
+    ChunkMsg = namedtuple('ChunkMsg', 'seq, total, data, part')
+    DoneMsg = namedtuple('DoneMsg', 'chunks, items, part')    # part is None when the whole state is done
+    TreeMsg = namedtuple('TreeMsg', 'depth, nodes, hashes')
+    DiffMsg = namedtuple('DiffMsg', 'nodes, synced')   # synced is False when the receiver has no matching tree
+    LeavesMsg = namedtuple('LeavesMsg', 'leaves, keys, values')
     
-    def __init__ ( self, state ):
+    CHUNKSIZE = 8192
+    LEVEL = 1           # zlib compression level, the fastest one
+    PARTITIONS = 16     # a divisor of the number of leaves of MerkleDict, so partitions are sets of leaves
+    SYNCROUNDS = 8      # max times syncState() walks the tree down from the root
+    
+    # Our listening port is taken again right away when retrying a failed transfer
+    allow_reuse_address = True
+    
+    def __init__ ( self, state, chunksize=CHUNKSIZE, parts=None ):
         self.__state = state
+        self.__chunksize = chunksize
+        self.__pending = set(range(StateXferAgent.PARTITIONS)) if parts is None else parts
+        self.__streams = {}     # sender -> partitions it announced and hasn't sent yet
+        self.__broken = False
+        self.__mutex = Lock()   # serializes applying the chunks received from different senders
+        self.__items = 0
+        self.__total = None
+        self.__nbytes = 0
+        self.__started = None
+        self.__finished = None
+        self.__done = Event()
+        self.__synced = False   # whether our state has the same tree as the sender's
         
     @property
     def state ( self ): return self.__state
     
+    @property
+    def items ( self ): return self.__items
+    
+    @property
+    def total ( self ): return self.__total
+    
+    @property
+    def nbytes ( self ): return self.__nbytes
+    
+    @property
+    def done ( self ): return self.__done
+    
+    @property
+    def pending ( self ): return self.__pending
+    
+    @property
+    def broken ( self ): return self.__broken
+    
+    @property
+    def elapsed ( self ):
+        if self.__started is None: return 0.0
+        return (self.__finished or monotonic()) - self.__started
+    
+    @property
+    def rate ( self ):
+        '''Items transferred per second'''
+        elapsed = self.elapsed
+        return self.__items / elapsed if elapsed > 0 else 0.0
+    
+    def __progress ( self, items, nbytes, total=None ):
+        if self.__started is None:
+            self.__started = monotonic()
+        if self.__total is None:
+            self.__total = total
+        self.__items += items
+        self.__nbytes += nbytes
+        
+    def __finish ( self, peer ):
+        self.__finished = monotonic()
+        self.__done.set()
+        logger.info("State transfer with %s done: %d items, %d bytes in %.3fs (%.0f items/s)",
+                    peer, self.__items, self.__nbytes, self.elapsed, self.rate)
+    
     def xferItem ( self, key, dst ):
         self.send(StateXferAgent.ItemMsg(key, self.state[key]), dst)
         
-    def xferState ( self, dst ):
+    @staticmethod
+    def partition ( key ):
+        return MerkleDict.digest(key) % StateXferAgent.PARTITIONS
+    
+    def __partitions ( self, parts ):
+        '''Yields a (partition, items) tuple for every partition in parts'''
+        state = self.state
+        if isinstance(state, MerkleDict) and len(state.leaves) % StateXferAgent.PARTITIONS == 0:
+            # The leaves of a partition are every PARTITIONS-th one, see partition() and MerkleDict.leaf()
+            for part in parts:
+                items = []
+                for leaf in state.leaves[part::StateXferAgent.PARTITIONS]:
+                    for key in list(state.leafkeys(leaf)):
+                        try:
+                            items.append((key, state[key]))
+                        except KeyError:
+                            pass    # deleted since we listed the leaf
+                yield part, items
+        else:
+            # Copying the items is atomic for dicts, so the snapshot is consistent even if the
+            # state keeps changing while it's sent
+            buckets = dict((part, []) for part in parts)
+            for key, value in list(state.items()):
+                bucket = buckets.get(StateXferAgent.partition(key))
+                if bucket is not None: bucket.append((key, value))
+            for part in parts:
+                yield part, buckets[part]
+    
+    def xferState ( self, dst, parts=None ):
+        '''Sends the partitions in parts to dst, all of them by default'''
+        parts = list(range(StateXferAgent.PARTITIONS) if parts is None else parts)
+        self.__progress(0, 0, len(self.state))
+        chunks = 0
         try:
-            for key, value in self.state.items():
-                self.send(StateXferAgent.ItemMsg(key, value), dst)
+            self.send(StateXferAgent.PartsMsg(parts), dst)
+            for part, items in self.__partitions(parts):
+                for start in range(0, len(items), self.__chunksize):
+                    chunk = items[start:start+self.__chunksize]
+                    data = zlib.compress(self.msgcodec.encode(StateXferAgent.ItemsMsg(*zip(*chunk))), self.LEVEL)
+                    self.send(StateXferAgent.ChunkMsg(chunks, len(self.state), data, part), dst)
+                    self.__progress(len(chunk), len(data))
+                    chunks += 1
+                self.send(StateXferAgent.DoneMsg(chunks, len(items), part), dst)
+            self.__finish(dst)
         finally:
-            self.shutdown()
+            # The agent was never served, so shutdown() would wait forever
+            self.close()
+    
+    def syncState ( self, dst ):
+        tree = self.state
+        self.__progress(0, 0, len(tree))
+        reader, nodes, chunks = Framing.Reader(), [0], 0
+        try:
+            self.send(StateXferAgent.PartsMsg(list(range(StateXferAgent.PARTITIONS))), dst)
+            for _ in range(StateXferAgent.SYNCROUNDS):
+                # Hashes and leaves are read at different times, so a round may leave some
+                # difference behind if the tree changes meanwhile; start over until the roots match
+                nodes, differ = [0], False
+                while nodes:
+                    self.send(StateXferAgent.TreeMsg(tree.depth, nodes, [tree.node(i) for i in nodes]), dst)
+                    self.__progress(0, 8 * len(nodes))
+                    reply = self.__reply(dst, reader)
+                    leaves = [i for i in reply.nodes if tree.isleaf(i)]
+                    nodes = [child for i in reply.nodes if not tree.isleaf(i) for child in tree.children(i)]
+                    chunks = self.__xferleaves(leaves, chunks, dst)
+                    differ = differ or bool(reply.nodes)
+                if not differ or not reply.synced: break
+            else:
+                raise ConnectionError("State of %s still differs from ours after %d rounds" % (dst, StateXferAgent.SYNCROUNDS))
+            self.send(StateXferAgent.DoneMsg(chunks, self.items, None), dst)
+            self.__finish(dst)
+        finally:
+            self.close()
+            
+    def __reply ( self, dst, reader ):
+        '''Waits for the message the receiver answers through the connection we opened'''
+        sock = self.peers[dst]
+        while True:
+            msgs = reader.recv(sock)
+            if msgs is None:
+                raise ConnectionError("Connection to %s closed while waiting for its answer" % (dst,))
+            if msgs:
+                return self.msgcodec.decode(msgs[0])[1]
+                
+    def __xferleaves ( self, leaves, chunks, dst ):
+        tree, batch, keys, values = self.state, [], [], []
+        for n, leaf in enumerate(leaves, 1):
+            batch.append(leaf)
+            for key in list(tree.leafkeys(leaf)):
+                try:
+                    values.append(tree[key])
+                    keys.append(key)
+                except KeyError:
+                    pass            # deleted since we listed the leaf
+            if len(keys) >= self.__chunksize or n == len(leaves):
+                data = zlib.compress(self.msgcodec.encode(StateXferAgent.LeavesMsg(batch, keys, values)), self.LEVEL)
+                self.send(StateXferAgent.ChunkMsg(chunks, len(tree), data, None), dst)
+                self.__progress(len(keys), len(data))
+                batch, keys, values, chunks = [], [], [], chunks + 1
+        return chunks
     
-    def xferStateAsync ( self, dst, callMeWhenDone = None, callMeOnError = None ):
+    def xferStateAsync ( self, dst, callMeWhenDone = None, callMeOnError = None, sync = False, parts = None ):
         def func():
             try:
-                self.xferState(dst)
+                if sync:
+                    self.syncState(dst)
+                else:
+                    self.xferState(dst, parts)
                 if callMeWhenDone is not None: callMeWhenDone(dst)
             except Exception as e:
+                logger.warning("Error transferring state to %s, cause: %s", dst, e)
                 if callMeOnError is not None: callMeOnError(dst, e)
 
-        stateXferThread = Thread(target=func, name=type(self).__name__)
-        stateXferThread.run()
+        stateXferThread = Thread(target=func, name=type(self).__name__, daemon=True)
+        stateXferThread.start()
         return stateXferThread  # Just in case caller needs to join() on it
 
     @ProtocolAgent.handles('ItemMsg')
     def receiveItem ( self, msg, src ):
         self.state[msg.key] = msg.value
 
+    @ProtocolAgent.handles('ItemsMsg')
+    def receiveItems ( self, msg, src ):
+        self.state.update(zip(msg.keys, msg.values))
+        self.__items += len(msg.keys)
+        
+    @ProtocolAgent.handles('PartsMsg')
+    def receiveParts ( self, msg, src ):
+        with self.__mutex:
+            self.__streams.setdefault(src, set()).update(msg.parts)
+        
+    @ProtocolAgent.handles('ChunkMsg')
+    def receiveChunk ( self, msg, src ):
+        data = zlib.decompress(msg.data)
+        with self.__mutex:
+            self.__progress(0, len(msg.data), msg.total)
+            self.handle(data, src)
+        
+    @ProtocolAgent.handles('TreeMsg')
+    def receiveTree ( self, msg, src ):
+        tree = self.state
+        self.__synced = isinstance(tree, MerkleDict) and tree.depth == msg.depth
+        if not self.__synced:
+            diff = msg.nodes
+        else:
+            diff = [i for i, h in zip(msg.nodes, msg.hashes) if tree.node(i) != h]
+        self.__progress(0, 8 * len(msg.nodes))
+        self.send(StateXferAgent.DiffMsg(diff, self.__synced), src)
+        
+    @ProtocolAgent.handles('LeavesMsg')
+    def receiveLeaves ( self, msg, src ):
+        if self.__synced:
+            # The leaves received replace ours, so we drop the keys the sender hasn't got
+            keys = set(msg.keys)
+            for leaf in msg.leaves:
+                for key in [key for key in self.state.leafkeys(leaf) if key not in keys]:
+                    del self.state[key]
+        self.state.update(zip(msg.keys, msg.values))
+        self.__items += len(msg.keys)
+        
+    @ProtocolAgent.handles('DoneMsg')
+    def receiveDone ( self, msg, src ):
+        with self.__mutex:
+            if msg.part is None:
+                self.__pending.clear()
+                self.__streams.get(src, set()).clear()
+            else:
+                self.__pending.discard(msg.part)
+                self.__streams.get(src, set()).discard(msg.part)
+            if self.__pending: return
+        self.__finish(src)
+        self.shutdown()
+
     def closed ( self, peer ):
+        with self.__mutex:
+            unsent = self.__streams.pop(peer, None)
+            if unsent is None: return       # not a sender
+            if unsent:
+                self.__broken = True
+            elif self.__streams or not self.__pending:
+                return                      # others still sending, or we're done already
+        if unsent:
+            logger.warning("State transfer from %s broken, %d partitions missing", peer, len(self.__pending))
+        else:
+            logger.warning("State transfer senders done, %d partitions missing", len(self.__pending))
         self.shutdown()
 
 
@@ -1213,14 +4135,15 @@ class LogicalClockServer(object):
     TROUBLED = 2
     DEAD = 0
     STATE_PORT = 2500
+    SLACK = 64          # stale entries the heap of last message times may hold beyond twice the members
     
     # Protocol
-    HelloMsg = namedtuple('HelloMsg', 'id, time')
+    HelloMsg = namedtuple('HelloMsg', 'id, time, state, parts')    # the joiner's state agent address and missing partitions
     ByeMsg = namedtuple('ByeMsg', 'id, time')
     CommandMsg = namedtuple('CommandMsg', 'command, time')
     HeartbeatMsg = namedtuple('HeartbeatMsg', 'time')
     
-    def __init__ ( self, state_hostport, state = {}, clk_start=0, hb_time=1, startup_time=3, death_time=30 ):
+    def __init__ ( self, state_hostport, state = {}, clk_start=0, hb_time=1, startup_time=3, death_time=30, sync=False ):
         '''
         Constructor
         Basically variable initialization, and launching the HB thread.
@@ -1230,14 +4153,19 @@ class LogicalClockServer(object):
         @param hb_time: time interval, in seconds, between two successive heart-beat command generation, defaults to 1s
         @param startup_time: number of heart-beat commands this server waits until assuming it is alone, defaults to 3
         @param death_time: number of seconds until a silent peer is regarded dead, defaults to 30s
+        @param sync: whether joining servers get only the part of the state they lack rather than a full copy,
+                     defaults to False. The state is then kept in a MerkleDict, so it must be accessed through
+                     the 'state' property; all servers in the group should agree on this setting
         '''
         clock() # On Windows, make sure processor time is > hb_time when __hbthread kicks in
         self.__state_hostport = state_hostport
-        self.__state = state
+        self.__state = MerkleDict(state) if sync and not isinstance(state, MerkleDict) else state
+        self.__pendingparts = set(range(StateXferAgent.PARTITIONS))    # state partitions not received yet
         self.__mutex = Lock()
         self.__reqissued = False
         self.__cmdseq = []
         self.__members = {}
+        self.__lasttimes = []   # heap of (time, address) of the last messages from members, see __mintime()
         self.__clk = clk_start
         self.__deathtime = death_time
         self.__hbthread = RepeatableTimer(hb_time, LogicalClockServer.heartbeat, args=(self,))
@@ -1275,20 +4203,41 @@ class LogicalClockServer(object):
     @state.setter
     def state ( self, new_state ): self.__state = new_state
     
+    @property
+    def state_hostport ( self ): return self.__state_hostport
+    
+    @property
+    def pendingparts ( self ): return self.__pendingparts
+    
     @property
     def hbthread ( self ): return self.__hbthread
 
     @property
     def startingup ( self ): return self.__startingup > 0
     
-    def __xferstate ( self, dst ):
-        agent = StateXferAgent(self.__state_hostport, self.__state)
-        agent.xferStateAsync(dst)
+    def __xferstate ( self, dst, parts=None ):
+        # The sending agent doesn't accept connections, so it takes any free port; ours may
+        # be taken by another transfer already
+        agent = StateXferAgent((self.__state_hostport[0], 0), self.__state)
+        return agent.xferStateAsync(dst, sync=parts is None, parts=parts)
 
     def __acceptstate ( self ):
         # We need to keep the agent variable in the instance, so heartbeat() can call agent.shutdown()
-        self.__agent = StateXferAgent(self.__state_hostport, self.__state)
-        self.__agent.serve_forever()
+        # The agent removes the partitions it receives from self.__pendingparts, so if the transfer
+        # breaks we ask just for those missing when we try again
+        self.__agent = StateXferAgent(self.__state_hostport, self.__state, parts=self.__pendingparts)
+        try:
+            self.__agent.serve_forever()
+            # Partitions may be missing even if no transfer broke, e.g. if the members disagree on
+            # who's alive so nobody sends some; unless there's nobody to get them from, ask again
+            missing = len(self.__pendingparts)
+            if self.__agent.broken or (missing and any(m != self.address() for m, _ in self.alivemembers)):
+                raise ConnectionError("%d state partitions missing" % missing)
+            if missing:
+                logger.info("LogicalClockServer at %s, no other member alive, starting with its own state", self.id)
+            self.__startingup = 0   # the state is complete, or there's none to wait for
+        finally:
+            self.__agent.close()
         del self.__agent
         
     def updclknsend ( self, msg, dst=None ):
@@ -1328,18 +4277,25 @@ class LogicalClockServer(object):
         #print("LogicalClockServer.heartbeat(): current time is %f" % clock())
         xpctd_time_of_last_msg = clock() - self.__hbthread.interval
         min_time_of_last_msg = clock() - self.__deathtime
-        for src, member in self.alivemembers:
+        dead = []
+        for src, member in list(self.alivemembers):
             time_of_last_msg = member[0]
             if time_of_last_msg <= xpctd_time_of_last_msg:
                 self.__mutex.acquire()
                 try:
+                    # The member may have sent something, or left, since we looked
+                    if self.__members.get(src) is not member: continue
                     if time_of_last_msg <= min_time_of_last_msg:
                         self.__members[src] = (time_of_last_msg, member[1], LogicalClockServer.DEAD)
+                        dead.append(src)
                         #print("LogicalClockServer.heartbeat(): member %s is dead" % src)
                     else:
                         self.__members[src] = (time_of_last_msg, member[1], LogicalClockServer.TROUBLED)
                 finally:
                     self.__mutex.release()
+        # Dead members won't ack our messages anymore, don't let them close our send window
+        for src in dead:
+            self.forgetpeer(src)
         
     def checkstartup ( self ):
         '''
@@ -1371,8 +4327,35 @@ class LogicalClockServer(object):
         try:
             self.__clk = max(self.__clk + 1, msg.time)
             self.__members[src] = (clock(), msg.time, LogicalClockServer.ALIVE)
+            heappush(self.__lasttimes, (msg.time, src))
+            if len(self.__lasttimes) > 2 * len(self.__members) + LogicalClockServer.SLACK:
+                self.__compact()
         finally:
             self.__mutex.release()
+            
+    def __compact ( self ):
+        '''Rebuilds the heap of last message times dropping all the stale entries. The caller holds the mutex.'''
+        self.__lasttimes = [(m[1], src) for src, m in self.__members.items() if m[2] != LogicalClockServer.DEAD]
+        heapify(self.__lasttimes)
+        
+    def __mintime ( self ):
+        '''
+        Returns the time of the oldest among the last messages received from every alive member,
+        or None if there are none. The caller holds the mutex.
+        
+        Every message received pushes its time onto a heap rather than updating its sender's
+        entry, so the entries of members that sent again since, died or left are stale. Those
+        at the top of the heap are dropped here, and the rest every time the heap grows to
+        twice the number of members, hence the cost per message is O(log n) amortized.
+        '''
+        lasttimes, members = self.__lasttimes, self.__members
+        while lasttimes:
+            time, src = lasttimes[0]
+            member = members.get(src)
+            if member is not None and member[1] == time and member[2] != LogicalClockServer.DEAD:
+                return time
+            heappop(lasttimes)
+        return None
         
     def heartbeat ( self, dst = None ):
         '''
@@ -1418,7 +4401,8 @@ class LogicalClockServer(object):
         #print("%s %s: received command %s with time %i at local time %i" \
         #      % (type(self).__name__, self.id, msg.command, msg.time, self.__clk))
         self.updclknstatus(msg, src)
-        heappush(self.__cmdseq, (msg.time, msg.command))
+        with self.__mutex:
+            heappush(self.__cmdseq, (msg.time, msg.command))
 
     @ProtocolAgent.handles('HeartbeatMsg')
     def handleHeartbeat ( self, msg, src ):
@@ -1428,7 +4412,13 @@ class LogicalClockServer(object):
     @ProtocolAgent.handles('HelloMsg')
     def handleHello ( self, msg, src ):
         self.updclknstatus(msg, src)
-        if len(self.__members) > 1:
+        if len(self.__members) > 1 and not isinstance(self.__state, MerkleDict):
+            # Every alive member but the joiner sends a share of the partitions missing
+            donors = sorted(m[0] for m in self.alivemembers if m[0] != src)
+            if self.address() in donors:
+                parts = msg.parts[donors.index(self.address())::len(donors)]
+                if parts: self.__xferstate(tuple(msg.state), parts)
+        elif len(self.__members) > 1:
             # State shall be transferred by us only if we're closest network address
             srcs = list(map(lambda m: m[0], self.alivemembers))
             srcs.sort()
@@ -1440,7 +4430,7 @@ class LogicalClockServer(object):
             else:
                 pass                        # pick the closest one
             if srcs[i] == self.address():   # is it me?
-                self.__xferState(src)
+                self.__xferstate(tuple(msg.state))
         
     @ProtocolAgent.handles('ByeMsg')
     def handleBye ( self, msg, src ):
@@ -1450,6 +4440,7 @@ class LogicalClockServer(object):
             del self.__members[src]
         finally:
             self.__mutex.release()
+        self.forgetpeer(src)
         #print("LogicalClockServer.handleBye(): from %s at %f" % (src, clock()))
 
     @ProtocolAgent.export
@@ -1458,10 +4449,21 @@ class LogicalClockServer(object):
     
     @ProtocolAgent.export
     def __next__ ( self ):
-        if self.isFirstMsgStable():
-            return heappop(self.cmdseq)[1]
-        else:
-            raise StopIteration
+        with self.__mutex:
+            if self.__isstable():
+                return heappop(self.__cmdseq)[1]
+        raise StopIteration
+    
+    def drain_stable ( self ):
+        '''
+        Pops all the stable messages at once, returning their commands in order.
+        '''
+        cmds = []
+        with self.__mutex:
+            mintime = self.__mintime() if self.__members else None
+            while self.__cmdseq and (mintime is None or self.__cmdseq[0][0] < mintime):
+                cmds.append(heappop(self.__cmdseq)[1])
+        return cmds
 
     def isFirstMsgStable ( self ):
         '''
@@ -1472,25 +4474,22 @@ class LogicalClockServer(object):
         This implies silent peers block the ensemble until they send something again
         or are declared dead by the heartbeat() method.
         ''' 
+        with self.__mutex:
+            return self.__isstable()
+        
+    def __isstable ( self ):
         # If the sequence is empty, there're no messages - stable or not
-        if len(self.cmdseq) == 0: return False
+        if len(self.__cmdseq) == 0: return False
         
-        # If we're alone, all messages in the sequence are stable
-        if len(self.members) == 0: return True
+        # If we're alone, all messages in the sequence are stable; likewise if all the others are dead
+        mintime = self.__mintime() if self.__members else None
+        if mintime is None: return True
         
         # Otherwise, check we got more recent messages from all alive members
-        firstmsg = self.cmdseq[0]
-        msgtime = firstmsg[0]
-        self.mutex.acquire()
-        try:
-            mintime = min(map(lambda t: t[1][1], self.alivemembers))
-        finally:
-            self.mutex.release()
-
-        return msgtime < mintime
+        return self.__cmdseq[0][0] < mintime
         
 def sayhello ( self, dst = None ):
-    return self.updclknsend(LogicalClockServer.HelloMsg(self.id, self.clk))
+    return self.updclknsend(LogicalClockServer.HelloMsg(self.id, self.clk, self.state_hostport, sorted(self.pendingparts)))
 LogicalClockServer.sayhello = sayhello
             
 def saygoodbye ( self, dst = None ):
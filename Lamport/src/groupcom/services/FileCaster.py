@@ -14,8 +14,10 @@ class FileCaster(server.RMcastServer):
     EndFileMsg = namedtuple('EndFileMsg', 'hash')
     ReceiveErrorMsg = namedtuple('ReceiveError', 'reason')
     
-    def __init__ ( self, mcast_hostport, hostport, ttl, station_id=None, chunksize=1400 ):
-        super(FileCaster, self).__init__(mcast_hostport, hostport, ttl, self, station_id)
+    FEC = 8     # file chunks protected by each parity datagram, see RMcastServer
+    
+    def __init__ ( self, mcast_hostport, hostport, ttl, station_id=None, chunksize=1400, fec=FEC ):
+        super(FileCaster, self).__init__(mcast_hostport, hostport, self, ttl, station_id, fec=fec)
         self.__chunksize = chunksize
         self.__sending = None
         self.__receiving = {}
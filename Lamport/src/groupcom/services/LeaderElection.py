@@ -1237,10 +1237,12 @@ class O1StableLeaderElector ( LeaderElectorBase, ExpiringLinksImpl ):
                 type(self).__name__, self.p, self.n )
             peers = self.peersSnapshot()
             try:
-                # TODO: optimize by reusing the same msg and calling msg._replace()
-                rcvrlist = map(
-                    lambda rcvr: self.send(type(self).OkMsg(time(), self.O(rcvr), self.D(rcvr), self.r, peers), rcvr),
-                    self.peers)
+                # O and D differ for every peer so each one gets its own message, but all
+                # of them are sent in a single batch
+                encode = self.msgcodec.encode
+                msg = type(self).OkMsg(time(), 0, 0, self.r, peers)
+                rcvrlist = self.sendbatch(
+                    [(encode(msg._replace(O=self.O(rcvr), D=self.D(rcvr))), rcvr) for rcvr in self.peers])
                 if any(rcvrlist):
                     logger.error("Peer %d failed sending OK to one or more peers", self.p)
             except Exception as e:
@@ -1268,8 +1270,7 @@ class O1StableLeaderElector ( LeaderElectorBase, ExpiringLinksImpl ):
         '''Sends the same message to all the peers in the internal list'''
         peers = self.peersSnapshot()
         try:
-            rcvrlist = map(lambda rcvr: self.send(msg, rcvr), peers)
-            if any(rcvrlist):
+            if self.sendmany(msg, peers):
                 logger.error("Peer %d failed sending %s to one or more peers", self.p, msg)
         except Exception as e:
             logger.error("Peer %d failed sending %s to one or more peers, error: %s", self.p, msg, e)
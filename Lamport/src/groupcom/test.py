@@ -4,7 +4,8 @@ Created on 20/02/2013
 @author: ecejjar
 '''
 
-from server import LogicalClockServer, McastServer, McastRouter, RMcastServer, SequencedMessage, ProtocolAgent, RepeatableTimer, StateXferAgent
+from server import LogicalClockServer, McastServer, McastRouter, RMcastServer, SequencedMessage, ProtocolAgent, RepeatableTimer, StateXferAgent, MerkleDict
+from server import BinaryCodec, JSONCodec, SequencedMsgSndQueue, SequencedMsgRcvQueue, SequencedMsgLog, TimerScheduler, SequencedDgramMsgHandler, SeenCache, AsyncioScheduler, Framing
 from services import LeaderElection, Paxos 
 from socketserver import BaseRequestHandler
 from threading import  Thread, Timer, Lock
@@ -13,10 +14,15 @@ from collections import deque, namedtuple
 from functools import reduce, wraps
 from itertools import count
 import unittest
+import threading
 import socket
 import os
 import re
 import logging
+import tempfile
+import shelve
+import asyncio
+import zlib
 
 if not hasattr(unittest, 'skip'):
     unittest.skip = lambda func: func   # Python 3.0 and lower
@@ -75,6 +81,12 @@ class ServerTest(unittest.TestCase):
             Timer(3, testfunc, args=(server,)).start()
             server.serve_forever()
             self.assertEqual(testData, server.result, "Server stored result: %s" % str(server.result))
+            # Draining a socket that has no datagrams is quiet, other errors are logged
+            with self.assertLogs('server', logging.WARNING) as logs:
+                self.assertListEqual([], server.get_batch(), "Datagrams out of nowhere")
+                server.socket.close()
+                self.assertListEqual([], server.get_batch(), "Datagrams out of a closed socket")
+            self.assertEqual(1, len(logs.output), "Wrong errors logged")
         finally:
             server.socket.close()
             
@@ -93,16 +105,59 @@ class ServerTest(unittest.TestCase):
         client.bind((host, 2000))
         client.connect((grp_addr1, port1))
         print("Creating McastRouter on interface %s bound to %s:%d and %s:%d" % (host, grp_addr1, port1, grp_addr2, port2))
-        router = McastRouter((host, port1), (grp_addr1, port1), (host, port2), (grp_addr2, port2))
+        drop = lambda data, src: None if data.endswith(b'3') else data
+        router = McastRouter((host, port1), (grp_addr1, port1), (host, port2), (grp_addr2, port2), drop)
         try:
             msg = lambda s: bytes(testData + str(s), 'utf8')        
             Timer(5, testfunc, args=(client,)).start()
             router.route_forever()
+            self.assertEqual(4, router.forwarded[((grp_addr1, port1), (grp_addr2, port2))], "Wrong number of datagrams forwarded")
+            self.assertEqual(0, router.forwarded[((grp_addr2, port2), (grp_addr1, port1))], "Datagrams forwarded back")
+            self.assertEqual(1, router.filtered[(grp_addr1, port1)], "Datagram not filtered")
+            self.assertEqual((0, 0), (router.seen.hits, router.seen.misses), "Datagrams other than RMcast cached")
         finally:
             client.close()
             router.server1.socket.close()
             router.server2.socket.close()  
         
+        # RMcast messages are told apart by their whole header (epoch, sequence number, ack) and body
+        rmcast = lambda seq, ack, body: SequencedDgramMsgHandler.HEADER.pack(seq, 1, ack) + body
+        nak = lambda baddr: McastRouter.rmcastkey(SequencedDgramMsgHandler.HEADER.pack(5, 7, (10 << 32) + baddr))
+        self.assertNotEqual(nak(1), nak(2), "NAKs of different receivers collide")
+        self.assertNotEqual(McastRouter.rmcastkey(rmcast(1, 1, b'')), McastRouter.rmcastkey(rmcast(1, 2, b'')), "Ack not in key")
+        self.assertNotEqual(McastRouter.rmcastkey(rmcast(1, 1, b'a')), McastRouter.rmcastkey(rmcast(1, 1, b'b')), "Body not in key")
+        self.assertNotEqual(McastRouter.rmcastkey(rmcast(1, 1, b'a')), McastRouter.rmcastkey(rmcast(2, 1, b'a')), "Seq not in key")
+        
+        # Datagrams forwarded by another router aren't forwarded again; once it's silent for a while
+        # this router forwards everything
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind((host, 2000))
+        client.connect((grp_addr1, port1))
+        router = McastRouter((host, port1), (grp_addr1, port1), (host, port2), (grp_addr2, port2),
+                             routers=[[(host, 2000)]], peerttl=0.5)
+        try:
+            client.send(rmcast(1, 0, b'Echo!'))
+            sleep(0.2)
+            router.route(0)
+            self.assertEqual(0, router.forwarded[((grp_addr1, port1), (grp_addr2, port2))], "Datagram from a router forwarded")
+            sleep(0.5)
+            self.assertTrue(router.designated(0, 1) and router.designated(1, 0), "Traffic not forwarded with the other router silent")
+        finally:
+            client.close()
+            router.server1.socket.close()
+            router.server2.socket.close()
+        
+    def testSeenCache ( self ):
+        cache = SeenCache(0.2, 3)
+        self.assertFalse(cache.seen(b'a'), "Key seen before it was added")
+        self.assertTrue(cache.seen(b'a'), "Key not remembered")
+        for key in (b'b', b'c', b'd'): cache.seen(key)
+        self.assertEqual(3, len(cache), "Cache not bounded")
+        self.assertFalse(cache.seen(b'a'), "Oldest key not dropped")
+        sleep(0.3)
+        self.assertFalse(cache.seen(b'd'), "Key not expired")
+        self.assertEqual((1, 1), (len(cache), cache.hits), "Wrong cache status")
+        
     def testRMcastServer ( self ):
         testData = "Echo!"
         port = 2003
@@ -191,6 +246,271 @@ class ServerTest(unittest.TestCase):
         finally:
             server.socket.close()
         
+    def testRMcastServerRangeNak ( self ):
+        testData = "Echo!"
+        port = 2016
+        grp_addr = "224.0.0.1"
+        msg = lambda s: bytes(testData + str(s), 'utf8')
+        naks = []
+        def testfunc ( s ):
+            # Messages 3 to 12 are lost, a single NAK should recover them all
+            for seq in range(1, 21):
+                m = SequencedMessage(seq=seq, epoch=s.epoch, ack=s.ack, body=msg(seq))
+                s.sndq.push(m)
+                if not 3 <= seq <= 12:
+                    McastServer.send(s, s.encode(m))
+            sleep(3)
+            s.shutdown()
+             
+        self.__msgq.clear()
+        host = socket.gethostbyname(self.__hostaddr)
+        print("Creating RMcastServer on interface %s bound to %s" % (host, grp_addr))
+        server = RMcastServer((grp_addr, port), (host, port), self)
+        sendnak = server.sendnak
+        server.sendnak = lambda *args: naks.append(args) or sendnak(*args)
+        try:
+            Timer(3, testfunc, args=(server,)).start()
+            server.serve_forever()
+            self.assertListEqual(list(self.__msgq), [msg(seq) for seq in range(1, 21)], "RMcast server range NAK test failed")
+            self.assertEqual(1, len(naks), "Burst loss not recovered with a single NAK")
+            self.assertListEqual(list(range(3, 13)), naks[0][2], "Wrong messages NAK'd")
+        finally:
+            server.socket.close()
+        
+    def testRMcastServerBatch ( self ):
+        testData = "Echo!"
+        port = 2017
+        grp_addr = "224.0.0.1"
+        msg = lambda s: bytes(testData + str(s), 'utf8')
+        def testfunc ( s ):
+            for seq in range(1, 101): s.send(msg(seq))
+            sleep(3)
+            s.shutdown()
+             
+        self.__msgq.clear()
+        host = socket.gethostbyname(self.__hostaddr)
+        print("Creating batching RMcastServer on interface %s bound to %s" % (host, grp_addr))
+        server = RMcastServer((grp_addr, port), (host, port), self, batchbytes=512, batchdelay=5000)
+        try:
+            Timer(3, testfunc, args=(server,)).start()
+            server.serve_forever()
+            self.assertListEqual(list(self.__msgq), [msg(seq) for seq in range(1, 101)], "RMcast server batch test failed")
+            self.assertLess(server.sndq.seq, 10, "Payloads not coalesced")
+        finally:
+            server.socket.close()
+        
+    def testRMcastServerZeroCopy ( self ):
+        port = 2033
+        grp_addr = "224.0.0.1"
+        sender = '10.0.0.1'
+        header = SequencedDgramMsgHandler.HEADER
+        
+        self.__msgq.clear()
+        host = socket.gethostbyname(self.__hostaddr)
+        print("Creating RMcastServer on interface %s bound to %s" % (host, grp_addr))
+        server = RMcastServer((grp_addr, port), (host, port), self)
+        buf = bytearray(64)
+        try:
+            # Every datagram is received into the same buffer, as the receive buffer pool does;
+            # message 3 arrives ahead of 2 and waits in the reorder window
+            for seq in (1, 3, 2):
+                datagram = header.pack(seq, server.epoch, 0) + bytes("Echo!%d" % seq, 'utf8')
+                buf[:] = bytes(len(buf))
+                buf[:len(datagram)] = datagram
+                SequencedDgramMsgHandler.handlebatch(server, [(memoryview(buf)[:len(datagram)], (sender, port))])
+            buf[:] = bytes(len(buf))
+            self.assertListEqual([b'Echo!1', b'Echo!2', b'Echo!3'], list(self.__msgq), "Bodies overwritten by later datagrams")
+            self.assertTrue(all(type(body) is bytes for body in self.__msgq), "Bodies delivered as views")
+            server.rcvq(sender).cancelTimer()
+        finally:
+            server.socket.close()
+        
+    def testRMcastServerDeliveryPool ( self ):
+        port = 2018
+        grp_addr = "224.0.0.1"
+        msg = lambda s: bytes("Echo!" + str(s), 'utf8')
+        slow, fast = '10.0.0.1', '10.0.0.2'
+        delivered = {slow: [], fast: []}
+        class Handler(object):
+            def handle ( self, msg, src ):
+                if src == slow: sleep(0.1)
+                delivered[src].append(msg)
+        
+        host = socket.gethostbyname(self.__hostaddr)
+        print("Creating RMcastServer with delivery pool on interface %s bound to %s" % (host, grp_addr))
+        server = RMcastServer((grp_addr, port), (host, port), Handler(), delivery_workers=2)
+        try:
+            # Feed the server directly, as if the messages were coming from two different senders
+            for seq in range(1, 11):
+                for src in (slow, fast):
+                    server.receive(SequencedMessage(seq=seq, epoch=server.epoch, ack=0, body=msg(seq)), src)
+            sleep(0.5)
+            self.assertListEqual([msg(seq) for seq in range(1, 11)], delivered[fast], "Fast sender delayed by slow one")
+            self.assertLess(len(delivered[slow]), 10, "Slow sender delivered in no time")
+            sleep(1)
+            self.assertListEqual([msg(seq) for seq in range(1, 11)], delivered[slow], "Slow sender messages out of order")
+        finally:
+            server.socket.close()
+        
+    def testRMcastServerSpottedNak ( self ):
+        port = 2019
+        grp_addr = "224.0.0.1"
+        sender, peer, other = '10.0.0.1', '10.0.0.2', '10.0.0.3'
+        self.assertEqual(socket.inet_aton(sender), RMcastServer.iton(RMcastServer.ntoi(socket.inet_aton(sender))),
+                         "Wrong address conversion")
+        
+        host = socket.gethostbyname(self.__hostaddr)
+        print("Creating RMcastServer on interface %s bound to %s" % (host, grp_addr))
+        server = RMcastServer((grp_addr, port), (host, port), self)
+        try:
+            # Feed the server directly; message 2 from sender is missing, then peer NAKs it
+            for seq in (1, 3, 4):
+                server.receive(SequencedMessage(seq=seq, epoch=server.epoch, ack=0, body=b'Echo!'), sender)
+            self.assertFalse(server.rcvq(sender).nakseen, "NAK spotted before it was sent")
+            nak = (2 << 32) + RMcastServer.ntoi(socket.inet_aton(sender))
+            server.receive(SequencedMessage(seq=1, epoch=server.epoch, ack=nak, body=b''), peer)
+            self.assertTrue(server.rcvq(sender).nakseen, "NAK from peer not spotted")
+            server.rcvq(sender).cancelTimer()
+            
+            # A message beyond the window end gets the window NAK'd, though nothing is queued
+            server.receive(SequencedMessage(seq=1, epoch=server.epoch, ack=0, body=b'Echo!'), other)
+            server.receive(SequencedMessage(seq=2000, epoch=server.epoch, ack=0, body=b'Echo!'), other)
+            rcvq = server.rcvq(other)
+            self.assertTrue(rcvq.empty and rcvq.nakseen, "Window not NAK'd on overflow")
+            self.assertEqual(list(range(2, 2 + rcvq.maxwindow)), list(rcvq.missing()), "Wrong missing messages")
+            rcvq.cancelTimer()
+        finally:
+            server.socket.close()
+        
+    def testRMcastServerFragments ( self ):
+        port = 2022
+        grp_addr = "224.0.0.1"
+        sender = '10.0.0.1'
+        payload = bytes(range(256)) * 40
+        
+        self.__msgq.clear()
+        host = socket.gethostbyname(self.__hostaddr)
+        print("Creating RMcastServer on interface %s bound to %s" % (host, grp_addr))
+        server = RMcastServer((grp_addr, port), (host, port), self, mtu=1000, maxmsgsize=len(payload))
+        try:
+            server.send(payload)
+            fragments = [server.sndq[seq] for seq in range(server.sndq.first, server.sndq.seq+1)]
+            self.assertEqual(11, len(fragments), "Wrong number of fragments")
+            self.assertTrue(all(len(f.body) <= 1000 for f in fragments), "Fragment larger than MTU")
+            self.assertRaises(ValueError, server.send, payload + b'!')
+            
+            # Feed the server directly as if fragments came from another sender; one gets lost
+            for f in fragments[:3] + fragments[4:]:
+                server.receive(f, sender)
+            self.assertEqual(0, len(self.__msgq), "Payload delivered with a fragment missing")
+            server.receive(fragments[3], sender)
+            self.assertListEqual([payload], list(self.__msgq), "Payload not reassembled")
+            server.rcvq(sender).cancelTimer()
+        finally:
+            server.socket.close()
+
+        # Payloads can't need more fragments than the receivers' window holds
+        server = RMcastServer((grp_addr, port), (host, port), self, mtu=1000, rcvwindow=8)
+        try:
+            self.assertEqual(8 * (1000 - RMcastServer.FRAGMENT.size), server.maxmsgsize, "Wrong default max message size")
+            self.assertRaises(ValueError, server.send, payload)
+        finally:
+            server.socket.close()
+        server = RMcastServer((grp_addr, port), (host, port), self, mtu=1000, rcvwindow=8, maxmsgsize=len(payload))
+        try:
+            self.assertRaises(ValueError, server.send, payload)
+            self.assertEqual(0, server.sndq.seq, "Fragments sent for a rejected payload")
+        finally:
+            server.socket.close()
+        
+    def testRMcastServerFlowControl ( self ):
+        port = 2023
+        grp_addr = "224.0.0.1"
+        peer = '10.0.0.1'
+
+        host = socket.gethostbyname(self.__hostaddr)
+        print("Creating flow-controlled RMcastServer on interface %s bound to %s" % (host, grp_addr))
+        server = RMcastServer((grp_addr, port), (host, port), self, sndwindow=4, sndtimeout=0.2)
+        baddr = RMcastServer.ntoi(socket.inet_aton(host))
+        ackfrom = lambda seq, ack: server.receive(SequencedMessage(seq=seq, epoch=server.epoch, ack=(ack << 32) + baddr, body=b'Echo!'), peer)
+        try:
+            server.send(b'Echo!')
+            ackfrom(1, 1)       # the peer is missing our first message
+            for _ in range(3): server.send(b'Echo!')
+            self.assertEqual(4, server.inflight, "Wrong number of messages in flight")
+            self.assertRaises(TimeoutError, server.send, b'Echo!')
+
+            # Acks make room in the window, NAKs shrink it
+            sleep(0.1)
+            ackfrom(2, 4)
+            self.assertGreater(server.sndrate, 0, "Ack rate not measured")
+            server.send(b'Echo!')
+            server.receive(SequencedMessage(seq=2, epoch=server.epoch, ack=(4 << 32) + baddr, body=b''), peer)
+            self.assertEqual(2, server.sndwindow, "Window not shrunk on NAK")
+            self.assertRaises(TimeoutError, server.send, b'Echo!')
+
+            # A peer that is gone doesn't hold the window back anymore
+            server.forgetpeer(peer)
+            server.send(b'Echo!')
+            server.rcvq(peer).cancelTimer()
+        finally:
+            server.socket.close()
+
+    def testRMcastServerLegacyShelf ( self ):
+        port = 2032
+        grp_addr = "224.0.0.1"
+        sender = '10.0.0.1'
+        msg = lambda seq: bytes("Echo!" + str(seq), 'utf8')
+        
+        host = socket.gethostbyname(self.__hostaddr)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            station = os.path.join(tmpdir, 'station')
+            with shelve.open(station) as shelf:
+                for seq in range(1, 4):
+                    shelf[str(seq)] = msg(seq)
+                shelf['4'] = (RMcastServer.FRAME_BATCH, msg(4))
+                shelf[sender] = 7
+            print("Creating lossless RMcastServer on interface %s from legacy shelf" % host)
+            server = RMcastServer((grp_addr, port), (host, port), self, station_id=station, lossless=True)
+            try:
+                self.assertEqual(4, server.sndq.seq, "Last sequence number not imported")
+                self.assertEqual(7, server.rcvq(sender).ack, "Ack not imported")
+                Timer(0.5, server.shutdown).start()
+                server.serve_forever()
+            finally:
+                server.socket.close()
+            log = SequencedMsgLog(station)
+            self.assertEqual((0, msg(1)), log[1], "Message not imported")
+            self.assertEqual((RMcastServer.FRAME_BATCH, msg(4)), log[4], "Message flags not imported")
+            log.close()
+        
+    def testRMcastServerFEC ( self ):
+        port = 2024
+        grp_addr = "224.0.0.1"
+        sender = '10.0.0.1'
+        parities = []
+
+        self.__msgq.clear()
+        host = socket.gethostbyname(self.__hostaddr)
+        print("Creating RMcastServer with FEC on interface %s bound to %s" % (host, grp_addr))
+        server = RMcastServer((grp_addr, port), (host, port), self, fec=4)
+        sendbatch = server.sendbatch
+        server.sendbatch = lambda batch: sendbatch([d for d in batch if parities.append(d[0]) or True])
+        try:
+            for seq in range(1, 10): server.send(b'Echo!' * seq)
+            self.assertEqual(2, len(parities), "Wrong number of parity datagrams")
+            msgs = [server.sndq[seq] for seq in range(1, 10)]
+            parities = [SequencedDgramMsgHandler.decode(namedtuple('Handler', 'request')((p, None))) for p in parities]
+
+            # Feed the server directly as if messages came from another sender; message 7 gets lost
+            for m in msgs[:4] + parities[:1] + msgs[4:6] + msgs[7:] + parities[1:]:
+                server.receive(m, sender)
+            self.assertListEqual([b'Echo!' * seq for seq in range(1, 10)], list(self.__msgq), "Lost message not rebuilt")
+            self.assertEqual((1, 0), (server.fecrecovered, server.nakrecovered), "Wrong recovery counters")
+            server.rcvq(sender).cancelTimer()
+        finally:
+            server.socket.close()
+
     def testRMcastServerRestart ( self ):
         testData = "Echo!"
         port = 2007
@@ -393,6 +713,368 @@ class ServerTest(unittest.TestCase):
         finally:
             agent.socket.close()
         
+    def testProtocolAgentAsyncio ( self ):
+        @ProtocolAgent.Asyncio
+        class AgentTestAsyncio ( deque ):
+            TestMsg = namedtuple('TestMsg', 'a,b')
+            
+            @ProtocolAgent.handles('TestMsg')
+            def testHandler ( self, msg, src ):
+                self.append(msg)
+                
+        testmsgs = [AgentTestAsyncio.TestMsg(a=1, b='Hi'), AgentTestAsyncio.TestMsg(a=2, b='there!')]
+        host = socket.gethostbyname(self.__hostaddr)
+        grp_addr, port = "224.0.0.1", 2025
+        loop = asyncio.new_event_loop()
+        timers = AsyncioScheduler(loop)
+        fired = []
+        
+        # Agents, a RMcastServer and their timers all run on the loop's thread
+        agentA, agentB = AgentTestAsyncio((host, port), loop=loop), AgentTestAsyncio((host, port+1), loop=loop)
+        self.assertRaises(ValueError, AgentTestAsyncio, (host, port+2))     # no loop running to default to
+        server = RMcastServer((grp_addr, port), (host, port), self, scheduler=timers)
+        server.serve_on(loop)
+        self.__msgq.clear()
+        threads = len(threading.enumerate())
+        try:
+            for msg in testmsgs: agentA.send(msg, agentB.address())
+            for seq in range(1, 4): server.send(b'Echo!' + bytes(str(seq), 'utf8'))
+            timers.schedule(0.1, fired.append, (1,))
+            timers.schedule(0.2, fired.append, (2,)).cancel()
+            loop.run_until_complete(asyncio.sleep(1))
+            self.assertEqual(threads, len(threading.enumerate()), "Asyncio agents spawned threads")
+            self.assertListEqual(testmsgs, list(agentB), "Lists not equal")
+            self.assertListEqual([b'Echo!1', b'Echo!2', b'Echo!3'], list(self.__msgq), "RMcast server not served by the loop")
+            self.assertEqual(([1], 0), (fired, timers.pending), "Timers not run by the loop")
+        finally:
+            server.stop_serving(loop)
+            server.socket.close()
+            agentA.shutdown()
+            agentB.shutdown()
+            loop.run_until_complete(asyncio.sleep(0.1))
+            loop.close()
+        
+    def testProtocolAgentMultiplexedTCP ( self ):
+        @ProtocolAgent.MultiplexedTCP
+        class AgentTestMux ( deque ):
+            TestMsg = namedtuple('TestMsg', 'a,b')
+            
+            @ProtocolAgent.handles('TestMsg')
+            def testHandler ( self, msg, src ):
+                self.append(msg)
+        
+        testmsgs = [AgentTestMux.TestMsg(a=n, b='Hi') for n in range(100)]
+        host = socket.gethostbyname(self.__hostaddr)
+        port = 2026
+        agent = AgentTestMux((host, port), tcpopts={'idletime': 1})
+        server = Thread(target=agent.serve_forever, kwargs={'poll_interval': 0.1})
+        server.start()
+        clients = []
+        try:
+            threads = len(threading.enumerate())
+            # Many clients, each one sending a message split across two writes
+            for msg in testmsgs:
+                data = agent.msgcodec.encode(msg)
+                client = socket.create_connection(agent.address())
+                client.sendall(Framing.HEADER.pack(len(data)) + data[:3])
+                clients.append((client, data[3:]))
+            sleep(0.5)
+            self.assertEqual(0, len(agent), "Message handled before it was complete")
+            for client, rest in clients: client.sendall(rest)
+            agent.send(testmsgs[0], agent.address())
+            sleep(0.5)
+            self.assertCountEqual(testmsgs + testmsgs[:1], list(agent), "Lists not equal")
+            self.assertEqual(threads, len(threading.enumerate()), "Connections spawned threads")
+            self.assertEqual(len(testmsgs) + 2, len(agent.peers), "Wrong number of connections")
+            sleep(1.5)
+            self.assertEqual(0, len(agent.peers), "Idle connections not closed")
+        finally:
+            agent.shutdown()
+            server.join()
+            agent.close()
+            for client, _ in clients: client.close()
+        
+    def testProtocolAgentTCPConnections ( self ):
+        @ProtocolAgent.TCP
+        class AgentTestPool ( deque ):
+            TestMsg = namedtuple('TestMsg', 'a,b')
+            allow_reuse_address = True      # the agent closes a connection below
+            
+            @ProtocolAgent.handles('TestMsg')
+            def testHandler ( self, msg, src ):
+                self.append(msg)
+        
+        host = socket.gethostbyname(self.__hostaddr)
+        agent = AgentTestPool((host, 2027), tcpopts={'connecttimeout': 1})
+        remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        remote.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        remote.bind((host, 2028))
+        remote.listen(5)
+        remote.settimeout(5)
+        msg = AgentTestPool.TestMsg(a=1, b='Hi')
+        try:
+            def receive ( conn, count ):
+                reader, received = Framing.Reader(), []
+                while len(received) < count: received += reader.recv(conn)
+                return received
+            
+            agent.send(msg, remote.getsockname())
+            agent.send(msg, remote.getsockname())
+            conn, _ = remote.accept()
+            conn.settimeout(5)
+            self.assertEqual(2, len(receive(conn, 2)), "Messages not received")
+            self.assertEqual((1, 1, 0), (agent.dials, agent.reuses, agent.failures), "Connection not re-used")
+            # The remote peer closes the connection, the next send connects again
+            conn.close()
+            sleep(0.1)
+            agent.send(msg, remote.getsockname())
+            conn, _ = remote.accept()
+            conn.settimeout(5)
+            self.assertEqual(1, len(receive(conn, 1)), "Message not re-sent")
+            self.assertEqual(2, agent.dials, "Closed connection re-used")
+            conn.close()
+            # Nobody listening
+            dst = remote.getsockname()
+            remote.close()
+            self.assertRaises(ConnectionError, agent.send, msg, dst)
+            self.assertEqual(2, agent.dials, "Failed connection counted")
+            # A corrupted stream gets the connection closed
+            Thread(target=agent.serve_forever, daemon=True).start()
+            conn = socket.create_connection(agent.address(), 5)
+            conn.sendall(Framing.HEADER.pack(Framing.MAXSIZE + 1))
+            self.assertEqual(b'', conn.recv(1), "Connection with corrupted stream not closed")
+            self.assertNotIn(conn.getsockname(), agent.peers, "Connection with corrupted stream still a peer")
+            conn.close()
+            agent.shutdown()
+        finally:
+            remote.close()
+            agent.close()
+        
+    def testFraming ( self ):
+        msgs = [b'', b'Hi', bytes(range(256)) * 1024, b'there!' * 100]
+        reader = Framing.Reader(1024)
+        data = b''.join(Framing.HEADER.pack(len(m)) + m for m in msgs)
+        received = []
+        for offset in range(0, len(data), 1000):
+            received += reader.feed(data[offset:offset+1000])
+        self.assertListEqual(msgs, received, "Messages not reassembled")
+        self.assertRaises(ValueError, reader.feed, Framing.HEADER.pack(Framing.MAXSIZE + 1))
+        
+        # Many messages written at once, read back from a non-blocking socket
+        a, b = socket.socketpair()
+        try:
+            sender = Thread(target=Framing.sendall, args=(a, msgs * 10))
+            sender.start()
+            reader, received = Framing.Reader(), []
+            b.settimeout(5)
+            while len(received) < len(msgs) * 10:
+                received += reader.recv(b)
+            sender.join()
+            self.assertListEqual(msgs * 10, received, "Messages corrupted")
+            a.close()
+            self.assertIsNone(reader.recv(b), "Connection close not detected")
+        finally:
+            a.close()
+            b.close()
+        
+    def testProtocolAgentDispatchTable ( self ):
+        @ProtocolAgent.local
+        class AgentTestDispatch ( deque ):
+            TestMsg = namedtuple('TestMsg', 'a,b')
+            OtherMsg = namedtuple('OtherMsg', 'c')
+
+            @ProtocolAgent.handles('TestMsg')
+            def testHandler ( self, msg, src ):
+                self.append(msg)
+
+        table = AgentTestDispatch.dispatchtable
+        self.assertEqual(table['TestMsg'][0], AgentTestDispatch.TestMsg, "Wrong message type in dispatch table")
+        self.assertIsNotNone(table['TestMsg'][1], "Missing handler in dispatch table")
+        self.assertIsNone(table['OtherMsg'][1], "Unexpected handler in dispatch table")
+        self.assertNotIn('NoSuchMsg', table, "Unexpected message in dispatch table")
+
+        agent = AgentTestDispatch()
+        agent.handle(agent.msgcodec.encode(AgentTestDispatch.TestMsg(a=1, b='Hi')), agent.address())
+        agent.handle(agent.msgcodec.encode(AgentTestDispatch.OtherMsg(c=2)), agent.address())
+        agent.handle(b'\xff\xff', agent.address())
+        # Garbage is handed over to the unknown message handler too
+        garbage = []
+        agent.unknownhandler = lambda message, src: garbage.append(bytes(message))
+        testmsg = agent.msgcodec.encode(AgentTestDispatch.TestMsg(a=1, b='Hi'))
+        for message in (testmsg[:-1], testmsg[:2] + b'\x63', testmsg[:2] + b'\x08\xff', testmsg[:1]):
+            agent.handle(message, agent.address())
+        self.assertEqual(4, len(garbage), "Garbage not handed over to the unknown message handler")
+        self.assertListEqual([AgentTestDispatch.TestMsg(a=1, b='Hi')], list(agent), "Lists not equal")
+
+    def testProtocolAgentCodecs ( self ):
+        TestMsg = namedtuple('TestMsg', 'a,b,c,d,e')
+        msgtypes = {'TestMsg': TestMsg}
+        testmsg = TestMsg(a=1, b=-2.5, c='Hi there!', d=b'\x00\x01', e={'k': [1, None, True], 'l': ('x', 2)})
+        codec = BinaryCodec(msgtypes)
+        self.assertEqual(('TestMsg', testmsg), codec.decode(codec.encode(testmsg)), "Binary codec round-trip failed")
+        codec, testmsg = JSONCodec(msgtypes), testmsg._replace(d=None, e={'k': [1, None, True]})
+        self.assertEqual(('TestMsg', testmsg), codec.decode(codec.encode(testmsg)), "JSON codec round-trip failed")
+        NumbersMsg = namedtuple('NumbersMsg', 'a,b')
+        codec = BinaryCodec({'NumbersMsg': NumbersMsg})
+        for testmsg in (NumbersMsg(1, 2.5), NumbersMsg(2, 3.5), NumbersMsg(2.5, 1 << 40), NumbersMsg(1, None)):
+            self.assertEqual(('NumbersMsg', testmsg), codec.decode(codec.encode(testmsg)), "Binary codec round-trip failed")
+        self.assertRaises(KeyError, BinaryCodec(msgtypes).decode, b'\x00\x01')
+        self.assertRaises(ValueError, BinaryCodec(msgtypes).encode, namedtuple('OtherMsg', 'a')(1))
+        # Identifiers don't depend on the other messages a codec knows
+        testmsg = TestMsg(a=1, b=-2.5, c='Hi there!', d=None, e=None)
+        codec = BinaryCodec(dict(msgtypes, AMsg=namedtuple('AMsg', 'a'), ZMsg=namedtuple('ZMsg', 'z')))
+        self.assertEqual(('TestMsg', testmsg), BinaryCodec(msgtypes).decode(codec.encode(testmsg)), "Codecs disagree")
+
+        @ProtocolAgent.local
+        class AgentTestJSON ( deque ):
+            codec = JSONCodec
+            TestMsg = namedtuple('TestMsg', 'a,b')
+
+            @ProtocolAgent.handles('TestMsg')
+            def testHandler ( self, msg, src ):
+                self.append(msg)
+
+        agent = AgentTestJSON()
+        self.assertIsInstance(agent.msgcodec, JSONCodec, "Codec class not honoured")
+        agent.handle(b'TestMsg:{"a": 1, "b": "Hi"}', agent.address())
+        self.assertListEqual([AgentTestJSON.TestMsg(a=1, b='Hi')], list(agent), "Lists not equal")
+
+    def testProtocolAgentBatch ( self ):
+        @ProtocolAgent.UDP
+        class AgentTestBatch ( deque ):
+            TestMsg = namedtuple('TestMsg', 'a,b')
+            
+            @ProtocolAgent.handles('TestMsg')
+            def testHandler ( self, msg, src ):
+                self.append(msg)
+        
+        testmsgs = [AgentTestBatch.TestMsg(a=n, b='Hi') for n in range(10)]
+        agentA, agentB = AgentTestBatch(('127.0.0.1', 2014)), AgentTestBatch(('127.0.0.1', 2015))
+        try:
+            for msg in testmsgs:
+                self.assertFalse(agentA.sendmany(msg, [agentA.address(), agentB.address()]), "Send failed")
+            sleep(0.5)
+            agentA.handle_request()     # a single wake-up handles all the datagrams ready
+            agentB.handle_request()
+            self.assertListEqual(testmsgs, list(agentA), "Lists not equal")
+            self.assertListEqual(testmsgs, list(agentB), "Lists not equal")
+        finally:
+            agentA.socket.close()
+            agentB.socket.close()
+
+    def testSequencedMsgSndQueue ( self ):
+        sndq = SequencedMsgSndQueue(0, 4)
+        for seq in range(1, 6):
+            sndq.push(SequencedMessage(seq=seq, epoch=0, ack=0, body=bytes(seq)))
+        self.assertEqual((5, 2, 4, 1), (sndq.seq, sndq.first, len(sndq), sndq.dropped), "Wrong queue status")
+        self.assertEqual(sum(range(2, 6)), sndq.nbytes, "Wrong queue size")
+        self.assertEqual(3, sndq[3].seq, "Wrong message retrieved")
+        self.assertRaises(IndexError, sndq.__getitem__, 1)
+        
+        # The queue is trimmed down to the lowest ack from all peers
+        sndq.updateack(5, 'peerA')
+        sndq.updateack(4, 'peerB')
+        sndq.tail()
+        self.assertEqual((4, 4), (sndq.ack, sndq.first), "Queue trimmed beyond lowest ack")
+        sndq.updateack(4, 'peerB')
+        sndq.updateack(4, 'peerB')
+        self.assertEqual(3, sndq.ackcount, "Wrong duplicated ack count")
+        sndq.forget('peerB')
+        sndq.tail()
+        self.assertEqual((5, 5, 1), (sndq.ack, sndq.first, len(sndq)), "Wrong queue status")
+        
+        # A peer stuck at an old ack doesn't let the acks of the others pile up underneath
+        sndq = SequencedMsgSndQueue(0, 4)
+        sndq.updateack(1, 'peerA')
+        for ack in range(2, 1002):
+            sndq.updateack(ack, 'peerB')
+        self.assertEqual(1, sndq.ack, "Wrong lowest ack")
+        self.assertLessEqual(len(sndq._SequencedMsgSndQueue__ackheap), 2 * 2 + SequencedMsgSndQueue.SLACK + 1,
+                             "Stale acks not dropped")
+        sndq.forget('peerA')
+        self.assertEqual(1001, sndq.ack, "Wrong lowest ack")
+        
+        # Senders push while the receiving thread records acks and trims the queue
+        sndq, errors = SequencedMsgSndQueue(0, 8), []
+        def pushing ( ):
+            try:
+                for seq in range(1, 20001):
+                    sndq.push(SequencedMessage(seq=seq, epoch=0, ack=0, body=b'Echo!'))
+            except Exception as e:
+                errors.append(e)
+        pusher = Thread(target=pushing)
+        pusher.start()
+        while pusher.is_alive():
+            sndq.updateack(sndq.seq, 'peerA')
+            sndq.tail()
+        pusher.join()
+        self.assertListEqual([], errors, "Concurrent push failed")
+        self.assertListEqual(list(range(sndq.first, 20001)), [msg.seq for msg in sndq], "Ring out of order")
+        self.assertEqual(5 * len(sndq), sndq.nbytes, "Wrong queue size")
+
+    def testSequencedMsgRcvQueue ( self ):
+        rcvq = SequencedMsgRcvQueue(1, 0, 4)
+        msg = lambda seq: SequencedMessage(seq=seq, epoch=0, ack=0, body=bytes(seq))
+        Q = SequencedMsgRcvQueue
+        self.assertEqual([Q.ACCEPTED, Q.ACCEPTED, Q.DUPLICATE, Q.OVERFLOW], [rcvq.push(msg(s)) for s in (3, 2, 3, 5)],
+                         "Wrong push outcomes")
+        self.assertEqual((2, 2), (len(rcvq), rcvq.first), "Wrong queue status")
+        self.assertEqual([], list(rcvq.head()), "Messages delivered out of order")
+        
+        # Once the gap is filled the window slides past all consecutive messages
+        rcvq.push(msg(1))
+        self.assertEqual([1, 2, 3], [m.seq for m in rcvq.head()], "Wrong messages delivered")
+        self.assertEqual((4, True, None), (rcvq.ack, rcvq.empty, rcvq.first), "Wrong queue status")
+        self.assertEqual([Q.DUPLICATE, Q.ACCEPTED, Q.OVERFLOW], [rcvq.push(msg(s)) for s in (2, 7, 8)], "Wrong push outcomes")
+        self.assertEqual(7, rcvq.pop().seq, "Wrong message popped")
+        
+        # Messages dropped beyond the window end leave the whole window missing, even if empty
+        rcvq = SequencedMsgRcvQueue(1, 0, 4)
+        self.assertEqual(Q.OVERFLOW, rcvq.push(msg(6)), "Wrong push outcome")
+        self.assertEqual((True, True), (rcvq.empty, rcvq.overflowed), "Wrong queue status")
+        self.assertListEqual([1, 2, 3, 4], list(rcvq.missing()), "Wrong missing messages")
+        rcvq.push(msg(1))
+        list(rcvq.head())
+        self.assertListEqual([2, 3, 4, 5], list(rcvq.missing()), "Window end not followed")
+        
+        # Missing messages are NAK'd once, no matter how many NAKs are spotted for them
+        rcvq = SequencedMsgRcvQueue(4, 0, 8)
+        rcvq.push(msg(7))
+        rcvq.push(msg(9))
+        self.assertListEqual([4, 5, 6, 8], list(rcvq.missing()), "Wrong missing messages")
+        self.assertTrue(rcvq.spot([1, 5, 6, 9]), "NAK for missing messages not recorded")
+        self.assertListEqual([4, 8], list(rcvq.unspotted()), "Wrong unspotted messages")
+        self.assertFalse(rcvq.nakseen, "NAKs spotted for some missing messages only")
+        rcvq.spot(range(4, 9))
+        self.assertTrue(rcvq.nakseen, "NAKs spotted for all missing messages")
+        bitmap = RMcastServer.nakmap(4, rcvq.missing())
+        self.assertEqual((1, [4, 5, 6, 8]), (len(bitmap), RMcastServer.nakseqs(4, bitmap)), "Wrong NAK bitmap")
+
+    def testSequencedMsgLog ( self ):
+        msg = lambda seq: bytes("Echo!" + str(seq), 'utf8')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logid = os.path.join(tmpdir, 'station')
+            log = SequencedMsgLog(logid, 100)
+            for seq in range(1, 251):
+                log.append(seq, msg(seq), seq % 2)
+            log.commit()
+            self.assertEqual(3, len(log.segments), "Wrong number of segments")
+            self.assertEqual((1, msg(77)), log[77], "Wrong record retrieved")
+            log.close()
+            
+            # Simulate a crash in the middle of a record
+            with open(log.segments[-1], 'ab') as f:
+                f.write(SequencedMsgLog.RECORD.pack(251, 0, 10) + b'Echo')
+            log = SequencedMsgLog(logid, 100)
+            self.assertEqual(250, log.lastseq, "Incomplete record recovered")
+            self.assertEqual((0, msg(250)), log[250], "Wrong record retrieved")
+            self.assertEqual((1, msg(101)), log[101], "Wrong record retrieved")
+            self.assertRaises(KeyError, log.__getitem__, 251)
+            log.append(251, msg(251))
+            log.commit(251)
+            self.assertEqual((0, msg(251)), log[251], "Wrong record retrieved")
+            log.close()
+
     def testRepeatableTimer ( self ):
         testData = 'Hi there!'
         
@@ -405,29 +1087,198 @@ class ServerTest(unittest.TestCase):
         
         timer = RepeatableTimer(1, ServerTest.handle, (self, testData, self), {}, 10)
         timer.start()
-        sleep(5)
+        sleep(5.5)      # calls run on threads of their own, cancel half-way between two
         timer.cancel()
         sleep(5)
         self.assertListEqual(list(self.__msgq), [testData]*5, "Lists not equal")
         
         self.__msgq.clear()
     
+    def testTimerScheduler ( self ):
+        scheduler = TimerScheduler()
+        fired = []
+        handles = [scheduler.schedule(0.1*n, fired.append, (n,)) for n in range(10, 0, -1)]
+        for handle in handles[::2]:
+            handle.cancel()
+        self.assertEqual(5, scheduler.pending, "Wrong number of pending timers")
+        sleep(1.5)
+        self.assertListEqual([1, 3, 5, 7, 9], fired, "Timers fired out of order or not cancelled")
+        self.assertFalse(any(handle.pending for handle in handles), "Timers still pending")
+        
+        # Timers don't get their own threads
+        threads = len(threading.enumerate())
+        handles = [scheduler.schedule(10, fired.append, (n,)) for n in range(100)]
+        self.assertEqual(threads, len(threading.enumerate()), "Timers spawned threads")
+        list(map(TimerScheduler.Handle.cancel, handles))
+        self.assertEqual(0, scheduler.pending, "Wrong number of pending timers")
+        
+        # Repeatable timers blocking don't hold the other timers back
+        release, fired = threading.Event(), []
+        timer = RepeatableTimer(0.1, release.wait, (), {}, 2, scheduler)
+        timer.start()
+        scheduler.schedule(0.3, fired.append, (1,))
+        sleep(0.5)
+        self.assertListEqual([1], fired, "Timer delayed by a blocking repeatable timer")
+        release.set()
+        timer.join(1)
+        self.assertFalse(timer.is_alive(), "Repeatable timer not finished")
+    
     def testStateXferAgent ( self ):
         host = socket.gethostbyname(self.__hostaddr)
         port = 2012
         
         print("Creating state xfer agents on interface %s and ports %d and %d" % (host, port, port+1))
-        stateA, stateB = dict(zip(range(5), range(4, -1, -1))), dict()
-        agentA, agentB = StateXferAgent((host, port), stateA), StateXferAgent((host, port+1), stateB)
+        stateA, stateB = dict(zip(range(10000), map(str, range(9999, -1, -1)))), dict()
+        agentA, agentB = StateXferAgent((host, port), stateA, chunksize=1000), StateXferAgent((host, port+1), stateB)
         try:
             Timer(3, lambda a,b: a.xferState(b.address()), args=(agentA, agentB)).start()
             agentB.serve_forever()       
             self.assertDictEqual(agentA.state, agentB.state, "States not equal")
+            self.assertTrue(agentB.done.is_set(), "Transfer not done")
+            self.assertEqual((10000, 10000), (agentB.items, agentB.total), "Wrong progress")
+            self.assertEqual(agentA.nbytes, agentB.nbytes, "Wrong number of bytes")
+            self.assertLess(agentB.nbytes, 10000 * 8, "Chunks not compressed")
         finally:
             agentA.socket.close()
             agentB.shutdown()
             agentB.socket.close()
         
+    def testParallelStateXfer ( self ):
+        host = socket.gethostbyname(self.__hostaddr)
+        port = 2031
+        state = dict(zip(map(str, range(10000)), range(10000)))
+        pending = set(range(StateXferAgent.PARTITIONS))
+        def breakxfer ( msgs ):
+            sock = socket.create_connection(agent.address())
+            for msg in msgs:
+                Framing.sendall(sock, (StateXferAgent.msgcodec.encode(msg),))
+            sleep(0.5)
+            sock.close()
+        # A sender breaks the transfer in the middle of partition 5
+        agent = StateXferAgent((host, port), {}, parts=pending)
+        items = [(k, v) for k, v in state.items() if StateXferAgent.partition(k) == 5][:10]
+        data = zlib.compress(StateXferAgent.msgcodec.encode(StateXferAgent.ItemsMsg(*zip(*items))))
+        try:
+            Timer(0.5, breakxfer, args=([StateXferAgent.PartsMsg([7, 5]), StateXferAgent.DoneMsg(0, 0, 7),
+                                         StateXferAgent.ChunkMsg(0, len(state), data, 5)],)).start()
+            agent.serve_forever()
+            self.assertTrue(agent.broken, "Broken transfer not detected")
+            self.assertEqual(set(range(StateXferAgent.PARTITIONS)) - {7}, pending, "Wrong partitions pending")
+            received = agent.state
+        finally:
+            agent.shutdown()
+            agent.close()
+        # A sender goes away between partitions
+        agent = StateXferAgent((host, port), received, parts=pending)
+        try:
+            Timer(0.5, breakxfer, args=([StateXferAgent.PartsMsg([3, 4]), StateXferAgent.DoneMsg(0, 0, 3)],)).start()
+            agent.serve_forever()
+            self.assertTrue(agent.broken, "Broken transfer not detected")
+            self.assertEqual(set(range(StateXferAgent.PARTITIONS)) - {3, 7}, pending, "Wrong partitions pending")
+        finally:
+            agent.shutdown()
+            agent.close()
+        # Two senders share the partitions missing, but for one nobody sends
+        agent = StateXferAgent((host, port), received, parts=pending)
+        senders = [StateXferAgent((host, 0), state), StateXferAgent((host, 0), state)]
+        try:
+            for n, sender in enumerate(senders):
+                sender.xferStateAsync(agent.address(), parts=sorted(pending)[1:][n::2])
+            agent.serve_forever()
+            self.assertFalse(agent.broken, "Transfer broken")
+            self.assertEqual({0}, pending, "Wrong partitions pending")
+            expected = dict((k, v) for k, v in state.items() if StateXferAgent.partition(k) not in (0, 3, 7))
+            self.assertEqual(len(expected), senders[0].items + senders[1].items, "Partition done re-sent")
+            self.assertDictEqual(expected, agent.state, "States not equal")
+            self.assertTrue(senders[0].items > 0 and senders[1].items > 0, "Partitions not shared")
+        finally:
+            agent.shutdown()
+            agent.close()
+        
+    def testMerkleDict ( self ):
+        state = MerkleDict(dict(zip(range(1000), map(str, range(1000)))), depth=2)
+        state[1000] = 'new'
+        state[0] = 'changed'
+        del state[1]
+        state.pop(2)
+        state.setdefault(3, 'unchanged')
+        state.update({4: 'updated'})
+        self.assertEqual(MerkleDict(dict(state), depth=2).root, state.root, "Tree not updated incrementally")
+        self.assertEqual(set(range(3, 1001)) | {0}, set().union(*map(state.leafkeys, range(17, 273))), "Wrong leaves")
+        state.clear()
+        self.assertEqual(0, state.root, "Tree not cleared")
+        
+    def testStateSync ( self ):
+        host = socket.gethostbyname(self.__hostaddr)
+        port = 2029
+        stateA = MerkleDict(zip(range(100000), map(str, range(100000))))
+        stateB = MerkleDict(stateA)
+        stateB[0], stateB[100000] = 'stale', 'extra'
+        del stateB[1]
+        agentA, agentB = StateXferAgent((host, port), stateA), StateXferAgent((host, port+1), stateB)
+        try:
+            Timer(1, lambda a,b: a.syncState(b.address()), args=(agentA, agentB)).start()
+            agentB.serve_forever()
+            self.assertDictEqual(agentA.state, agentB.state, "States not equal")
+            self.assertEqual(stateA.root, stateB.root, "Trees not equal")
+            # Three leaves out of 4096, about 25 items each
+            self.assertLess(agentB.items, 200, "Too many items sent")
+        finally:
+            agentA.socket.close()
+            agentB.shutdown()
+            agentB.socket.close()
+        
+        # An item changing after the sender has read the hashes gets sent in a later round
+        class RacyDict ( MerkleDict ):
+            def leafkeys ( self, leaf ):
+                if 0 not in self: self[0] = 'changed'
+                return super(RacyDict, self).leafkeys(leaf)
+        stateA = RacyDict(stateA)
+        del stateA[0]
+        stateB = MerkleDict(stateA)
+        stateB[1] = 'stale'
+        agentA, agentB = StateXferAgent((host, port), stateA), StateXferAgent((host, port+1), stateB)
+        try:
+            Timer(1, lambda a,b: a.syncState(b.address()), args=(agentA, agentB)).start()
+            agentB.serve_forever()
+            self.assertEqual('changed', agentB.state.get(0), "Item changed during the sync not sent")
+            self.assertEqual(stateA.root, stateB.root, "Trees not equal")
+        finally:
+            agentA.socket.close()
+            agentB.shutdown()
+            agentB.socket.close()
+        
+    def testStableCommands ( self ):
+        # Just the state the message handlers need, the constructor waits for state transfer
+        server = LogicalClockServer.__new__(LogicalClockServer)
+        server._LogicalClockServer__mutex = Lock()
+        server._LogicalClockServer__clk = 0
+        server._LogicalClockServer__members = {}
+        server._LogicalClockServer__cmdseq = []
+        server._LogicalClockServer__lasttimes = []
+        forgotten = []
+        server.forgetpeer = forgotten.append
+        a, b = ('10.0.0.1', 2013), ('10.0.0.2', 2013)
+        server.handleCommand(LogicalClockServer.CommandMsg('c1', 1), a)
+        server.handleCommand(LogicalClockServer.CommandMsg('c2', 2), b)
+        server.handleCommand(LogicalClockServer.CommandMsg('c4', 4), a)
+        server.handleHeartbeat(LogicalClockServer.HeartbeatMsg(3), b)
+        self.assertListEqual(['c1', 'c2'], server.drain_stable(), "Wrong stable commands")
+        self.assertFalse(server.isFirstMsgStable(), "Command stable before all members sent a later one")
+        # b dies, a's messages are the only ones to wait for
+        server.members[b] = server.members[b][:2] + (LogicalClockServer.DEAD,)
+        for time in range(5, 1005):
+            server.handleHeartbeat(LogicalClockServer.HeartbeatMsg(time), a)
+        self.assertListEqual(['c4'], list(server), "Wrong stable commands")
+        self.assertLessEqual(len(server._LogicalClockServer__lasttimes), 2 * 2 + LogicalClockServer.SLACK + 1,
+                             "Stale message times not dropped")
+        server.handleBye(LogicalClockServer.ByeMsg(a, 1005), a)
+        self.assertListEqual([a], forgotten, "Member leaving still holds the send window")
+        server.handleCommand(LogicalClockServer.CommandMsg('c1006', 1006), b)
+        self.assertListEqual([], server.drain_stable(), "Command stable before its sender sent a later one")
+        server.handleHeartbeat(LogicalClockServer.HeartbeatMsg(1007), b)
+        self.assertListEqual(['c1006'], server.drain_stable(), "Command from the only member alive not stable")
+        
     def testLogicalClockServer ( self ):
         testCommand = "echo"
         port = 2013